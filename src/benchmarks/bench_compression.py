@@ -0,0 +1,41 @@
+#vim: fileencoding=utf8
+"""Measures CompressionExtension throughput and compression ratio for each compression level.
+
+Usage::
+
+    python bench_compression.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rays
+
+PAGE = "".join("<tr><td>%d</td><td>item %d</td><td><a href='/items/%d'>show</a></td></tr>\n"%(i, i, i)
+               for i in range(1000))
+
+def create_app(level = None):
+  app = rays.Application()
+  if level is not None:
+    app.config("CompressionExtension", {"level": level})
+  @app.get("page")
+  def page():
+    return PAGE
+  env = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+         "REQUEST_METHOD": "GET", "PATH_INFO": "/page", "HTTP_ACCEPT_ENCODING": "gzip"}
+  def request():
+    return b"".join(app(dict(env), lambda status, headers: None))
+  return request
+
+def main(number = 500):
+  size = len(PAGE.encode("utf8"))
+  print("page size: %d bytes" % size)
+  print("%-10s %12s %12s %10s" % ("level", "usec/req", "MB/sec", "ratio"))
+  for level in (None, 1, 6, 9):
+    request = create_app(level)
+    body = request()
+    t = timeit.timeit(request, number=number) / number
+    print("%-10s %12.1f %12.1f %10.3f" % (level or "off", t*1e6, size/t/1e6, len(body)/size))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,54 @@
+#vim: fileencoding=utf8
+"""Measures HTML escaping with the former reduce based implementation and rays.escape_html,
+and rendering of a table-heavy template with the default filter.
+
+Usage::
+
+    python bench_escape.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from functools import reduce
+import rays
+from rays.compat import *
+
+TABLE = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ("'", "&#39;"), ('"', "&quot;"))
+def reduce_escape_html(s):
+  return reduce(lambda r,v: r.replace(v[0], v[1]), TABLE, s)
+
+def reduce_filter(s):
+  if not isinstance(s, rays.EmbpyString):
+    return rays.EmbpyString(reduce_escape_html(u_(s)))
+  return s
+
+TEMPLATE = u_("""<table>
+<% for row in rows: %>
+  <tr><td><%= row["id"] %></td><td><%= row["name"] %></td><td><%= row["comment"] %></td></tr>
+<% end %>
+</table>""")
+
+ROWS = [{"id": i, "name": "user%d"%i, "comment": i % 10 and "plain comment text" or "Tom & Jerry <b>'x'</b>"}
+        for i in range(1000)]
+
+def main(number = 100000):
+  cases = [("name", "Alice Smith"), ("number", "12345"), 
+           ("special", "Tom & Jerry <b>'x'</b>"), ("paragraph", "lorem ipsum dolor sit amet "*40)]
+  print("%-12s %14s %14s" % ("value", "reduce(usec)", "rays(usec)"))
+  for label, value in cases:
+    t1 = timeit.timeit(lambda: reduce_escape_html(value), number=number)
+    t2 = timeit.timeit(lambda: rays.escape_html(value), number=number)
+    print("%-12s %14.3f %14.3f" % (label, t1/number*1e6, t2/number*1e6))
+
+  embpy = rays.Embpy(TEMPLATE, filter = rays.escape_html)
+  embpy.render({"rows": ROWS})
+  filter = embpy.template_globals["__filter"]
+  t2 = timeit.timeit(lambda: embpy.render({"rows": ROWS}), number=100)
+  embpy.template_globals["__filter"] = reduce_filter
+  t1 = timeit.timeit(lambda: embpy.render({"rows": ROWS}), number=100)
+  embpy.template_globals["__filter"] = filter
+  print("%-12s %14.1f %14.1f" % ("table(msec)", t1*10, t2*10))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,54 @@
+#vim: fileencoding=utf8
+"""Compares GET requests which send full bodies with conditional GET requests answered by '304 Not Modified'.
+
+Usage::
+
+    python bench_etag.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rays
+
+ROWS = [["<cell %d-%d>"%(i, j) for j in range(10)] for i in range(200)]
+
+def create_app():
+  app = rays.Application()
+  app.config("auto_etag", True)
+  def render():
+    return "".join("<tr>%s</tr>\n"%"".join("<td>%s</td>"%rays.Helper.htmlquote(c) for c in row) for row in ROWS)
+
+  @app.get("page")
+  def page():
+    return render()
+
+  @app.apply_filter(app.etag(lambda: 1))
+  @app.get("validated")
+  def validated():
+    return render()
+  return app
+
+def main(number = 500):
+  app = create_app()
+  def request(path, if_none_match = None):
+    env = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+           "REQUEST_METHOD": "GET", "PATH_INFO": path}
+    if if_none_match:
+      env["HTTP_IF_NONE_MATCH"] = if_none_match
+    result = {}
+    def start_response(status, headers):
+      result["status"], result["headers"] = status, dict(headers)
+    result["body"] = b"".join(app(env, start_response))
+    return result
+  print("%-24s %10s %10s %14s" % ("case", "status", "bytes", "request(usec)"))
+  for name, path in (("auto_etag", "/page"), ("validator", "/validated")):
+    etag = request(path)["headers"]["Etag"]
+    for suffix, if_none_match in (("", None), (" (If-None-Match)", etag)):
+      response = request(path, if_none_match)
+      t = min(timeit.repeat(lambda: request(path, if_none_match), number=number, repeat=5))
+      print("%-24s %10s %10d %14.2f" % (name + suffix, response["status"].split(" ")[0], 
+                                         len(response["body"]), t/number*1e6))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,58 @@
+#vim: fileencoding=utf8
+"""Measures rendering of pages which use layouts and template helpers.
+
+Usage::
+
+    python bench_layout.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit, tempfile, shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rays
+
+TEMPLATES = {
+  "layout.html": rays.u_("""<html>
+<head><title><%= title %></title><%=r head %></head>
+<body><nav><%=r nav %></nav><%=r body %></body>
+</html>
+"""),
+  "page.html": rays.u_("""<% with h.capture("head"): %>
+  <link rel="stylesheet" href="/site.css">
+<% end %>
+<% with h.capture("nav"): %>
+  <% for item in items: %><a href="#<%= item %>"><%= item %></a><% end %>
+<% end %>
+<% for item in items: %>
+  <p><% h.concat(item) %></p>
+<% end %>
+<%= renderer.with_layout_file("layout") %>"""),
+  "plain.html": rays.u_("""<% for item in items: %>
+  <p><%= item %></p>
+<% end %>"""),
+}
+
+def main(number = 2000):
+  base = tempfile.mkdtemp()
+  try:
+    template_dir = os.path.join(base, "templates")
+    os.makedirs(template_dir)
+    for name, text in rays.iter_items(TEMPLATES):
+      with open(os.path.join(template_dir, name), "wb") as io:
+        io.write(text.encode("utf8"))
+    sys.path.insert(0, base)
+    rays.Renderer(template_dir, None, filter = rays.Helper.htmlquote).precompile(os.path.join(base, "bench_layout_pkg"))
+    renderers = [("", rays.Renderer(template_dir, None, filter = rays.Helper.htmlquote)),
+                 (" (precompiled)", rays.Renderer(template_dir, None, filter = rays.Helper.htmlquote, package = "bench_layout_pkg"))]
+    vars = {"title": "bench", "items": ["item%d"%i for i in range(10)]}
+    print("%-24s %14s" % ("case", "render(usec)"))
+    for suffix, renderer in renderers:
+      for name in ("plain", "page"):
+        t = min(timeit.repeat(lambda: renderer.render_file(name, vars), number=number, repeat=5))
+        print("%-24s %14.2f" % (name + suffix, t/number*1e6))
+  finally:
+    sys.path.remove(base)
+    shutil.rmtree(base)
+
+if __name__ == "__main__":
+  main()
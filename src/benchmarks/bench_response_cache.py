@@ -0,0 +1,62 @@
+#vim: fileencoding=utf8
+"""Compares GET requests to an action with and without the response cache.
+
+Usage::
+
+    python bench_response_cache.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit, tempfile, shutil
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rays
+
+TEMPLATE = rays.u_("""<html>
+<body>
+<table>
+<% for row in rows: %>
+  <tr><% for cell in row: %><td><%= cell %></td><% end %></tr>
+<% end %>
+</table>
+</body>
+</html>
+""")
+
+def create_app(base, config):
+  template_dir = os.path.join(base, "templates")
+  if not os.path.exists(template_dir):
+    os.makedirs(template_dir)
+    with open(os.path.join(template_dir, "table.html"), "wb") as io:
+      io.write(TEMPLATE.encode("utf8"))
+  app = rays.Application()
+  app.config("renderer", {"template_dir": template_dir, "cache_dir": None})
+  rows = [["<cell %d-%d>"%(i, j) for j in range(10)] for i in range(50)]
+  filters = []
+  if config is not None:
+    app.config("ResponseCacheExtension", config)
+    filters.append(app.ext.response_cache())
+  with app.filter(*filters):
+    @app.get("table")
+    def table():
+      return app.renderer.render_file("table", {"rows": rows})
+  return app
+
+def main(number = 2000):
+  base = tempfile.mkdtemp()
+  env = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+         "REQUEST_METHOD": "GET", "PATH_INFO": "/table", "QUERY_STRING": ""}
+  try:
+    cases = [("no cache", None), ("memory", {}),
+             ("sqlite", {"store": "Sqlite", "path": os.path.join(base, "responses.db")})]
+    print("%-16s %14s" % ("store", "request(usec)"))
+    for name, config in cases:
+      app = create_app(base, config)
+      request = lambda: b"".join(app(dict(env), lambda status, headers: None))
+      request()
+      t = min(timeit.repeat(request, number=number, repeat=5))
+      print("%-16s %14.2f" % (name, t/number*1e6))
+  finally:
+    shutil.rmtree(base)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,51 @@
+#vim: fileencoding=utf8
+"""Compares the linear route scan with the rays.Router dispatch table.
+
+Usage::
+
+    python bench_routing.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rays
+
+def linear_scan(actions, path, method):
+  find = False
+  for action in actions:
+    m = action.match(path)
+    if m:
+      find = True
+      if action.method != method:
+        continue
+      return action, m, find
+  return None, None, find
+
+def create_app(size):
+  app = rays.Application()
+  for i in range(size):
+    def show(id): pass
+    show.__name__ = "show%d"%i
+    app.get("resource%d/(int:\d+)"%i)(show)
+    def about(): pass
+    about.__name__ = "about%d"%i
+    app.get("about%d"%i)(about)
+  app.init_routes()
+  return app
+
+def main(number = 2000):
+  print("%8s %-18s %14s %14s" % ("routes", "path", "linear(usec)", "router(usec)"))
+  for size in (10, 100, 1000):
+    app = create_app(size//2)
+    paths = [("first", "/resource0/1"),
+             ("last", "/resource%d/1"%(size//2-1)),
+             ("static", "/about%d"%(size//2-1)),
+             ("miss", "/missing/1")]
+    for label, path in paths:
+      linear = timeit.timeit(lambda: linear_scan(app.actions, path, "get"), number=number)
+      router = timeit.timeit(lambda: app.router.lookup(path, "get"), number=number)
+      print("%8d %-18s %14.2f %14.2f" % (size, label, linear/number*1e6, router/number*1e6))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,64 @@
+#vim: fileencoding=utf8
+"""Measures static file requests with and without the StaticFileExtension metadata cache.
+
+The "former stat calls" case repeats the system calls made per request before the cache
+was added; to compare whole requests with the former implementation, run this benchmark
+against an older checkout.
+
+Usage::
+
+    python bench_static.py
+"""
+from __future__ import division, print_function
+import os, sys, time, mimetypes, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hashlib import sha1
+import rays
+from rays.compat import *
+
+def legacy_metadata(abs_path):
+  # stat calls made by the former static_file and send_file implementations
+  os.stat(abs_path)
+  os.path.exists(abs_path) and os.path.isfile(abs_path) and os.access(abs_path, os.R_OK)
+  mimetypes.guess_type(abs_path)
+  stats = os.stat(abs_path)
+  time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(stats.st_mtime))
+  hasher = sha1()
+  stats = os.stat(abs_path)
+  hasher.update(b_(abs_path))
+  hasher.update(b_(stats.st_mtime))
+  hasher.update(b_(stats.st_size))
+  return hasher.hexdigest()
+
+def create_app(**kw):
+  app = rays.Application()
+  kw.update({"url": "static/", "path": os.path.dirname(os.path.abspath(__file__))})
+  app.config("StaticFileExtension", kw)
+  env = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+         "REQUEST_METHOD": "GET", "PATH_INFO": "/static/bench_static.py"}
+  def request():
+    body = app(dict(env), lambda status, headers: None)
+    for _ in body: pass
+    body.close()
+  return app, request
+
+def main(number = 10000):
+  abs_path = os.path.abspath(__file__)
+  uncached, request_uncached = create_app(metadata_cache_size = 0)
+  cached, request_cached = create_app(revalidate = 2)
+  request_uncached(); request_cached()
+  ext = cached.ext.static_file
+
+  print("%-32s %14s" % ("case", "usec/call"))
+  for label, f in [("metadata: former stat calls", lambda: legacy_metadata(abs_path)),
+                   ("metadata: uncached", lambda: rays.FileMetadata.from_path(abs_path)),
+                   ("metadata: cached", lambda: ext.get_metadata(abs_path)),
+                   ("request: metadata_cache_size=0", request_uncached),
+                   ("request: cached", request_cached)]:
+    t = min(timeit.repeat(f, number=number, repeat=5))
+    print("%-32s %14.2f" % (label, t/number*1e6))
+  print(ext.stats())
+
+if __name__ == "__main__":
+  main()
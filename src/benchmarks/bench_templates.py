@@ -0,0 +1,73 @@
+#vim: fileencoding=utf8
+"""Compares templates compiled at the first request with templates precompiled into a python package.
+
+Usage::
+
+    python bench_templates.py
+"""
+from __future__ import division, print_function
+import os, sys, timeit, tempfile, shutil, importlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rays
+
+TEMPLATE = rays.u_("""<html>
+<head><title><%= title %></title></head>
+<body>
+<table>
+<% for i, row in enumerate(rows): %>
+  <tr class="<%= i % 2 and "odd" or "even" %>">
+  <% for cell in row: %>
+    <td><%= cell %></td>
+  <% end %>
+  </tr>
+<% end %>
+</table>
+</body>
+</html>
+""")
+
+def run(size, number):
+  base = tempfile.mkdtemp()
+  try:
+    template_dir = os.path.join(base, "templates")
+    os.makedirs(template_dir)
+    with open(os.path.join(template_dir, "table.html"), "wb") as io:
+      io.write((TEMPLATE*size).encode("utf8"))
+    sys.path.insert(0, base)
+    vars = {"title": "bench", "rows": [["<cell %d-%d>"%(i, j) for j in range(10)] for i in range(20)]}
+
+    def create_renderer(package = None):
+      return rays.Renderer(template_dir, None, filter = rays.Helper.htmlquote, package = package)
+    create_renderer().precompile(os.path.join(base, "bench_templates_pkg"))
+
+    def first_render(package):
+      create_renderer(package).render_file("table", vars)
+      for name in list(sys.modules.keys()):
+        if name.startswith("bench_templates_pkg."):
+          del sys.modules[name]
+
+    n = number//10
+    t1 = timeit.timeit(lambda: first_render(None), number=n)
+    t2 = timeit.timeit(lambda: first_render("bench_templates_pkg"), number=n)
+    print("%6d %-16s %14.3f %14.3f" % (size, "first render", t1/n*1e3, t2/n*1e3))
+
+    compiled, precompiled = create_renderer(), create_renderer("bench_templates_pkg")
+    t1 = timeit.timeit(lambda: compiled.render_file("table", vars), number=number)
+    t2 = timeit.timeit(lambda: precompiled.render_file("table", vars), number=number)
+    print("%6d %-16s %14.3f %14.3f" % (size, "render", t1/number*1e3, t2/number*1e3))
+  finally:
+    sys.path.remove(base)
+    shutil.rmtree(base)
+    for name in list(sys.modules.keys()):
+      if name.startswith("bench_templates_pkg"):
+        del sys.modules[name]
+    importlib.invalidate_caches()
+
+def main(number = 1000):
+  print("%6s %-16s %14s %14s" % ("blocks", "case", "exec(msec)", "package(msec)"))
+  for size in (1, 10, 50):
+    run(size, number)
+
+if __name__ == "__main__":
+  main()
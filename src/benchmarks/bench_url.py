@@ -0,0 +1,71 @@
+#vim: fileencoding=utf8
+"""Measures 10k URL generations with the closure based URL builder and rays.UrlBuilder.
+
+Usage::
+
+    python bench_url.py
+"""
+from __future__ import division, print_function
+import os, sys, re, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import urllib.parse
+import rays
+
+def closure_url_builder(app, action):
+  parts = re.compile("\([^\)]+\)").split(action.full_path_pattern)
+  def encode(v):
+    try:
+      return urllib.parse.quote(v.encode(app.charset))
+    except:
+      return rays.u_(v)
+  def _(*args, **kw):
+    _query = kw.get("_query", None)
+    _ssl   = kw.get("_ssl", None)
+    if len(parts) == 1:
+      path = "".join(parts)
+    else:
+      a = list(map(encode, args))
+      path = "".join(map(lambda p:p[0]+p[1], zip(parts,a+[""])))
+    if _ssl or (_ssl is None and app.req.is_ssl):
+      protocol = "https"
+    else:
+      protocol = "http"
+    url = "%s://%s%s"%(protocol, app.host, path)
+    if _query:
+      return url + "?" + _query
+    else:
+      return url
+  return _
+
+def create_app():
+  app = rays.Application()
+  @app.get("articles/(int:\d+)/(str:[^/]+)")
+  def show_article(id, slug): pass
+  @app.get("about")
+  def about(): pass
+  app.define_tls_property("req", "rays.Request object")
+  app.host = "localhost"
+  app.req = rays.Request({"wsgi.url_scheme": "http", "PATH_INFO": "/"})
+  app.init_routes()
+  return app
+
+def main(number = 10000):
+  app = create_app()
+  cases = [
+    ("static", "about", (), {}),
+    ("int+ascii", "show_article", (10, "hello-world"), {}),
+    ("int+multibyte", "show_article", (10, rays.u_("\u30d1\u30b9")), {}),
+    ("relative", "show_article", (10, "hello-world"), {"_relative": True}),
+  ]
+  print("%-16s %14s %14s" % ("case", "closure(msec)", "builder(msec)"))
+  for label, name, args, kw in cases:
+    old = closure_url_builder(app, app.actions_map[name])
+    new = app.get_url_builder(name)
+    old_kw = dict((k, v) for k, v in kw.items() if k != "_relative")
+    t1 = timeit.timeit(lambda: old(*args, **old_kw), number=number)
+    t2 = timeit.timeit(lambda: new(*args, **kw), number=number)
+    print("%-16s %14.2f %14.2f" % (label, t1*1e3, t2*1e3))
+
+if __name__ == "__main__":
+  main()
@@ -30,13 +30,14 @@ THE SOFTWARE.
 from __future__ import division, print_function
 from .compat import *
 
-import re, cgi, traceback, threading, os, os.path, mimetypes, types
+import re, traceback, threading, os, os.path, mimetypes, types, tempfile, shutil
 import time, collections, contextlib, codecs, marshal, functools, inspect
-import logging, json
+import logging, json, uuid, heapq, itertools, errno, stat, zlib, importlib, py_compile
 from datetime import datetime, timedelta
 from hashlib import sha1
 
 import urllib.parse
+_unquote_to_bytes = getattr(urllib.parse, "unquote_to_bytes", urllib.parse.unquote)
 compat_import(py3="http.cookies", py2="Cookie")
 compat_import(py3="pickle", py2="cPickle")
 import_BytesIO()
@@ -123,19 +124,26 @@ def unquote_guess_decode(q):
   """ """
   return guess_decode(urllib.parse.unquote(q))
 
-_htmlentity_trans_table = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ("'", "&#39;"), ('"', "&quot;"))
-_htmlentity_trans_table_rev = list(map(lambda v: (v[1], v[0]), _htmlentity_trans_table))
-
-def _trans(s, table):
-  return reduce(lambda r,v: r.replace(v[0], v[1]), table, s)
+def decode_url_param(q):
+  """Decodes a URL parameter, skipping ``guess_decode`` if the parameter consists of ASCII characters."""
+  if not q:
+    return u_("")
+  try:
+    q.encode("ascii")
+    return u_(q)
+  except UnicodeError:
+    return guess_decode(l_(q))
 
 def escape_html(s):
-  """ """
-  return _trans(s, _htmlentity_trans_table)
+  """Escapes '&', '<', '>', "'" and '"'. 
+  Chained ``str.replace`` calls are faster than regular expressions and 
+  ``str.translate`` for typical template outputs.
+  """
+  return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("'", "&#39;").replace('"', "&quot;")
 
 def unescape_html(s): 
   """ """
-  return _trans(s, _htmlentity_trans_table_rev)
+  return s.replace("&lt;", "<").replace("&gt;", ">").replace("&#39;", "'").replace("&quot;", '"').replace("&amp;", "&")
 
 def to_http_date_string(date): 
   """ """
@@ -148,6 +156,37 @@ def parse_http_date_string(string):
   """ """
   return datetime(*time.strptime(string.replace("GMT", "+0000"), "%a, %d %b %Y %H:%M:%S +0000")[:6])
 
+def parse_range_header(text, size, max_ranges = 16):
+  """Parses a 'Range' header value for a resource of ``size`` bytes.
+
+  Returns a list of (first, last) byte positions, an empty list if no range
+  is satisfiable, or None if the value is invalid and should be ignored.
+  """
+  unit, _, spec = text.partition("=")
+  if unit.strip().lower() != "bytes" or not spec.strip():
+    return None
+  ranges = []
+  for item in spec.split(","):
+    first, sep, last = item.strip().partition("-")
+    if not sep:
+      return None
+    try:
+      first = int(first) if first else None
+      last = int(last) if last else None
+    except ValueError:
+      return None
+    if first is None:
+      if last is None: return None
+      if last > 0:
+        ranges.append((max(size - last, 0), size - 1))
+    elif last is not None and last < first:
+      return None
+    elif first < size:
+      ranges.append((first, size - 1 if last is None else min(last, size - 1)))
+  if len(ranges) > max_ranges:
+    return None
+  return ranges
+
 def to_snake_case(s, pat=[]):
   """ """
   if not pat:
@@ -230,54 +269,31 @@ class Hook(PropertyCachable): # {{{
 
   def __call__(self, *a, **kw):
     return self.func(*a, **kw)
-
-  def __lt__(self, other):
-    return self.__cmp__(other) < 0
-
-  def __cmp__(self, other):
-    if self.name == other.pos_name:
-      if other.is_pos_type_before:
-        return 1
-      if other.is_pos_type_after:
-        return -1
-    elif other.name == self.pos_name:
-      if self.is_pos_type_before:
-        return -1
-      if self.is_pos_type_after:
-        return 1
-    elif self.pos_name and self.pos_name == other.pos_name:
-      if self.is_pos_type_before and other.is_pos_type_after:
-          return -1
-      if other.is_pos_type_before and self.is_pos_type_after:
-          return 1
-    elif self.is_pos_type_last and not other.is_pos_type_last:
-      return 1
-    elif self.is_pos_type_first and not other.is_pos_type_first:
-      return -1
-    elif not self.is_pos_type_last and other.is_pos_type_last:
-      return -1
-    elif not self.is_pos_type_first and other.is_pos_type_first:
-      return 1
-    elif not self.pos and other.pos:
-      ref = self.hookable.get_hook_by_type_and_name(self.type, other.pos_name)
-      if ref:
-        return cmp(self, ref)
-    elif self.pos and not other.pos:
-      ref = self.hookable.get_hook_by_type_and_name(self.type, self.pos_name)
-      if ref:
-        return cmp(ref, other)
-
-    return cmp(self.id, other.id)
 # }}}
 
+def _no_hooks(*a, **kw):
+  return None
+
 class Hookable(object): # {{{
   """Hookable object support.
 
+  Hooks associated with a hook type are sorted by their positions and compiled into a single function
+  when they are accessed at the first time after changes.
   """
   
   def __init__(self):
-    self.hooks    = collections.defaultdict(list)
+    self._hooks   = collections.defaultdict(list)
     self.hook_map = collections.defaultdict(lambda : {})
+    self.hook_runners = {}
+    self.unsorted_hook_types = set([])
+    self.hook_ids = itertools.count()
+
+  def get_hooks(self):
+    for hook_type in list(self.unsorted_hook_types):
+      self.sort_hooks(hook_type)
+    return self._hooks
+
+  hooks = property(get_hooks, None, None, """Dictionary of lists of Hook objects, keyed by hook types.""")
 
   def get_hook_by_type_and_name(self, hook_type, name):
     """Returns a named Hook object associated with ``hook_type``."""
@@ -295,10 +311,72 @@ class Hookable(object): # {{{
                 - ``"before_"`` followed by other extension name.(i.e. before_DatabaseExtension)
                 - ``"after_"`` followed by other extension name.(i.e. after_DatabaseExtension)
     """
-    hook = Hook(self, hook, hook_type, name or hook.__name__, pos, len(self.hooks[hook_type]))
+    hook = Hook(self, hook, hook_type, name or hook.__name__, pos, next(self.hook_ids))
     self.hook_map[hook_type][hook.name] = hook
-    self.hooks[hook_type].append(hook)
-    self.hooks[hook_type].sort()
+    self._hooks[hook_type].append(hook)
+    self.unsorted_hook_types.add(hook_type)
+    self.hook_runners.pop(hook_type, None)
+
+  def sort_hooks(self, hook_type):
+    """Sorts hooks associated with ``hook_type`` in topological order of their positions.
+
+    Hooks positioned ``"first"`` come before other hooks and hooks positioned ``"last"`` come after other hooks.
+    A hook positioned relative to another hook belongs to the same group as that hook.
+    Hooks are sorted in the order they were added unless their positions say otherwise.
+
+    Raises a ValueError if hooks have circular dependencies.
+    """
+    hooks = self._hooks[hook_type]
+    self.unsorted_hook_types.discard(hook_type)
+    by_name = dict((hook.name, hook) for hook in hooks)
+    targets = dict((hook, by_name.get(hook.pos_name, None)) for hook in hooks if hook.pos_name)
+
+    def group(hook):
+      seen = set([])
+      while hook in targets and targets[hook] is not None:
+        if hook in seen:
+          return 1
+        seen.add(hook)
+        hook = targets[hook]
+      if hook.is_pos_type_first:
+        return 0
+      if hook.is_pos_type_last:
+        return 2
+      return 1
+
+    successors = collections.defaultdict(list)
+    in_degrees = dict((hook, 0) for hook in hooks)
+    for hook, target in iter_items(targets):
+      if target is None or target is hook:
+        continue
+      before, after = (hook, target) if hook.is_pos_type_before else (target, hook)
+      successors[before].append(after)
+      in_degrees[after] += 1
+
+    keys = {}
+    for i, hook in enumerate(hooks):
+      keys[hook] = (group(hook), hook.id, i, hook)
+    queue = [keys[hook] for hook in hooks if not in_degrees[hook]]
+    heapq.heapify(queue)
+    result = []
+    while queue:
+      hook = heapq.heappop(queue)[-1]
+      result.append(hook)
+      for successor in successors[hook]:
+        in_degrees[successor] -= 1
+        if not in_degrees[successor]:
+          heapq.heappush(queue, keys[successor])
+
+    if len(result) != len(hooks):
+      self.unsorted_hook_types.add(hook_type)
+      raise ValueError("Hooks for '%s' have circular dependencies: %s" % (hook_type,
+        ", ".join("%s(%s)" % (hook.name, hook.pos) for hook in hooks if in_degrees[hook])))
+    self._hooks[hook_type] = result
+    return result
+
+  def get_hook_order(self, hook_type):
+    """Returns a list of hook names associated with ``hook_type`` in the order they will be run."""
+    return [hook.name for hook in self.hooks.get(hook_type, ())]
 
   def hook(self, hook_type="", pos="", name=""):
     """Adds a hook to the object. 
@@ -312,20 +390,38 @@ class Hookable(object): # {{{
 
   def remove_hook(self, hook_type, hook):
     """Remove a hook."""
-    self.hooks[hook_type] = [h for h in self.hooks[hook_type] if h.func != hook]
+    self._hooks[hook_type] = [h for h in self._hooks[hook_type] if h.func != hook]
+    self.hook_runners.pop(hook_type, None)
 
-  def _run_hook(self, hook_type, args, kw, f=lambda x:x):
-    if hook_type not in self.hooks: 
-      return
-    return [hook(*args, **kw) for hook in f(self.hooks[hook_type])]
+  def compile_hooks(self, hook_type):
+    """Returns a function that calls hooks associated with ``hook_type`` and returns a list of the results.
+
+    Returns a function that does nothing if there are no hooks.
+    """
+    funcs = tuple(hook.func for hook in self.hooks.get(hook_type, ()))
+    if not funcs:
+      return _no_hooks
+    if len(funcs) == 1:
+      func = funcs[0]
+      return lambda *a, **kw: [func(*a, **kw)]
+    return lambda *a, **kw: [func(*a, **kw) for func in funcs]
+
+  def get_hook_runner(self, hook_type):
+    """Returns a compiled function that runs hooks associated with ``hook_type``."""
+    runner = self.hook_runners.get(hook_type, None)
+    if runner is None:
+      runner = self.hook_runners[hook_type] = self.compile_hooks(hook_type)
+    return runner
 
   def run_hook(self, hook_type, args = [], kw = {}):
     """Runs hooks associated with ``hook_type``."""
-    return self._run_hook(hook_type, args, kw)
+    return self.get_hook_runner(hook_type)(*args, **kw)
  
   def reverse_run_hook(self, hook_type, args = [], kw = {}):
     """Runs hooks associated with ``hook_type`` in the reverse order."""
-    return self._run_hook(hook_type, args, kw, reversed)
+    if hook_type not in self.hooks: 
+      return
+    return [hook(*args, **kw) for hook in reversed(self.hooks[hook_type])]
 
 def __create_hookable_class():
   class HookableClass(Hookable, ClassInitable):
@@ -378,6 +474,149 @@ class DefaultAttrDict(collections.defaultdict): # {{{
     return DefaultAttrDict(d, self.default_factory)
 # }}}
   
+class LRUCache(object): # {{{
+  """A thread safe dictionary like cache which discards the least recently used items.
+  Items set with ``ttl`` are also discarded when they expire.
+
+  :Attributes:
+      maxsize
+          Maximum number of items. ``0`` disables caching.
+      hits
+          Number of lookups which found a cached item.
+      misses
+          Number of lookups which did not find a cached item.
+  """
+  def __init__(self, maxsize = 128):
+    self.maxsize = maxsize
+    self.data = collections.OrderedDict()
+    self.expires = {}
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.data)
+
+  def __contains__(self, key):
+    return key in self.data
+
+  def get(self, key, default = None):
+    """Returns the value for ``key`` and marks it as the most recently used item."""
+    with self.lock:
+      try:
+        value = self.data.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      expires = self.expires.get(key, None) if self.expires else None
+      if expires is not None and expires <= time.time():
+        del self.expires[key]
+        self.misses += 1
+        return default
+      self.data[key] = value
+      self.hits += 1
+      return value
+
+  def set(self, key, value, ttl = None):
+    """Sets the value for ``key``, discarding the least recently used items if the cache is full.
+    If ``ttl`` is not None, the item expires after ``ttl`` seconds.
+    """
+    with self.lock:
+      self.data.pop(key, None)
+      self.expires.pop(key, None)
+      if self.maxsize <= 0:
+        return
+      self.data[key] = value
+      if ttl is not None:
+        self.expires[key] = time.time() + ttl
+      self.evict(self.maxsize)
+
+  def evict(self, maxsize):
+    while len(self.data) > max(maxsize, 0):
+      self.expires.pop(self.data.popitem(False)[0], None)
+
+  def delete(self, key):
+    with self.lock:
+      self.data.pop(key, None)
+      self.expires.pop(key, None)
+
+  def delete_prefix(self, prefix):
+    """Removes items whose string keys start with ``prefix``. Returns the number of removed items."""
+    with self.lock:
+      keys = [key for key in self.data if key.startswith(prefix)]
+      for key in keys:
+        del self.data[key]
+        self.expires.pop(key, None)
+      return len(keys)
+
+  def clear(self):
+    """Removes all items and resets the counters."""
+    with self.lock:
+      self.data.clear()
+      self.expires.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def resize(self, maxsize):
+    """Changes the maximum number of items."""
+    with self.lock:
+      self.maxsize = maxsize
+      self.evict(maxsize)
+
+  def stats(self):
+    """Returns a dictionary object with the cache statistics."""
+    return {"hits": self.hits, "misses": self.misses, "size": len(self.data), "maxsize": self.maxsize}
+# }}}
+
+class HeaderDict(object): # {{{
+  """A case insensitive multi-value dictionary for HTTP headers.
+
+  Header names keep the order they were first added in, and values of the
+  same name are kept together in the order they were added.
+  """
+  def __init__(self, pairs = None):
+    self.data = collections.OrderedDict()
+    for name, value in pairs or []:
+      self.add(name, value)
+
+  def __len__(self):
+    return len(self.data)
+
+  def __contains__(self, name):
+    return name.lower() in self.data
+
+  def __iter__(self):
+    return (name for name, values in iter_values(self.data))
+
+  def __repr__(self):
+    return "<HeaderDict %r>"%self.items()
+
+  def get_all(self, name):
+    """Returns a list of values for ``name``."""
+    entry = self.data.get(name.lower(), None)
+    return entry and list(entry[1]) or []
+
+  def set(self, name, value):
+    """Replaces all values for ``name`` with ``value``."""
+    self.data[name.lower()] = (name, [value])
+
+  def add(self, name, value):
+    """Adds ``value`` to ``name`` values."""
+    entry = self.data.get(name.lower(), None)
+    if entry is None:
+      self.data[name.lower()] = (name, [value])
+    else:
+      entry[1].append(value)
+
+  def delete(self, name):
+    """Deletes all values for ``name``."""
+    self.data.pop(name.lower(), None)
+
+  def items(self):
+    """Returns a list of (name, value) tuples."""
+    return [(name, value) for name, values in iter_values(self.data) for value in values]
+# }}}
+
 class ReturnResponse(Exception): # {{{
   def __init__(self, f):
     self.thunk = f
@@ -395,7 +634,7 @@ class Action(PropertyCachable): # {{{
 
   :Attributes:
       param_types     
-          URL parameter types
+          URL parameter converters
       name
           Action name
       path_pattern
@@ -412,8 +651,22 @@ class Action(PropertyCachable): # {{{
 
   @cached_property
   def param_types(self):
-    return list(map(lambda s: eval(s[:-1]), 
-      self.PARAM_REGEX.findall(self.full_path_pattern) or []))
+    converters = self.app.converters
+    result = []
+    for name in (s[:-1] for s in self.PARAM_REGEX.findall(self.full_path_pattern)):
+      if name not in converters:
+        raise ValueError("URL parameter converter '%s' in '%s' is not registered. Register it with app.converter('%s')."%(
+                         name, self.full_path_pattern, name))
+      result.append(converters[name])
+    return result
+
+  @cached_property
+  def param_builder(self):
+    """Function that converts a MatchObject into a list of URL parameters."""
+    param_types = self.param_types
+    if not param_types:
+      return lambda m: []
+    return lambda m: [f(decode_url_param(v)) for v, f in zip(m.groups(), param_types)]
 
   @cached_property
   def full_path_pattern_compiled(self):
@@ -433,6 +686,11 @@ class Action(PropertyCachable): # {{{
     """
     return self.full_path_pattern_compiled.match(str)
 
+  def compile(self):
+    """Compiles the path pattern and resolves URL parameter converters."""
+    self.full_path_pattern_compiled
+    self.param_builder
+
   def append_filter(self, filter):
     """Adds a ``filter`` to the action as a filter."""
     self.filters.append(filter)
@@ -445,19 +703,205 @@ class Action(PropertyCachable): # {{{
 
   def perform_with_filters(self, *a, **kw):
     """Performs this action with filters.
+    Filters which are interrupted by exceptions are closed, so that their ``finally`` clauses are executed.
     """
     generators = [filter(*a, **kw) for filter in self.filters]
-    for generator in generators:
-      next(generator)
-    self.app.res.content = self.func(*a, **kw)
-    for generator in reversed(generators):
-      try:
+    try:
+      for generator in generators:
         next(generator)
-      except StopIteration:
-        pass
+      self.app.res.content = self.func(*a, **kw)
+      for generator in reversed(generators):
+        try:
+          next(generator)
+        except StopIteration:
+          pass
+    finally:
+      for generator in reversed(generators):
+        generator.close()
     return self.app.res.content
 # }}}
 
+class Router(object): # {{{
+  """Dispatch table that maps request paths to rays.Action objects.
+
+  Actions are stored in a trie keyed by the static path segments of their URL patterns,
+  so a request path is matched only against actions which share its leading segments.
+  Actions are tried in the order they were added.
+
+  Actions whose URL patterns have no regular expressions (such as ``"about"``) are
+  also stored in a dictionary keyed by (method, path), which is consulted before the trie.
+  """
+  META_CHARACTERS = "\\.^$|()[]{}*+?"
+  QUANTIFIERS = "{*+?"
+
+  def __init__(self, actions = None):
+    self.root = self.new_node()
+    self.static = {}
+    self.size = 0
+    for action in (actions or []):
+      self.add(action)
+
+  def new_node(self):
+    # (child nodes, {method : [(index, action)]})
+    return ({}, collections.defaultdict(list))
+
+  @classmethod
+  def static_segments(cls, pattern):
+    """Returns a list of path segments that every path matched by the ``pattern`` starts with."""
+    depth, escaped, in_class = 0, False, False
+    for c in pattern:
+      if escaped:
+        escaped = False
+      elif c == "\\":
+        escaped = True
+      elif in_class:
+        in_class = c != "]"
+      elif c == "[":
+        in_class = True
+      elif c == "(":
+        depth += 1
+      elif c == ")":
+        depth -= 1
+      elif c == "|" and depth == 0:
+        return []
+
+    prefix = []
+    for c in pattern:
+      if c in cls.META_CHARACTERS:
+        if c in cls.QUANTIFIERS and prefix:
+          prefix.pop()
+        return "".join(prefix).split("/")[:-1]
+      prefix.append(c)
+    return pattern.split("/")
+
+  @classmethod
+  def static_path(cls, pattern):
+    """Returns a path string if the ``pattern`` matches only one path, otherwise None."""
+    path = []
+    escaped = False
+    for c in pattern:
+      if escaped:
+        if c.isalnum():
+          return None
+        path.append(c)
+        escaped = False
+      elif c == "\\":
+        escaped = True
+      elif c in cls.META_CHARACTERS:
+        return None
+      else:
+        path.append(c)
+    return None if escaped else "".join(path)
+
+  def add(self, action):
+    """Adds an ``action`` to this table."""
+    action.compile()
+    node = self.root
+    for segment in self.static_segments(action.full_path_pattern):
+      node = node[0].setdefault(segment, self.new_node())
+    node[1][action.method].append((self.size, action))
+    self.size += 1
+
+    path = self.static_path(action.full_path_pattern)
+    if path is not None and (action.method, path) not in self.static:
+      found, m, _ = self.lookup(path, action.method)
+      # actions added earlier take precedence over this action.
+      if found is action:
+        self.static[(action.method, path)] = (found, m, True)
+
+  def _nodes(self, path):
+    node = self.root
+    yield node
+    for segment in path.split("/"):
+      node = node[0].get(segment, None)
+      if node is None:
+        return
+      yield node
+
+  def lookup(self, path, method):
+    """Finds an action for the given ``path`` and ``method``.
+
+    Returns a tuple (action, MatchObject, path_found). ``action`` is None if no action
+    accepts the request, ``path_found`` is True if any action matches the ``path`` regardless of the ``method``.
+    """
+    result = self.static.get((method, path), None)
+    if result:
+      return result
+
+    nodes = list(self._nodes(path))
+    candidates = []
+    for node in nodes:
+      candidates.extend(node[1].get(method, ()))
+    candidates.sort()
+    for index, action in candidates:
+      m = action.match(path)
+      if m:
+        return action, m, True
+
+    for node in nodes:
+      for other_method, actions in iter_items(node[1]):
+        if other_method == method:
+          continue
+        for index, action in actions:
+          if action.match(path):
+            return None, None, True
+    return None, None, False
+# }}}
+
+class UrlBuilder(object): # {{{
+  """Builds URLs for a rays.Action.
+
+  ``app.url.name(*args, **kw)`` calls the UrlBuilder object for the action named ``name``.
+
+  :Keyword arguments:
+      _query
+          Query string
+      _ssl
+          If True, builds an URL with the https scheme. Defaults to whether the current request is under SSL.
+      _relative
+          If True, builds an URL without the scheme and the host. Defaults to ``Application.relative_url``.
+  """
+  PARAM_PATTERN = re.compile("\([^\)]+\)")
+  SAFE_PATTERN = re.compile("[A-Za-z0-9_\.\-~/]*\Z")
+
+  def __init__(self, app, action):
+    self.app = app
+    self.charset = app.charset
+    self.parts = self.PARAM_PATTERN.split(action.full_path_pattern)
+    self.size = len(self.parts) - 1
+    self.template = u_("%s").join(p.replace("%", "%%") for p in self.parts)
+
+  def encode(self, v):
+    """Returns a URL encoded string of the ``v``."""
+    if isinstance(v, integer_types):
+      return u_(v)
+    if isinstance(v, str) and self.SAFE_PATTERN.match(v):
+      return v
+    try:
+      return urllib.parse.quote(v.encode(self.charset))
+    except:
+      return u_(v)
+
+  def __call__(self, *args, **kw):
+    if self.size:
+      encode = self.encode
+      url = self.template % tuple([encode(v) for v in args])
+    else:
+      url = self.parts[0]
+
+    if not kw.get("_relative", self.app.relative_url):
+      _ssl = kw.get("_ssl", None)
+      if _ssl or (_ssl is None and self.app.req.is_ssl):
+        url = "https://" + self.app.host + url
+      else:
+        url = "http://" + self.app.host + url
+
+    _query = kw.get("_query", None)
+    if _query:
+      return url + "?" + _query
+    return url
+# }}}
+
 class Application(Hookable): # {{{
   """Application to dispatch requests based on HTTP methods and path.
 
@@ -481,12 +925,34 @@ class Application(Hookable): # {{{
           (Thread local) rays.Request object.
       res
           (Thread local) rays.Response object.
+      converters
+          Dictionary of URL parameter converters, such as ``{"int": int}``
+      relative_url
+          If this member is True, ``app.url`` builds URLs without the scheme and the host by default.
+      file_chunk_size
+          Size of blocks to read files sent by ``Response.send_file``, default ``64KB``
+      auto_etag
+          If this member is True, successful GET responses without 'ETag' headers get weak ETags 
+          computed over their bodies, and responses whose ETags match the 'If-None-Match' header
+          are replaced with '304 Not Modified'. default False
   """
+  CONVERTERS = {
+    "int"     : int,
+    "float"   : float,
+    "str"     : str,
+    "unicode" : str,
+    "path"    : str,
+    "uuid"    : uuid.UUID
+  }
+
   def __init__(self, base='/', charset="UTF-8", debug=False):
     self.initialize()
     self.base = base
     self.charset = charset
     self.debug = debug
+    self.relative_url = False
+    self.file_chunk_size = Response.file_chunk_size
+    self.auto_etag = False
     self.logger = logging.getLogger("rays")
     self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
     ch = logging.StreamHandler()
@@ -501,8 +967,12 @@ class Application(Hookable): # {{{
   def initialize(self):
     self.current_filters = []
     self.error_handlers = {}
+    self.converters = dict(self.CONVERTERS)
+    self.form_parser = FormParser()
+    self.header_cache = LRUCache(256)
     self.actions = []
     self.actions_map = {}
+    self.router = Router()
     self.url_cache = {}
     self.initialized = False
     self._renderer = None
@@ -562,12 +1032,26 @@ class Application(Hookable): # {{{
         - base(str)
         - charset(str)
         - debug(Boolean)
+        - relative_url(Boolean)
+        - file_chunk_size(int) : size of blocks to read files sent by ``Response.send_file``, default ``64KB``
+        - auto_etag(Boolean) : computes ETags of response bodies and answers '304 Not Modified', default False
         - logger : logging.Logger object( in the Python standard libraries )
         - renderer : dict
             - template_dir : str, default ``"./templates"``
             - cache_dir    : str, default ``"./caches"``
             - template_globals : dict
             - encoding : str, default ``utf8``
+            - package : str, name of the package generated by ``Renderer.precompile``, default None
+            - reload_interval : float, seconds between checks for modified templates, default None(never checks)
+            - fragment_cache_size : int, maximum number of markup fragments cached by ``Renderer.render_cached``, default ``256``
+        - form_parser : dict, See rays.FormParser documentations for further details.
+            - memory_limit : int, default ``512KB``
+            - max_content_length : int, default None
+            - max_field_size : int, default ``1MB``
+            - temp_dir : str
+            - sink : function
+            - method_override_limit : int, default ``64KB``
+        - header_cache_size : int, maximum number of parsed 'Accept-\*', 'Cookie' and 'If-None-Match' headers to be cached, default ``256``. ``0`` disables the cache.
         - ExtensionLoader: dict
             - module : extension module object, See Extension documentations for further details.
     """
@@ -575,7 +1059,7 @@ class Application(Hookable): # {{{
       f = sys._getframe(1)
       return [self.config(k,v,f) for k,v in name]
 
-    if name in ("base","charset", "debug", "logger"):
+    if name in ("base","charset", "debug", "logger", "relative_url", "file_chunk_size", "auto_etag"):
       setattr(self, name, value)
 
     elif name == "ExtensionLoader":
@@ -591,7 +1075,17 @@ class Application(Hookable): # {{{
 
     elif name == "renderer":
       for k,v in iter_items(value):
-        setattr(self.renderer, k, v)
+        if k == "fragment_cache_size":
+          self.renderer.fragment_cache.resize(v)
+        else:
+          setattr(self.renderer, k, v)
+
+    elif name == "form_parser":
+      for k,v in iter_items(value):
+        setattr(self.form_parser, k, v)
+
+    elif name == "header_cache_size":
+      self.header_cache.resize(value)
 
     else:
       setattr(self.vars, name, value)
@@ -610,6 +1104,7 @@ class Application(Hookable): # {{{
     self.url_cache = {}
     for action in self.actions:
       self.actions_map[action.name] = action
+    self.router = Router(self.actions)
 
   def get(self, pattern):
     """ Binds a function to a GET request path. """
@@ -641,6 +1136,8 @@ class Application(Hookable): # {{{
           filter = filter[0]
         f = self.apply_filter(filter)(f)
       self.actions.append(f)
+      if self.initialized:
+        self.router.add(f)
       return f
     return _
 
@@ -667,6 +1164,38 @@ class Application(Hookable): # {{{
     yield
     del self.current_filters[index:index+size]
 
+  def validate_etag(self, etag, weak = True):
+    """Sets the 'ETag' header of the current response and sends '304 Not Modified' immediately
+    if the 'If-None-Match' header matches the ``etag``. Call this before rendering contents.
+
+    The ``etag`` is quoted(and prefixed with 'W/' if ``weak`` is true) unless it is already quoted.
+    """
+    etag = u_(etag)
+    if not etag.endswith('"'):
+      etag = '%s"%s"'%(weak and "W/" or "", etag)
+    self.res.set_header("Etag", etag)
+    if self.req.method in ("get", "head") and self.req.etag_matches(etag):
+      self.res.not_modified()
+
+  def etag(self, validator, weak = True):
+    """Returns a filter which validates an ETag by ``validate_etag`` before the action is performed,
+    so that the action is skipped if the client already has the content.
+
+    The ``validator`` is called with the arguments of the action and returns an ETag, 
+    such as a version number of the content, or None to perform the action as usual.
+
+        >>> @app.apply_filter(app.etag(lambda id: Dashboard.version(id)))
+        ... @app.get("dashboards/(int:[0-9]+)")
+        ... def dashboard(id):
+        ...   return app.renderer.render_file("dashboard", {"dashboard": Dashboard.get(id)})
+    """
+    def etag_filter(*a, **kw):
+      etag = validator(*a, **kw)
+      if etag is not None:
+        self.validate_etag(etag, weak)
+      yield
+    return etag_filter
+
   def error(self, code):
     """Adds the decorated function to this application as a error handler."""
     def _(f):
@@ -674,36 +1203,27 @@ class Application(Hookable): # {{{
       return f
     return _
 
+  def converter(self, name):
+    """Adds the decorated function to this application as a URL parameter converter.
+
+    >>> @app.converter("date")
+    ... def date(s):
+    ...   return datetime.strptime(s, "%Y-%m-%d")
+    ... @app.get("entries/(date:\d{4}-\d{2}-\d{2})")
+    ... def entries(date):
+    ...   # ...
+    """
+    def _(f):
+      self.converters[name] = f
+      return f
+    return _
+
   def get_url_builder(self, name):
     """Returns a url builder for the given named route."""
-    if name not in self.url_cache:
-      parts = re.compile("\([^\)]+\)").split(self.actions_map[name].full_path_pattern)
-      def encode(v):
-        try:
-          return urllib.parse.quote(v.encode(self.charset))
-        except:
-          return u_(v)
-      def mkclosure(parts):
-        def _(*args, **kw):
-          _query = kw.get("_query", None)
-          _ssl   = kw.get("_ssl", None)
-          if len(parts) == 1:
-            path = "".join(parts)
-          else:
-            a = list(map(encode, args))
-            path = "".join(map(lambda p:p[0]+p[1], zip(parts,a+[""])))
-          if _ssl or (_ssl is None and self.req.is_ssl):
-            protocol = "https"
-          else:
-            protocol = "http"
-          url = "%s://%s%s"%(protocol, self.host, path)
-          if _query:
-            return url + "?" + _query
-          else:
-            return url
-        return _
-      self.url_cache[name] = mkclosure(parts)
-    return self.url_cache[name] 
+    builder = self.url_cache.get(name, None)
+    if builder is None:
+      builder = self.url_cache[name] = UrlBuilder(self, self.actions_map[name])
+    return builder
 
   def _url(self, name, *args, **kw):
     return self.get_url_builder(name)(*args, **kw)
@@ -716,7 +1236,7 @@ class Application(Hookable): # {{{
     result.append("if(typeof(rays) == 'undefined'){ window.rays={};}");
     patterns = {}
     for name in names:
-      patterns[name] = re.compile("\([^\)]+\)").split(self.actions_map[name].full_path_pattern)
+      patterns[name] = UrlBuilder.PARAM_PATTERN.split(self.actions_map[name].full_path_pattern)
     code.append("var patterns=%s, host=\"%s\";"%(json.dumps(patterns), self.host))
     code.append("""window.rays.url=function(name, args, _options){
       var options = _options || {}; var parts   = patterns[name]; var path    = "";
@@ -740,30 +1260,25 @@ class Application(Hookable): # {{{
           self.initialized = True
           self.run_hook("after_initialize")
 
-    self.run_hook("before_call", [env, start_response])
+    self.get_hook_runner("before_call")(env, start_response)
     response = Response(start_response)
     response.charset = self.charset
+    response.file_chunk_size = self.file_chunk_size
     response.content = ""
     
     try:
-      request = Request(env)
+      request = Request(env, self.form_parser, self.header_cache)
       self.req = request
       self.res = response
       path, method = request.path, request.method
 
-      self.run_hook("before_dispatch")
-      find = False
-      for action in self.actions:
-        m = action.match(path)
-        if m:
-          find = True
-          if action.method != method:
-            continue
-          params = list(map(lambda s: s[1](guess_decode(l_(s[0]))), zip(m.groups(), action.param_types)))
-          request.action = action
-          request.params = params
-          self.run_hook("before_action")
-          return_response(request.action.perform_with_filters(*request.params))
+      self.get_hook_runner("before_dispatch")()
+      action, m, find = self.router.lookup(path, method)
+      if action:
+        request.action = action
+        request.params = action.param_builder(m)
+        self.get_hook_runner("before_action")()
+        return_response(request.action.perform_with_filters(*request.params))
       if find:
         response.method_not_allowed()
       else:
@@ -778,6 +1293,8 @@ class Application(Hookable): # {{{
 
   def _handle_exception(self, response, e):
     if isinstance(e, Abort):
+      if isinstance(e, RequestBodyError):
+        response.status_code = e.status_code
       response.exception = e
       try:
         response.content = eval_thunk(e.thunk or 
@@ -804,11 +1321,15 @@ class Application(Hookable): # {{{
 
   def convert_content(self, content):
     charset = self.res.charset
+    if isinstance(content, FileContent):
+      return content.wrap(self.req._env)
+    if isinstance(content, types.GeneratorType):
+      return (v.encode(charset) if isinstance(v, str) else v for v in content)
     if hasattr(content, 'read'):
       if 'wsgi.file_wrapper' in self.req._env:
         return self.req._env['wsgi.file_wrapper'](content)
       else:
-        return iter(lambda: content.read(8192), b'')
+        return iter(lambda: content.read(self.res.file_chunk_size), b'')
     if isinstance(content, str):
       bytes = content.encode(charset)
       return [bytes]
@@ -817,15 +1338,40 @@ class Application(Hookable): # {{{
 
   def convert_response(self, response):
     if self.req.method == "head":
+      getattr(response.content, "close", lambda: None)()
       return []
     content = self.convert_content(response.content or b"")
-    if response.get_header("Content-Length") is None:
+    if response.get_header("Content-Length") is None and isinstance(content, list):
       response.set_header("Content-Length", sum(len(v) for v in content))
     return content
 
+  def apply_etag(self, response):
+    """Adds a weak 'ETag' header computed over the body of the ``response`` unless it already has one,
+    and replaces the ``response`` with '304 Not Modified' if the 'If-None-Match' header matches it.
+    """
+    if response.status_code != 200 or self.req.method not in ("get", "head"):
+      return
+    etag = response.get_header("Etag")
+    if etag is None:
+      content = response.content
+      if isinstance(content, str):
+        content = response.content = content.encode(response.charset)
+      if not isinstance(content, bytes):
+        return
+      etag = 'W/"%s"'%sha1(content).hexdigest()[:20]
+      response.set_header("Etag", etag)
+    if self.req.etag_matches(etag):
+      getattr(response.content, "close", lambda: None)()
+      try:
+        response.not_modified()
+      except ReturnResponse as e:
+        response.content = eval_thunk(e.thunk)
+
   def _send_back_response(self, response):
+    if self.auto_etag:
+      self.apply_etag(response)
     response.iterable_content = self.convert_response(response)
-    self.run_hook("before_start_response")
+    self.get_hook_runner("before_start_response")()
     response.start_response()
     return response.iterable_content
 
@@ -1109,6 +1655,7 @@ class Accept(PropertyCachable): # {{{
   PARAM_PATTERN = re.compile("\s*(?P<paramname>[^\s;,\n]+)=(?P<paramvalue>[\d\.]+)*")
   def __init__(self, text):
     self.text = text
+    self.accepts_cache = {}
 
   def parse_text(self):
     values = []
@@ -1126,11 +1673,29 @@ class Accept(PropertyCachable): # {{{
 
   @cached_property
   def values(self):
-    """List of AcceptanceValue objects."""
-    return self.parse_text()
+    """Tuple of AcceptanceValue objects."""
+    return tuple(self.parse_text())
 
   def accepts(self, type, sub_type="*", params = None):
     """Returns the best matched AcceptanceValue object if the given type is acceptable for the response, otherwise None."""
+    if params:
+      return self._accepts(type, sub_type, params)
+    key = (type, sub_type)
+    try:
+      return self.accepts_cache[key]
+    except KeyError:
+      result = self.accepts_cache[key] = self._accepts(type, sub_type, params)
+      return result
+
+  def preferred(self, candidates):
+    """Returns main types in ``candidates`` which are explicitly acceptable, 
+    in descending order of quality. Ties are broken by the order of ``candidates``.
+    """
+    values = [v for v in self.values if v.main_type in candidates and v.q > 0]
+    values.sort(key = lambda v: (-v.q, candidates.index(v.main_type)))
+    return [v.main_type for v in values]
+
+  def _accepts(self, type, sub_type, params):
     for v in self.values:
       if v.q == 0: return None
 
@@ -1162,6 +1727,274 @@ class AcceptEncoding(Accept):
     return values
 # }}}
 
+class RequestBodyError(Abort): # {{{
+  """Raised when a request body is malformed or exceeds size limits."""
+  def __init__(self, message, status_code = 400):
+    self.status_code = status_code
+    Abort.__init__(self, message, Response.STATUS_MAP[status_code])
+# }}}
+
+class UploadedFile(object): # {{{
+  """File uploaded with a ``multipart/form-data`` request.
+
+  :Attributes:
+      name
+          Field name
+      filename
+          File name sent by the client
+      type
+          Content type of the file
+      headers
+          Dictionary of the part headers, whose keys are lowercase header names
+      file
+          File-like object that holds the file data
+      size
+          Size of the file in bytes
+  """
+  def __init__(self, name, filename, type, headers, file, size):
+    self.name = name
+    self.filename = filename
+    self.type = type
+    self.headers = headers
+    self.file = file
+    self.size = size
+
+  def __repr__(self):
+    return "<%s %s (%s, %d bytes)>"%(self.__class__.__name__, self.filename, self.type, self.size)
+
+  @property
+  def value(self):
+    """Returns the file data as bytes."""
+    self.file.seek(0)
+    try:
+      return self.file.read()
+    finally:
+      self.file.seek(0)
+
+  def save(self, path, chunk_size = 64*1024):
+    """Saves the file data to ``path``."""
+    self.file.seek(0)
+    with open(path, "wb") as io:
+      shutil.copyfileobj(self.file, io, chunk_size)
+    self.file.seek(0)
+# }}}
+
+class _FormPart(object): # {{{
+  def __init__(self, parser, headers):
+    self.parser = parser
+    self.headers = headers
+    params = parser.parse_header_params(headers.get("content-disposition", ""))
+    self.name = params.get("name", u_(""))
+    self.filename = params.get("filename", None)
+    self.type = headers.get("content-type", "text/plain")
+    self.size = 0
+    self.buffer = BytesIO()
+    self.sink = None
+
+  def write(self, data):
+    if not data:
+      return
+    self.size += len(data)
+    if self.sink is not None:
+      self.sink.write(data)
+      return
+    if not self.filename:
+      if self.size > self.parser.max_field_size:
+        raise RequestBodyError("Form field '%s' is too large."%self.name, 413)
+    elif self.size > self.parser.memory_limit:
+      self.sink = self.parser.create_sink(self.name, self.filename, self.type)
+      self.sink.write(self.buffer.getvalue())
+      self.sink.write(data)
+      self.buffer = None
+      return
+    self.buffer.write(data)
+
+  def finish(self):
+    if not self.filename:
+      return guess_decode(self.buffer.getvalue())
+    file = self.buffer if self.sink is None else self.sink
+    if hasattr(file, "seek"):
+      file.seek(0)
+    return UploadedFile(self.name, self.filename, self.type, self.headers, file, self.size)
+# }}}
+
+class FormParser(object): # {{{
+  """Incremental parser for ``application/x-www-form-urlencoded`` and ``multipart/form-data`` request bodies.
+
+  Request bodies are read from ``wsgi.input`` in chunks, so the memory usage is bounded
+  regardless of the size of the body. Uploaded files are kept in memory up to ``memory_limit`` bytes,
+  and then moved to a sink(a temporary file by default).
+
+  :Attributes:
+      chunk_size
+          Size of chunks read from ``wsgi.input``, default ``64KB``
+      memory_limit
+          Uploaded files larger than this are moved from memory to a sink, default ``512KB``
+      max_content_length
+          Maximum size of request bodies, default None(unlimited)
+      max_field_size
+          Maximum size of each non-file field, default ``1MB``
+      max_header_size
+          Maximum size of headers of each multipart part, default ``8KB``
+      temp_dir
+          Directory for temporary files, default None(the system default)
+      sink
+          Function accepts three parameters : field name, file name, content type. It returns
+          a writable file-like object which uploaded data will be written to.
+      method_override_limit
+          Request bodies up to this size are parsed to find the ``_method`` parameter 
+          while the request is dispatched, default ``64KB``
+  """
+  BOUNDARY_PATTERN = re.compile(r"boundary=(?:\"([^\"]+)\"|([^\s;,]+))", re.I)
+  PARAM_PATTERN = re.compile(r";\s*([\w\-\*]+)\s*=\s*(\"(?:[^\"\\]|\\.)*\"|[^;]*)")
+  PREAMBLE, DELIMITER, HEADERS, BODY = range(4)
+
+  def __init__(self, chunk_size = 64*1024, memory_limit = 512*1024, max_content_length = None,
+               max_field_size = 1024*1024, max_header_size = 8*1024, temp_dir = None, sink = None,
+               method_override_limit = 64*1024):
+    self.chunk_size = chunk_size
+    self.memory_limit = memory_limit
+    self.max_content_length = max_content_length
+    self.max_field_size = max_field_size
+    self.max_header_size = max_header_size
+    self.temp_dir = temp_dir
+    self.sink = sink
+    self.method_override_limit = method_override_limit
+
+  def create_sink(self, name, filename, content_type):
+    """Returns a writable file-like object for the uploaded file."""
+    if self.sink:
+      return self.sink(name, filename, content_type)
+    return tempfile.TemporaryFile(dir=self.temp_dir)
+
+  def read_chunks(self, env, length):
+    fp = env.get("wsgi.input", None)
+    if fp is None:
+      return
+    while length > 0:
+      chunk = fp.read(min(self.chunk_size, length))
+      if not chunk:
+        return
+      length -= len(chunk)
+      yield chunk
+
+  def parse(self, env):
+    """Returns an iterator of (name, value) pairs in the request body.
+
+    Values of uploaded files are ``UploadedFile`` objects.
+    """
+    length = int(env.get("CONTENT_LENGTH", 0) or 0)
+    if self.max_content_length is not None and length > self.max_content_length:
+      raise RequestBodyError("Request body is too large.", 413)
+    content_type = env.get("CONTENT_TYPE", "")
+    main_type = content_type.split(";")[0].strip().lower()
+    if not length:
+      return iter([])
+    if main_type == "multipart/form-data":
+      return self.parse_multipart(self.read_chunks(env, length), content_type)
+    if main_type in ("application/x-www-form-urlencoded", ""):
+      return self.parse_urlencoded(self.read_chunks(env, length))
+    return iter([])
+
+  def unquote(self, s):
+    return guess_decode(_unquote_to_bytes(s.replace(b"+", b" ")))
+
+  def parse_urlencoded(self, chunks):
+    """Parses an urlencoded body given as an iterator of bytes."""
+    buffer = b""
+    for chunk in chunks:
+      pairs = (buffer + chunk).split(b"&")
+      buffer = pairs.pop()
+      if len(buffer) > self.max_field_size:
+        raise RequestBodyError("Form field is too large.", 413)
+      for pair in pairs:
+        if pair:
+          name, _, value = pair.partition(b"=")
+          yield self.unquote(name), self.unquote(value)
+    if buffer:
+      name, _, value = buffer.partition(b"=")
+      yield self.unquote(name), self.unquote(value)
+
+  def parse_header_params(self, value):
+    params = {}
+    for name, v in self.PARAM_PATTERN.findall(value):
+      name = name.lower()
+      v = v.strip()
+      if v[:1] == '"':
+        v = re.sub(r"\\(.)", r"\1", v[1:-1])
+      if name.endswith("*"):
+        charset, _, v = v.partition("'")
+        v = _unquote_to_bytes(b_(v.partition("'")[2], "latin1")).decode(charset or "utf8", "replace")
+        name = name[:-1]
+      params[name] = v
+    return params
+
+  def parse_part_headers(self, data):
+    headers = {}
+    for line in guess_decode(data).split("\r\n"):
+      name, _, value = line.partition(":")
+      if value:
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+  def parse_multipart(self, chunks, content_type):
+    """Parses a multipart body given as an iterator of bytes."""
+    m = self.BOUNDARY_PATTERN.search(content_type)
+    if not m:
+      raise RequestBodyError("Multipart boundary is missing.")
+    delimiter = b"--" + b_(m.group(1) or m.group(2), "latin1")
+    separator = b"\r\n" + delimiter
+    state = self.PREAMBLE
+    buffer = b""
+    part = None
+    while True:
+      if state == self.PREAMBLE:
+        i = buffer.find(delimiter)
+        if i > -1:
+          buffer = buffer[i+len(delimiter):]
+          state = self.DELIMITER
+          continue
+        buffer = buffer[-len(delimiter):]
+      elif state == self.DELIMITER:
+        if len(buffer) >= 2:
+          if buffer[:2] == b"--":
+            return
+          if buffer[:2] != b"\r\n":
+            raise RequestBodyError("Malformed multipart body.")
+          buffer = buffer[2:]
+          state = self.HEADERS
+          continue
+      elif state == self.HEADERS:
+        i = buffer.find(b"\r\n\r\n")
+        if i > -1:
+          if i > self.max_header_size:
+            raise RequestBodyError("Multipart headers are too large.", 413)
+          part = _FormPart(self, self.parse_part_headers(buffer[:i]))
+          buffer = buffer[i+4:]
+          state = self.BODY
+          continue
+        if len(buffer) > self.max_header_size:
+          raise RequestBodyError("Multipart headers are too large.", 413)
+      else:
+        i = buffer.find(separator)
+        if i > -1:
+          part.write(buffer[:i])
+          buffer = buffer[i+len(separator):]
+          yield part.name, part.finish()
+          part = None
+          state = self.DELIMITER
+          continue
+        keep = len(separator) - 1
+        if len(buffer) > keep:
+          part.write(buffer[:-keep])
+          buffer = buffer[-keep:]
+
+      chunk = next(chunks, None)
+      if chunk is None:
+        raise RequestBodyError("Unexpected end of multipart body.")
+      buffer += chunk
+# }}}
+
 class Request(PropertyCachable): # {{{
   """Request.
 
@@ -1170,34 +2003,43 @@ class Request(PropertyCachable): # {{{
           List of parameters as part of the requested URL
       action     
           Requested rays.Action object.
+      form_parser
+          rays.FormParser object which parses the request body.
+      header_cache
+          rays.LRUCache object which holds parsed 'Accept-\*', 'Cookie' and 'If-None-Match' headers, or None.
   """
   PARAM_NAME = re.compile("(\w+)\[(\w*)\]")
-  def __init__(self, env):
+  form_parser = FormParser()
+  header_cache = None
+
+  def __init__(self, env, form_parser = None, header_cache = None):
     if env.get('HTTPS', '').lower() in ['on', 'true', '1'] or env.get("HTTP_X_FORWARDED_PROTO") == "https":
       env["wsgi.url_scheme"] = 'https'
     self._env = env
+    if form_parser is not None:
+      self.form_parser = form_parser
+    if header_cache is not None:
+      self.header_cache = header_cache
     self._path = "/"+env.get("PATH_INFO", env.get('REQUEST_URI', '').split("?")[0]).lstrip("/")
     self.params = []
     self.action = None
 
-  @cached_property
-  def input(self):
-    """Returns a dictionary object with the GET and POST parameters."""
-    input = {}
+  def _build_params(self, *pair_groups):
+    result = {}
     def parse_input(k, value, is_list = False):
       m = self.PARAM_NAME.match(k)
       if m:
         name = m.group(1)
         key = m.group(2)
         if key:
-          if name not in input:
-            input[name] = {}
-          d = input[name]
+          if name not in result:
+            result[name] = {}
+          d = result[name]
         else:
-          d = input
+          d = result
           key = name
       else:
-        d = input
+        d = result
         key = k
       if is_list or isinstance(d.get(key, None), list):
         if key not in d:
@@ -1206,33 +2048,44 @@ class Request(PropertyCachable): # {{{
       else:
         d[key] = value
 
-    if self.env.get('CONTENT_TYPE', '').lower().startswith('multipart/'):
-      fp = self.env['wsgi.input']
-    else:
-      fp = BytesIO(self.env['wsgi.input'].read(self.content_length))
-    storage = cgi.FieldStorage(fp=fp, environ=self.env, keep_blank_values=1)
-
-    def _decode(v):
-      if v.filename:
-        return v
-      v = v.value
-      if isinstance(v, string_types):
-        v = guess_decode(v)
-      return v
+    for pairs in pair_groups:
+      keys, values = [], {}
+      for k, v in pairs:
+        if k not in values:
+          keys.append(k)
+          values[k] = []
+        values[k].append(v)
+      for k in keys:
+        if len(values[k]) > 1:
+          [parse_input(k, v, True) for v in values[k]]
+        else:
+          parse_input(k, values[k][0], False)
+    return result
 
-    for k in storage:
-      value = storage[k]
-      if isinstance(value, list):
-        [parse_input(k,_decode(v), True) for v in value]
-      else:
-        parse_input(k, _decode(value), False)
+  @cached_property
+  def query_pairs(self):
+    """Returns a list of (name, value) pairs in the query string."""
+    return list(self.form_parser.parse_urlencoded([l_(self.env.get("QUERY_STRING", ""))]))
+
+  @cached_property
+  def form_pairs(self):
+    """Returns a list of (name, value) pairs in the request body."""
+    return list(self.form_parser.parse(self.env))
+
+  @cached_property
+  def query(self):
+    """Returns a dictionary object with the query string parameters."""
+    return self._build_params(self.query_pairs)
 
-    for k,v in urllib.parse.parse_qsl(self.env.get('QUERY_STRING',"")):
-      if isinstance(v, string_types):
-        v = unquote_guess_decode(v)
-      parse_input(k,v,False)
+  @cached_property
+  def form(self):
+    """Returns a dictionary object with the request body parameters. Uploaded files are rays.UploadedFile objects."""
+    return self._build_params(self.form_pairs)
 
-    return input
+  @cached_property
+  def input(self):
+    """Returns a dictionary object with the GET and POST parameters."""
+    return self._build_params(self.form_pairs, self.query_pairs)
 
   env = property(lambda s:s._env, None, None, """Returns a dictionary object with the environment variables.""")
   path = property(lambda s:s._path, None, None, """Returns a path, such as /show/1  """)
@@ -1245,35 +2098,64 @@ class Request(PropertyCachable): # {{{
         name = "HTTP_%s"%name
     return self.env.get(name, default)
 
+  def parse_header(self, parser, text):
+    """Returns a parsed header value, which may be shared between requests."""
+    cache = self.header_cache
+    if cache is None:
+      return parser(text)
+    key = (parser, text)
+    value = cache.get(key)
+    if value is None:
+      value = parser(text)
+      cache.set(key, value)
+    return value
+
+  @staticmethod
+  def _parse_cookie(text):
+    cookie = http.cookies.SimpleCookie()
+    cookie.load(text)
+    return tuple((k, unquote_guess_decode(cookie[k].value)) for k in cookie)
+
   @cached_property
   def accept(self):
     """Returns an Accept object associated with the 'Accept' header."""
-    return Accept(self.env.get("HTTP_ACCEPT", ""))
+    return self.parse_header(Accept, self.env.get("HTTP_ACCEPT", ""))
 
   @cached_property
   def accept_charset(self):
     """Returns an Accept object associated with the 'Accept-Charset' header."""
-    return AcceptCharset(self.env.get("HTTP_ACCEPT_CHARSET", "*"))
+    return self.parse_header(AcceptCharset, self.env.get("HTTP_ACCEPT_CHARSET", "*"))
 
   @cached_property
   def accept_language(self):
     """Returns an Accept object associated with the 'Accept-Charset' header."""
-    return AcceptLanguage(self.env.get("HTTP_ACCEPT_LANGUAGE", "*"))
+    return self.parse_header(AcceptLanguage, self.env.get("HTTP_ACCEPT_LANGUAGE", "*"))
 
   @cached_property
   def accept_encoding(self):
     """Returns an Accept object associated with the 'Accept-Encoding' header."""
-    return AcceptEncoding(self.env.get("HTTP_ACCEPT_ENCODING", "*"))
+    return self.parse_header(AcceptEncoding, self.env.get("HTTP_ACCEPT_ENCODING", "*"))
 
   @cached_property
   def cookies(self):
     """Returns a dictionary object with the cookies."""
-    cookie = http.cookies.SimpleCookie()
-    cookie.load(self.env.get('HTTP_COOKIE', ''))
-    d = {}
-    for k in cookie:
-      d[k] = unquote_guess_decode(cookie[k].value)
-    return d
+    return dict(self.parse_header(self._parse_cookie, self.env.get('HTTP_COOKIE', '')))
+
+  @staticmethod
+  def _parse_etags(text):
+    return frozenset(re.findall(r'\*|"[^"]*"', text))
+
+  @cached_property
+  def if_none_match(self):
+    """Returns a set of entity tags in the 'If-None-Match' header. Weak indicators('W/') are removed."""
+    return self.parse_header(self._parse_etags, self.env.get("HTTP_IF_NONE_MATCH", ""))
+
+  def etag_matches(self, etag):
+    """Returns True if the ``etag`` matches the 'If-None-Match' header by the weak comparison."""
+    if "HTTP_IF_NONE_MATCH" not in self.env:
+      return False
+    etags = self.if_none_match
+    return "*" in etags or (etag[2:] if etag.startswith("W/") else etag) in etags
 
   @cached_property
   def websocket(self):
@@ -1295,11 +2177,33 @@ class Request(PropertyCachable): # {{{
 
   @cached_property
   def method(self):
-    """Returns the HTTP REQUEST_METHOD as a lowercase string."""
+    """Returns the HTTP REQUEST_METHOD as a lowercase string.
+
+    The method of POST requests can be overridden by the 'X-HTTP-Method-Override' header or
+    the ``_method`` parameter. The request body is searched for the ``_method`` parameter only if 
+    it has been already parsed or its size is not larger than ``FormParser.method_override_limit``.
+    """
     method = self.env["REQUEST_METHOD"].lower()
-    if method == "post":
-      return self.input.get("_method", method).lower()
-    return method
+    if method != "post":
+      return method
+    override = self.env.get("HTTP_X_HTTP_METHOD_OVERRIDE", None)
+    if not override:
+      override = self._method_param(self.query)
+    if not override and ("form_pairs" in self.__dict__ or
+                         self.content_length <= self.form_parser.method_override_limit):
+      try:
+        override = self._method_param(self.form)
+      except RequestBodyError:
+        pass
+    return (override or method).lower()
+
+  @staticmethod
+  def _method_param(params):
+    # repeated parameters are lists, the last one wins
+    value = params.get("_method", None)
+    if isinstance(value, list):
+      value = value and value[-1] or None
+    return value if isinstance(value, str) else None
 
   @cached_property
   def ua(self):
@@ -1354,6 +2258,135 @@ class Request(PropertyCachable): # {{{
     
 # }}}
 
+class FileMetadata(object): # {{{
+  """Metadata of a file to be sent as a response.
+
+  :Attributes:
+      path
+          Path of the file.
+      size
+          Size of the file.
+      mtime
+          Last modification time of the file in seconds since the epoch.
+      mimetype
+          Guessed mimetype of the file, or None.
+      etag
+          'ETag' header value for the file.
+      last_modified
+          'Last-Modified' header value for the file.
+      checked_at
+          Time when this metadata was checked against the file system.
+      variants
+          Dictionary which maps content codings, such as "gzip", to 
+          rays.FileMetadata objects of precompressed files.
+  """
+  def __init__(self, path, stats, mimetype = None):
+    self.path = path
+    self.size = stats.st_size
+    self.mtime = stats.st_mtime
+    self.mimetype = mimetype
+    self.etag = '"%x-%x"' % (int(stats.st_mtime), stats.st_size)
+    self.last_modified = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(stats.st_mtime))
+    self.checked_at = time.time()
+    self.variants = {}
+
+  @classmethod
+  def from_path(cls, path):
+    """Returns metadata of the regular file ``path``. Raises an OSError if it does not exist."""
+    stats = os.stat(path)
+    if not stat.S_ISREG(stats.st_mode):
+      raise OSError(errno.ENOENT, "Not a regular file", path)
+    return cls(path, stats, mimetypes.guess_type(path)[0])
+
+  def is_modified(self, stats):
+    """Returns True if ``stats`` differs from this metadata."""
+    return stats.st_mtime != self.mtime or stats.st_size != self.size
+# }}}
+
+class FileContent(object): # {{{
+  """An iterable response content which sends a whole file or byte ranges of a file.
+
+  A content that ends at the end of the file is passed to the
+  ``wsgi.file_wrapper`` of the WSGI server if available, so that servers can
+  send it with a zero-copy system call such as ``sendfile``.
+
+  :Attributes:
+      file
+          File object opened in binary mode.
+      size
+          Size of the file.
+      ranges
+          List of (first, last) byte positions, or None for the whole file.
+      chunk_size
+          Size of blocks to read the file.
+      content_type
+          Content type of the file, used in multipart/byteranges responses.
+      boundary
+          Multipart boundary if this content has multiple ranges, otherwise None.
+  """
+  def __init__(self, file, size, ranges = None, chunk_size = 65536, content_type = None):
+    self.file = file
+    self.size = size
+    self.ranges = ranges
+    self.chunk_size = chunk_size
+    self.content_type = content_type
+    self.boundary = (ranges and len(ranges) > 1) and uuid.uuid4().hex or None
+
+  def part_header(self, first, last):
+    return b_("--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"%(
+               self.boundary, self.content_type, first, last, self.size))
+
+  def get_content_length(self):
+    if not self.ranges:
+      return self.size
+    if self.boundary is None:
+      first, last = self.ranges[0]
+      return last - first + 1
+    return sum(len(self.part_header(first, last)) + last - first + 3 for first, last in self.ranges) + \
+           len(self.boundary) + 6
+
+  content_length = property(get_content_length, None, None, "Number of bytes to be sent.")
+
+  def read(self, first, last):
+    """Yields bytes from ``first`` to ``last`` position."""
+    self.file.seek(first)
+    remaining = last - first + 1
+    read, chunk_size = self.file.read, self.chunk_size
+    while remaining > 0:
+      data = read(min(chunk_size, remaining))
+      if not data:
+        break
+      remaining -= len(data)
+      yield data
+
+  def __iter__(self):
+    if self.boundary is None:
+      first, last = self.ranges and self.ranges[0] or (0, self.size - 1)
+      return self.read(first, last)
+    return self._iter_multipart()
+
+  def _iter_multipart(self):
+    for first, last in self.ranges:
+      yield self.part_header(first, last)
+      for data in self.read(first, last):
+        yield data
+      yield b"\r\n"
+    yield b_("--%s--\r\n"%self.boundary)
+
+  def close(self):
+    self.file.close()
+
+  def wrap(self, env):
+    """Returns an iterable object to be passed to the WSGI server."""
+    wrapper = env.get("wsgi.file_wrapper", None)
+    if wrapper is not None and self.boundary is None:
+      first, last = self.ranges and self.ranges[0] or (0, self.size - 1)
+      if last == self.size - 1:
+        self.file.seek(first)
+        return wrapper(self.file, self.chunk_size)
+    return self
+# }}}
+
 class Response(object): # {{{
   """Response.
 
@@ -1368,12 +2401,16 @@ class Response(object): # {{{
           Content for the response as an iterable object(list of bytes or an IO object)
       exception
           Exception that was raised while this request
+      file_chunk_size
+          Size of blocks to read files sent by ``send_file``, default ``64KB``
       is_headers_written
           True if headers have already been sent, otherwise False
   """
 
+  file_chunk_size = 65536
+
   def __init__(self, start_response):
-    self._headers = [("Accept-Ranges", "none"), ("Cache-Control", "no-cache")]
+    self._headers = HeaderDict([("Accept-Ranges", "none"), ("Cache-Control", "no-cache")])
     self.content_type = 'text/html; charset=UTF-8'
     self.status_code = 200
     self.charset ='UTF-8'
@@ -1386,25 +2423,31 @@ class Response(object): # {{{
   content_type = property(lambda s: s.get_header('Content-type'),
                           lambda s,v: s.set_header('Content-type', v), None,
                           """Content-type for the response""")
-  headers = property(lambda s: s._headers, 
+  headers = property(lambda s: s._headers.items(), 
                      None, None,
                     """List of tuples, such as [("Content-Type", "text/html")] """)
-  status = property(lambda s: "%d %s"%(s.status_code, s.CODE_MAP[s.status_code]), 
-                    None, None, 
+
+  def get_status(self):
+    try:
+      return self.STATUS_MAP[self.status_code]
+    except KeyError:
+      return "%d %s"%(self.status_code, self.CODE_MAP[self.status_code])
+
+  status = property(get_status, None, None, 
                     """Status string for the response, such as "200 OK" """)
 
   def start_response(self):
     """Sends HTTP headers to the client."""
     if not self.is_headers_written:
-      self._start_response(self.status, self.headers)
+      self._start_response(self.status, self._headers.items())
       self.is_headers_written = True
 
   def get_header(self, name):
-    """ Returns the value for the named header.
+    """ Returns the value for the named header. Header names are case insensitive.
 
     Returns a list if exists multiple headers of the same ``name``, otherwise a string.
     """
-    result = [v for k,v in self._headers if k == name]
+    result = self._headers.get_all(name)
     if not result:
       return None
     return (len(result) > 1 and result or result[0])
@@ -1415,12 +2458,13 @@ class Response(object): # {{{
     if ``unique`` is True, ``name`` header will be overwritten by this value.
     """
     if unique:
-      self.del_header(name)
-    self._headers.append((name, n_(value)))
+      self._headers.set(name, n_(value))
+    else:
+      self._headers.add(name, n_(value))
 
   def del_header(self, name):
     """Deletes the ``name`` headers."""
-    self._headers = [(k,v) for k,v in self._headers if k != name]
+    self._headers.delete(name)
 
   def set_cookie(self, name, value, expires="", domain=None, secure=False, path="/", **kargs):
     """Sets a cookie.
@@ -1461,6 +2505,7 @@ class Response(object): # {{{
 
   CODE_MAP = {
     200 : "OK",
+    206 : "Partial Content",
     301 : "Moved Permanently",
     302 : "Found",
     303 : "See Other",
@@ -1470,20 +2515,24 @@ class Response(object): # {{{
     403 : "Forbidden",
     404 : "Not Found",
     405 : "Method Not Allowed",
+    413 : "Request Entity Too Large",
+    416 : "Requested Range Not Satisfiable",
     500 : "Internal Server Error"
   }
+  STATUS_MAP = dict((code, "%d %s"%(code, message)) for code, message in iter_items(CODE_MAP))
 
   moved_permanently  = _def_redirect(301)
   found              = _def_redirect(302)
   seeother           = _def_redirect(303)
+  NOT_MODIFIED_HEADERS = ("etag", "cache-control", "expires", "vary", "content-location")
+
   def not_modified(self):
+    """Sends a '304 Not Modified' response immediately.
+    Headers other than ``NOT_MODIFIED_HEADERS`` and 'X-' headers are removed.
+    """
     self.status_code = 304
-    _headers = []
-    for (k,v) in self._headers:
-      if not k.startswith("X-"):
-        continue
-      _headers.append((k,v))
-    self._headers = _headers
+    self._headers = HeaderDict((k,v) for k,v in self._headers.items() 
+                               if k.startswith("X-") or k.lower() in self.NOT_MODIFIED_HEADERS)
     return_response([])
 
   temporary_redirect = _def_redirect(307)
@@ -1493,39 +2542,77 @@ class Response(object): # {{{
   forbidden          = _def_error(403)
   notfound           = _def_error(404)
   method_not_allowed = _def_error(405)
+  requested_range_not_satisfiable = _def_error(416)
   internal_error     = _def_error(500)
 
 
-  def send_file(self, filepath, guess_mimetype = True, mimetype = 'text/plain', last_modified= None):
-    """ Sends file data to a browser immediately."""
-    if not os.path.exists(filepath) or not os.path.isfile(filepath):
+  def send_file(self, filepath, guess_mimetype = True, mimetype = 'text/plain', last_modified= None,
+                range = None, if_range = None, chunk_size = None, metadata = None):
+    """ Sends file data to a browser immediately.
+
+    :Parameters:
+        range
+            'Range' header value of the request. Satisfiable ranges are sent as a partial content.
+        if_range
+            'If-Range' header value of the request.
+        chunk_size
+            Size of blocks to read the file, default ``file_chunk_size``
+        metadata
+            rays.FileMetadata object of the file. It is used only if the opened file
+            has the same size and modification time, so that replaced files are sent correctly.
+    """
+    try:
+      file = open(filepath, 'rb')
+    except (IOError, OSError) as e:
+      if e.errno == errno.EACCES:
+        self.forbidden()
       self.notfound()
-    if not os.access(filepath, os.R_OK):
-      self.forbidden()
-
-    if guess_mimetype:
-      guessed = mimetypes.guess_type(filepath)[0]
-      if guessed:
-        self.content_type = guessed
-    if not self.content_type and mimetype:
-      self.content_type = mimetype
+
+    try:
+      # the file may have been replaced after the metadata was cached, so checks the opened file.
+      stats = os.fstat(file.fileno())
+      if metadata is None or metadata.is_modified(stats):
+        if not stat.S_ISREG(stats.st_mode):
+          self.notfound()
+        if metadata is None:
+          metadata = FileMetadata(filepath, stats, guess_mimetype and mimetypes.guess_type(filepath)[0] or None)
+        else:
+          metadata = FileMetadata(filepath, stats, metadata.mimetype)
+
+      if guess_mimetype and metadata.mimetype:
+        self.content_type = metadata.mimetype
+      if not self.content_type and mimetype:
+        self.content_type = mimetype
   
-    stats = os.stat(filepath)
-    if not self.get_header('Content-Length'):
-      self.set_header('Content-Length',stats.st_size)
-    if not self.get_header('Last-Modified'):
-      if not last_modified:
-        mtime = time.gmtime(stats.st_mtime)
-        last_modified = time.strftime("%a, %d %b %Y %H:%M:%S +0000", mtime)
-      self.set_header('Last-Modified', last_modified)
-    if not self.get_header("Etag"):
-      hasher = sha1()
-      stat = os.stat(filepath)
-      hasher.update(b_(filepath))
-      hasher.update(b_(stat.st_mtime))
-      hasher.update(b_(stat.st_size))
-      self.set_header('Etag', '"%s"' % hasher.hexdigest())
-    return_response(open(filepath, 'rb'))
+      if not self.get_header('Last-Modified'):
+        self.set_header('Last-Modified', last_modified or metadata.last_modified)
+      etag = self.get_header("Etag")
+      if not etag:
+        etag = metadata.etag
+        self.set_header('Etag', etag)
+      self.set_header("Accept-Ranges", "bytes")
+
+      ranges = None
+      if range and (not if_range or if_range in (etag, self.get_header('Last-Modified'))):
+        ranges = parse_range_header(range, metadata.size)
+        if ranges == []:
+          self.set_header("Content-Range", "bytes */%d"%metadata.size)
+          self.requested_range_not_satisfiable()
+
+      content = FileContent(file, metadata.size, ranges, chunk_size or self.file_chunk_size, self.content_type)
+      if ranges:
+        self.status_code = 206
+        if content.boundary is None:
+          self.set_header("Content-Range", "bytes %d-%d/%d"%(ranges[0] + (metadata.size,)))
+        else:
+          self.content_type = "multipart/byteranges; boundary=%s"%content.boundary
+        self.set_header('Content-Length', content.content_length)
+      elif not self.get_header('Content-Length'):
+        self.set_header('Content-Length', content.content_length)
+    except:
+      file.close()
+      raise
+    return_response(content)
 
   def get_is_success(self):
     return 200 <= self.status_code < 400
@@ -1547,9 +2634,73 @@ class Response(object): # {{{
 
 # Embpy {{{
 class EmbpyString(str): pass
+
+class RenderContext(object):
+  """State of a template being rendered. Template helpers refer to it instead of inspecting the caller's frames.
+
+  Embpy activates the context in the current thread while the template is executed,
+  so ``RenderContext.current()`` returns the context of the innermost template being rendered.
+
+  :Attributes:
+      buffer
+          List of rendered strings.
+      append
+          Function which adds a string to ``buffer``.
+      namespace
+          Dictionary which the template is rendered in. Captured markup is stored in it.
+      streaming
+          True if the template is rendered by ``Embpy.stream``.
+      flush_size
+          ``flush_size`` of ``Embpy.stream``.
+      holds
+          Number of open captures, cache blocks and layouts. Streamed templates are not flushed 
+          while it is positive, since the buffered markup may still be moved.
+      layout
+          Generator of the streamed layout, which is yielded after the template. 
+  """
+  __slots__ = ("buffer", "append", "namespace", "streaming", "flush_size", "holds", "layout")
+  local = threading.local()
+
+  def __init__(self, namespace, streaming = False, flush_size = None):
+    self.buffer = []
+    self.append = self.buffer.append
+    self.namespace = namespace
+    self.streaming = streaming
+    self.flush_size = flush_size
+    self.holds = 0
+    self.layout = None
+
+  @classmethod
+  def current(cls):
+    """Returns the RenderContext object activated in the current thread, or None."""
+    return getattr(cls.local, "context", None)
+
+  def activate(self):
+    """Activates this context in the current thread. Returns the context which was active."""
+    local = self.local
+    previous = getattr(local, "context", None)
+    local.context = self
+    return previous
+
 class Embpy(object):
+  """Embedded python template engine.
+
+  Compiled templates are cached in ``cache_path`` + "_" + ``cache_key``.
+  The cache key is a hash of the template source, the compiler version and the python version, 
+  so processes sharing a cache directory never load stale code.
+
+  :Attributes:
+      compile_time
+          Seconds taken to compile the template, or None if it has not been compiled.
+      load_time
+          Seconds taken to load the compiled template from the cache, or None if it has not been loaded.
+      function
+          Render function of the precompiled module, or None. See ``Embpy.module_source``.
+  """
   BLOCK_START_PAT = re.compile(r".*:\s*$")
+  DEFINITION_PAT = re.compile(r"\s*(async\s+)?(def|class)\s")
   VERSION_SUFFIX = u_("").join(map(str, list(sys.version_info)))
+  COMPILER_VERSION = "6"
 
   def _lazy(lock):
     def deco(f):
@@ -1585,24 +2736,52 @@ class Embpy(object):
     return re.compile(r"""((?P<print_code><%=(?P<raw_mode>(r )?))|((?P<s_space>^[ \t]*)(?P<trim_start><%\-))|(<%(?!%)(?:\-?)))(?P<code_body>("([^\\"]|\\.)*"|'([^\\']|\\.)*'|(?:(?!(%>)).))*)((?P<trim_end>\-%>[\n]?)|(?P<end_tag>[^%]%>))""", re.M|re.S)
 
 
+  HEADER = "__buffer = __context.buffer\n__buffer_append = __context.append\n"
+  STREAM_HEADER = """def __stream(__flush_size, __context):
+  __buffer = __context.buffer
+  __size = [0]
+  def __buffer_append(s, append = __buffer.append):
+    append(s)
+    __size[0] += len(s)
+  __context.append = __buffer_append
+  def __flush():
+    s = u_("").join(__buffer)
+    del __buffer[:]
+    __size[0] = 0
+    return s
+"""
+  FUNCTION_HEADER = """def render(u_, __filter, __context):
+  __buffer = __context.buffer
+  __buffer_append = __context.append
+"""
+
   def __init__(self, template, cache_path = "", template_globals = None, filter=None, encoding="utf8"):
-    self.code = ["__buffer= []\n__buffer_append = __buffer.append\n"]
+    self.code = [self.HEADER]
     self.src  = ""
+    self.stream_code = None
+    self.stream_src = ""
+    self.streaming = False
+    self.function = None
+    self.stream_function = None
     self.indent = 0
+    self.definitions = []
     self.template = getattr(template, "read", lambda: template)()
     self.file_path = getattr(template, "name", None)
     self.encoding = encoding
     if isinstance(self.template, bytes):
       self.template = self.template.decode(self.encoding)
-    self.cache_path = cache_path and cache_path+"_"+self.VERSION_SUFFIX or ""
     self.template_globals = template_globals or {}
     self.filter = filter
+    self.cache_path = cache_path and cache_path+"_"+self.cache_key() or ""
+    self.compile_time = None
+    self.load_time = None
     if filter:
-      def _(s):
-        if not isinstance(s, EmbpyString) :
-          return EmbpyString(filter(u_(s)))
-        else:
+      def _(s, str = str):
+        if s.__class__ is str:
+          return EmbpyString(filter(s))
+        elif isinstance(s, EmbpyString):
           return s
+        return EmbpyString(filter(u_(s)))
       self.template_globals["__filter"] = _
 
   def set_template_globals(self, dct = None):
@@ -1614,95 +2793,292 @@ class Embpy(object):
 
   template_globals = property(get_template_globals, set_template_globals)
 
+  def cache_key(self):
+    hasher = sha1()
+    hasher.update(b_("%s:%s:%d:"%(self.COMPILER_VERSION, self.VERSION_SUFFIX, bool(self.filter))))
+    hasher.update(self.template.encode("utf8"))
+    return hasher.hexdigest()[:20]
+
   def is_cached(self):
-     return self.file_path and self.cache_path and \
-     os.path.exists(self.file_path) and os.path.exists(self.cache_path) and \
-     os.path.getmtime(self.file_path) < os.path.getmtime(self.cache_path)
+    return bool(self.cache_path) and os.path.exists(self.cache_path)
 
-  def compile(self):
-    if isinstance(self.code, list):
-      if self.is_cached(): 
-        self.code = marshal.load(open(self.cache_path, "rb"))
+  def load_cache(self):
+    """Returns a code object loaded from the cache, or None."""
+    if not self.cache_path:
+      return None
+    start = time.time()
+    try:
+      with open(self.cache_path, "rb") as io:
+        code = marshal.load(io)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+      return None
+    self.load_time = time.time() - start
+    return code
+
+  def save_cache(self, code):
+    """Writes ``code`` to the cache. The file is replaced atomically, so other processes never read partially written code."""
+    if not self.cache_path:
+      return
+    dir_path = os.path.dirname(self.cache_path) or "."
+    tmp_path = None
+    try:
+      if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+      fd, tmp_path = tempfile.mkstemp(dir = dir_path, prefix = ".embpy")
+      with os.fdopen(fd, "wb") as io:
+        marshal.dump(code, io)
+      getattr(os, "replace", os.rename)(tmp_path, self.cache_path)
+    except (IOError, OSError):
+      if tmp_path and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  def generate(self, streaming = False, function = False):
+    """Returns python source code of the template.
+    If ``streaming`` is True, the code defines a generator function which yields rendered chunks.
+    If ``function`` is True, the code defines a function ``render`` which returns the output buffer.
+    """
+    self.streaming = streaming
+    code = self.code
+    if streaming:
+      self.code = [self.STREAM_HEADER]
+    elif function:
+      self.code = [self.FUNCTION_HEADER]
+    else:
+      self.code = [self.HEADER]
+    self.indent = (streaming or function) and 1 or 0
+    self.definitions = []
+    s = self.template
+    if streaming and "with_layout" in s:
+      # the body is moved into the layout, so it is held until the end of the template
+      self.do_indent()
+      self.code.append(u_("__context.holds += 1"))
+    search = self.splitter().search
+    scan = self.scanner().scan
+    m = True
+    pos = 0
+    while m:
+      m = search(s, pos=pos)
+      if m:
+        text = s[pos:m.start()]
       else:
-        s = self.template
-        search = self.splitter().search
-        scan = self.scanner().scan
-        m = True
-        pos = 0
-        while m:
-          m = search(s, pos=pos)
-          if m:
-            text = s[pos:m.start()]
-          else:
-            text = s[pos:]
-          self.append(self.escape_string(text))
-          if not m:
-            break
-
-          d = m.groupdict()
-          pos = m.end()
-          code_body = [d.get("code_body") or ""]
-
-          if not d.get("trim_end"):
-            v = d.get("end_tag")[0]
-            if v != "-":
-              code_body.append(v)
-
-          if d.get("print_code"):
-            self.do_indent()
-            if self.filter and not d["raw_mode"]:
-              self.code.append(u_("__buffer_append(__filter("))
-            else:
-              self.code.append(u_("__buffer_append(u_("))
-
-          code_body = u_("").join(code_body)
-          if not code_body.strip():
-            # <% %>: indent end
-            self.indent_end("")
-          else:
-            self.do_indent()
-            for token_type, value in scan(code_body)[0]:
-              getattr(self, token_type)(value)
+        text = s[pos:]
+      self.append(self.escape_string(text))
+      if not m:
+        break
 
-          if d.get("print_code"):
-              self.code.append(u_("))"))
+      d = m.groupdict()
+      pos = m.end()
+      code_body = [d.get("code_body") or ""]
 
+      if not d.get("trim_end"):
+        v = d.get("end_tag")[0]
+        if v != "-":
+          code_body.append(v)
+
+      if d.get("print_code"):
         self.do_indent()
-        self.src = u_("").join(self.code)
-        try:
-          self.code = compile(self.src, "<string>", "exec")
-        except SyntaxError as e:
-          e.text = u_("\n").join(self.src.splitlines()[0:e.lineno])
-          e.args = ('invalid syntax', ('<string>', e.lineno, e.offset, e.text))
-          reraise(e.__class__, e, sys.exc_info()[-1])
-        if self.file_path and self.cache_path:
-          marshal.dump(self.code, open(self.cache_path, "wb"))
+        if self.filter and not d["raw_mode"]:
+          self.code.append(u_("__buffer_append(__filter("))
+        else:
+          self.code.append(u_("__buffer_append(u_("))
+
+      code_body = u_("").join(code_body)
+      if not code_body.strip():
+        # <% %>: indent end
+        self.indent_end("")
+      elif code_body.strip() == "flush()":
+        # <% flush() %>: flush point for streaming
+        if streaming and not self.definitions:
+          self.do_indent()
+          self.code.append(u_("if not __context.holds: yield __flush()"))
+      else:
+        self.do_indent()
+        for token_type, value in scan(code_body)[0]:
+          getattr(self, token_type)(value)
+
+      if d.get("print_code"):
+        self.code.append(u_("))"))
+        self.flush_point()
+
+    self.do_indent()
+    if streaming:
+      self.code.append(u_("if __context.layout is not None:"))
+      self.indent += 1
+      self.do_indent()
+      self.code.append(u_("for __chunk in __context.layout: yield __chunk"))
+      self.indent -= 1
+      self.do_indent()
+      self.code.append(u_("yield __flush()"))
+      self.do_indent()
+    elif function:
+      self.code.append(u_("return __buffer"))
+      self.do_indent()
+    src, self.code = u_("").join(self.code), code
+    if streaming or function:
+      src = self.declare_globals(src)
+    return src
+
+  def declare_globals(self, src):
+    """Declares names assigned in the template function of ``src`` as global, so that they are stored 
+    in the namespace as templates executed by ``exec`` do, and layouts can read them.
+    Internal names, such as ``__buffer_append``, remain fast local variables.
+    """
+    try:
+      code = compile(src, "<string>", "exec")
+    except SyntaxError:
+      return src
+    function = [c for c in code.co_consts if isinstance(c, types.CodeType)][0]
+    names = set(n for n in function.co_varnames[function.co_argcount:] + function.co_cellvars 
+                if not n.startswith("__"))
+    if not names:
+      return src
+    header, body = src.split("\n", 1)
+    return u_("%s\n  global %s\n%s")%(header, u_(", ").join(sorted(names)), body)
+
+  def module_source(self):
+    """Returns python source code of a module which defines render functions of the template.
+
+    Internal variables, such as ``__buffer_append``, are fast local variables of the functions.
+    ``Embpy.load_module`` uses the module instead of compiling the template.
+    """
+    return u_("").join([
+      u_("# Generated by rays from %s. Do not edit.\n")%(self.file_path and os.path.basename(self.file_path) or "<string>"),
+      u_("KEY = %r\n\n")%n_(self.cache_key()),
+      self.generate(function = True),
+      u_("\n\n"),
+      self.generate(streaming = True),
+      u_("\n\nstream = __stream\n")])
+
+  def load_module(self, module):
+    """Uses render functions defined in ``module`` if the module was generated from the same template.
+    Returns True if the module is used.
+    """
+    if getattr(module, "KEY", None) != self.cache_key():
+      return False
+    self.function = module.render
+    self.stream_function = module.stream
+    return True
+
+  def compile_source(self, src):
+    try:
+      return compile(src, "<string>", "exec")
+    except SyntaxError as e:
+      e.text = u_("\n").join(src.splitlines()[0:e.lineno])
+      e.args = ('invalid syntax', ('<string>', e.lineno, e.offset, e.text))
+      reraise(e.__class__, e, sys.exc_info()[-1])
+
+  def compile(self):
+    if isinstance(self.code, list):
+      code = self.load_cache()
+      if code is None:
+        start = time.time()
+        self.src = self.generate()
+        code = self.compile_source(self.src)
+        self.compile_time = time.time() - start
+        self.save_cache(code)
+      self.code = code
     return self.code
 
+  def compile_stream(self):
+    if self.stream_code is None:
+      self.stream_src = self.generate(True)
+      self.stream_code = self.compile_source(self.stream_src)
+    return self.stream_code
+
+  def create_context(self, vars, streaming = False, flush_size = None):
+    """Returns a RenderContext object with a new namespace."""
+    namespace = self.template_globals.copy()
+    if vars:
+      namespace.update(vars)
+    context = RenderContext(namespace, streaming, flush_size)
+    namespace["__context"] = context
+    return context
+
   def render(self, vars = None):
-    vars = vars or {}
-    vars.update(self.template_globals)
+    """Renders the template. ``vars`` are laid over the template globals and are not modified."""
+    context = self.create_context(vars)
+    namespace = context.namespace
+    local = RenderContext.local
+    previous = getattr(local, "context", None)
+    local.context = context
+    try:
+      if self.function is not None:
+        function = types.FunctionType(self.function.__code__, namespace)
+        return EmbpyString(u_("").join(function(namespace["u_"], namespace.get("__filter"), context)))
+      try:
+        exec_function(self.compile(), namespace, namespace)
+      except Exception as e:
+        self.reraise_with_source(e, self.src)
+    finally:
+      local.context = previous
+    return EmbpyString(u_("").join(context.buffer))
+
+  def stream(self, vars = None, flush_size = 8192):
+    """Renders the template as a generator which yields chunks of the output.
+
+    A chunk is yielded whenever ``flush_size`` characters are buffered and
+    at ``<% flush() %>`` statements in the template. If ``flush_size`` is None,
+    chunks are yielded only at ``<% flush() %>`` statements and the end.
+
+    Markup in captures and cache blocks is not flushed until the block ends, and 
+    templates which use layouts are flushed only while their layouts are streamed,
+    so that a ``<% flush() %>`` after the head of a layout sends the head first.
+    Functions defined in templates only buffer their output, which is flushed by their callers.
+    """
+    context = self.create_context(vars, True, flush_size)
+    namespace = context.namespace
+    if self.stream_function is not None:
+      generator = types.FunctionType(self.stream_function.__code__, namespace)(flush_size, context)
+      for chunk in self.iter_context(generator, context):
+        yield chunk
+      return
+    exec_function(self.compile_stream(), namespace, namespace)
+    generator = namespace["__stream"](flush_size, context)
     try:
-      exec_function(self.compile(), vars, vars)
+      for chunk in self.iter_context(generator, context):
+        yield chunk
     except Exception as e:
-      if self.src and not isinstance(e, SyntaxError):
-        m = re.match(".*line (\d+).*", traceback.format_exc().splitlines()[-2])
-        if m:
-          line =  int(m.group(1))
-          buf = [e.args[0]]
-          start = max(line-5, 0)
-          for i, v in enumerate(self.src.splitlines()[start:line+5]):
-            buf.append(u_("%04d : %s")%(start+i+1, v))
-          e.message = u_("\n").join(buf)
-          e.args = [e.message]
-      reraise(e.__class__, e, sys.exc_info()[-1])
-    return EmbpyString(u_("").join(vars["__buffer"]))
+      self.reraise_with_source(e, self.stream_src)
+
+  def iter_context(self, generator, context):
+    # other templates may be rendered while the generator is suspended,
+    # so the context is activated only while the generator runs.
+    while True:
+      previous = context.activate()
+      try:
+        chunk = next(generator)
+      except StopIteration:
+        return
+      finally:
+        RenderContext.local.context = previous
+      if chunk:
+        yield chunk
+
+  def reraise_with_source(self, e, src):
+    if src and not isinstance(e, SyntaxError):
+      m = re.match(".*line (\d+).*", traceback.format_exc().splitlines()[-2])
+      if m:
+        line =  int(m.group(1))
+        buf = [e.args[0]]
+        start = max(line-5, 0)
+        for i, v in enumerate(src.splitlines()[start:line+5]):
+          buf.append(u_("%04d : %s")%(start+i+1, v))
+        e.message = u_("\n").join(buf)
+        e.args = [e.message]
+    reraise(e.__class__, e, sys.exc_info()[-1])
+
+  def flush_point(self):
+    # functions defined in templates only append to the buffer, since a yield makes them generators
+    if self.streaming and not self.definitions:
+      self.do_indent()
+      self.code.append(u_("if __flush_size and __size[0] >= __flush_size and not __context.holds: yield __flush()"))
 
   def append(self, s):
     if not s:
       return
     self.do_indent()
     self.code.append(u_("__buffer_append(u_(\"\"\"%s\"\"\"))")%s)
+    self.flush_point()
 
   def do_indent(self, *a):
     self.code.append(u_("\n%s")%(u_("  ")*self.indent))
@@ -1715,7 +3091,7 @@ class Embpy(object):
       line_striped = line.lstrip()
       if self.BLOCK_START_PAT.match(line_striped):
         self.code.append(line_striped)
-        self.indent += 1
+        self.start_block()
       else:
         self.code.append(line_striped)
       self.do_indent()
@@ -1724,13 +3100,25 @@ class Embpy(object):
   def string(self, s):  self.code.append(s)
   def newline(self, s): self.do_indent()
 
-  def indent_start(self, s):
+  def start_block(self):
+    line = []
+    for v in reversed(self.code):
+      if v.startswith("\n"):
+        break
+      line.insert(0, v)
     self.indent += 1
+    if self.DEFINITION_PAT.match(u_("").join(line)):
+      self.definitions.append(self.indent)
+
+  def indent_start(self, s):
     self.code.append(u_(":"))
+    self.start_block()
     self.do_indent()
 
   def indent_end(self, s):
     self.indent -= 1
+    while self.definitions and self.definitions[-1] > self.indent:
+      self.definitions.pop()
     self.do_indent()
 
   def block_keyword(self, s):
@@ -1741,16 +3129,16 @@ class Embpy(object):
 # }}}
 
 class Helper(object): # {{{
-  """ """
-  buffer_search_limit = 10
+  """Template helpers which are available as ``h`` in templates.
 
-  def _buffer_frame_locals(self):
-    for i in range(2, self.buffer_search_limit):
-      f = sys._getframe(i).f_locals
-      if "__buffer" in f:
-        return f
-  buffer_frame_locals = property(_buffer_frame_locals)
-  get_buffer_frame_locals = classmethod(_buffer_frame_locals)
+  :Attributes:
+      context
+          RenderContext object of the template being rendered in the current thread, or None.
+  """
+  def __init__(self, renderer = None):
+    self.renderer = renderer
+
+  context = property(lambda self: getattr(RenderContext.local, "context", None))
 
   @contextlib.contextmanager
   def capture(self, name):
@@ -1764,41 +3152,94 @@ class Helper(object): # {{{
         <%=r header %>
 
     """
-    locals = self.buffer_frame_locals
-    start_index = len(locals["__buffer"])
-    yield 
-    locals.update({name:EmbpyString(u_("").join(locals["__buffer"][start_index:]))})
-    del locals["__buffer"][start_index:]
+    context = self.context
+    start_index = len(context.buffer)
+    context.holds += 1
+    try:
+      yield 
+    finally:
+      context.holds -= 1
+    context.namespace[name] = EmbpyString(u_("").join(context.buffer[start_index:]))
+    del context.buffer[start_index:]
+
+  def cache(self, key, ttl = None):
+    """ Caches a block of markup in the fragment cache of the renderer.
+    The block is executed only if ``key`` is not cached.
+
+    example::
+
+        <% for _ in h.cache("sidebar", 60): %>
+          <%= renderer.sidebar() %>
+        <% end %>
+
+    Cached blocks can be removed by ``Renderer.invalidate``.
+    """
+    context = self.context
+    cache = self.renderer and self.renderer.fragment_cache
+    value = cache.get(key) if cache is not None else None
+    if value is not None:
+      context.append(value)
+      return
+    start_index = len(context.buffer)
+    context.holds += 1
+    try:
+      yield
+    finally:
+      context.holds -= 1
+    if cache is not None:
+      cache.set(key, EmbpyString(u_("").join(context.buffer[start_index:])), ttl)
 
   def concat(self, value):
     """ Adds ``value`` to the output buffer. """
-    self.buffer_frame_locals["__buffer_append"](value)
+    self.context.append(value)
 
   def captured(self, value):
-    return self.buffer_frame_locals[value]
+    return self.context.namespace[value]
 
-  @classmethod
-  def htmlquote(*a): 
-    """ Escapes HTML tag characters."""
-    text = a[-1]
-    return escape_html(text)
+  htmlquote = staticmethod(escape_html)
 # }}}
 
 class Renderer(object): # {{{
-  """ """
+  """Renders template files in ``template_dir``.
+
+  :Attributes:
+      embpy_cache
+          Dictionary which maps template file paths to compiled Embpy objects, so that names of the same file,
+          such as "index" and "index.html", share an Embpy object.
+          A lock for each template is taken only while the template is loaded.
+      template_files
+          Dictionary which maps template names to tuples returned by ``Renderer.find_template``.
+      reload_interval
+          Seconds between checks for modified templates, or None to never check.
+          Each check stats the loaded templates once, and modified templates are loaded again at the next render.
+          Templates which include other templates by ``renderer`` are not affected, since they are looked up at each render.
+      fragment_cache
+          LRUCache object which stores markup cached by ``Renderer.render_cached`` and ``Helper.cache``.
+      package
+          Name of the package generated by ``Renderer.precompile``, or None.
+          Templates are rendered by functions in the package instead of being compiled at the first request.
+          Modules generated from other versions of the templates are ignored.
+  """
   extensions = [".html", ".xml", ".js", ".epy", ".pyhtml"]
-  def __init__(self, template_dir, cache_dir, template_globals = None, filter = None, encoding = "utf8"):
+  def __init__(self, template_dir, cache_dir, template_globals = None, filter = None, encoding = "utf8", package = None, reload_interval = None,
+               fragment_cache_size = 256):
     self.template_dir = template_dir
     self.cache_dir    = cache_dir
     self.template_globals = template_globals or {}
     self.filter = filter
     self.encoding = encoding
+    self.package = package
+    self.reload_interval = reload_interval
+    self.fragment_cache = LRUCache(fragment_cache_size)
     self.embpy_cache = {}
-    self.lock = threading.Lock()
+    self.template_files = {}
+    self.template_stats = {}
+    self.checked_at = time.time()
+    self.locks = {}
 
   def set_template_globals(self, dct):
     self._template_globals = {
-      "h": Helper()
+      "h": Helper(self)
     }
     self._template_globals.update(dct)
     self._template_globals["renderer"] = self
@@ -1820,35 +3261,221 @@ class Renderer(object): # {{{
     
     ``Renderer.index(vars, encoding)`` is same as ``Renderer.render_file("index", vars, encoding).``
     """
+    return self.get_embpy(name, encoding).render(vars)
+
+  def stream_file(self, name, vars = None, flush_size = 8192, encoding = None):
+    """Renders the template file as a generator which yields chunks of the output.
+    An action can return the generator to send the output while it is rendered.
+
+    See ``Embpy.stream`` for further details.
+    """
+    return self.get_embpy(name, encoding).stream(vars, flush_size)
+
+  def get_embpy(self, name, encoding = None):
+    """Returns a compiled Embpy object for the template ``name``."""
+    if self.reload_interval is not None:
+      now = time.time()
+      if now - self.checked_at >= self.reload_interval:
+        self.checked_at = now
+        self.check_templates()
+    files = self.template_files.get(name, None)
+    template, file_name = files or self.find_template(name)
+    embpy = self.embpy_cache.get(template, None)
+    if embpy is None:
+      with self.locks.setdefault(template, threading.Lock()):
+        embpy = self.embpy_cache.get(template, None)
+        if embpy is None:
+          with open(template, "rb") as io:
+            st = os.fstat(io.fileno())
+            embpy = self.create_embpy(io, file_name, encoding=encoding or self.encoding)
+          module = self.find_module(file_name)
+          if module is None or not embpy.load_module(module):
+            embpy.compile()
+          self.template_stats[template] = (st.st_mtime, st.st_size)
+          self.embpy_cache[template] = embpy
+    if files is None:
+      self.template_files[name] = (template, file_name)
+    return embpy
+
+  def check_templates(self):
+    """Removes templates modified or deleted after they were loaded from ``embpy_cache``.
+    Returns a list of the removed template names.
+    """
+    removed = []
+    for template, stat in list(iter_items(self.template_stats)):
+      try:
+        st = os.stat(template)
+        current = (st.st_mtime, st.st_size)
+      except OSError:
+        current = None
+      if current != stat:
+        names = [name for name, files in list(iter_items(self.template_files)) if files[0] == template]
+        self.template_stats.pop(template, None)
+        self.embpy_cache.pop(template, None)
+        self.reload(names)
+        removed.extend(names)
+    return removed
+
+  def reload(self, names = None):
+    """Removes templates from ``embpy_cache`` so that they are loaded again at the next render.
+    If ``names`` is None, all templates are removed. This method can be called from a signal handler::
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: app.renderer.reload())
+
+    ``fragment_cache`` is replaced with an empty one, since cached markup may be rendered by the old templates.
+    This method does not acquire any locks, so that a signal handler never waits for the interrupted thread.
+    """
+    if names is None:
+      self.template_files = {}
+      self.template_stats = {}
+      self.embpy_cache = {}
+    for name in (names or []):
+      template = self.template_files.pop(name, (None,))[0]
+      self.template_stats.pop(template, None)
+      self.embpy_cache.pop(template, None)
+    self.fragment_cache = LRUCache(self.fragment_cache.maxsize)
+
+  def render_cached(self, name, vars = None, key = None, ttl = None, encoding = None):
+    """Renders the template file and stores the output in ``fragment_cache`` as ``key``.
+    If ``key`` is None, the template name is used. The template is rendered only if ``key`` is not cached::
+
+        <%= renderer.render_cached("sidebar", {"user": user}, "sidebar:%d"%user.id, 60) %>
+    """
+    key = name if key is None else key
+    value = self.fragment_cache.get(key)
+    if value is None:
+      value = self.render_file(name, vars, encoding)
+      self.fragment_cache.set(key, value, ttl)
+    return value
+
+  def invalidate(self, prefix = ""):
+    """Removes markup whose keys start with ``prefix`` from ``fragment_cache``.
+    Returns the number of removed items.
+    """
+    return self.fragment_cache.delete_prefix(prefix)
+
+  def find_template(self, name):
+    """Returns a tuple of the template file path for ``name`` and its file name."""
     template = os.path.join(self.template_dir, name)
     if not "." in name:
       for i in self.extensions:
-        template_cand = template+i
-        if os.path.exists(template_cand):
-          template = template_cand
-          name = name+i
-    with self.lock:
-      embpy = self.embpy_cache.get(template, None)
-      if not embpy:
-        embpy = self.create_embpy(open(template, "rb"), name, encoding=encoding or self.encoding)
-        self.embpy_cache[template] = embpy
-    return embpy.render(vars or {})
+        if os.path.exists(template+i):
+          return template+i, name+i
+    return template, name
+
+  def template_names(self):
+    """Returns names of all files in ``template_dir`` which have one of ``Renderer.extensions``."""
+    names = []
+    for dir, dirs, files in os.walk(self.template_dir):
+      dirs.sort()
+      for file in sorted(files):
+        if os.path.splitext(file)[1] in self.extensions:
+          path = os.path.join(dir, file)
+          names.append(os.path.relpath(path, self.template_dir).replace(os.path.sep, "/"))
+    return names
+
+  def prewarm(self, names = None, encoding = None):
+    """Compiles templates and writes them to ``cache_dir`` before the first request.
+    If ``names`` is None, all templates returned by ``template_names`` are compiled.
+
+    Returns a list of tuples of the template name and its Embpy object.
+    """
+    if names is None:
+      names = self.template_names()
+    if self.cache_dir and not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    return [(name, self.get_embpy(name, encoding)) for name in names]
+
+  @staticmethod
+  def module_name(file_name):
+    """Returns a module name for the template ``file_name``."""
+    return "t_" + re.sub(r"\W", "_", file_name)
+
+  def find_module(self, file_name):
+    """Returns the module generated from the template ``file_name`` in ``package``, or None."""
+    if not self.package:
+      return None
+    package = importlib.import_module(self.package)
+    module_name = getattr(package, "TEMPLATES", {}).get(file_name, None)
+    if module_name is None:
+      return None
+    return importlib.import_module(self.package + "." + module_name)
+
+  def precompile(self, path, names = None, encoding = None):
+    """Generates a python package in ``path`` which contains a module for each template.
+    If ``names`` is None, all templates returned by ``template_names`` are compiled.
+    The package is used when its name is set to ``package``.
+
+    Returns a list of tuples of the template file name and the module name.
+    """
+    if names is None:
+      names = self.template_names()
+    modules = [self.write_module(path, name, encoding) for name in names]
+    self.write_package(path, modules)
+    return modules
+
+  def write_module(self, path, name, encoding = None):
+    """Writes a module generated from the template ``name`` and its byte code to ``path``.
+    Returns a tuple of the template file name and the module name.
+    """
+    template, file_name = self.find_template(name)
+    with open(template, "rb") as io:
+      embpy = self.create_embpy(io, file_name, encoding=encoding or self.encoding)
+    src = embpy.module_source()
+    embpy.compile_source(src)
+    module_name = self.module_name(file_name)
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    module_path = os.path.join(path, module_name + ".py")
+    with open(module_path, "wb") as io:
+      io.write(b_("#vim: fileencoding=utf8\n") + src.encode("utf8"))
+    py_compile.compile(module_path, doraise = True)
+    return file_name, module_name
+
+  def write_package(self, path, modules):
+    """Writes ``__init__.py`` which maps template file names to the modules written by ``write_module``."""
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    init_path = os.path.join(path, "__init__.py")
+    with open(init_path, "wb") as io:
+      io.write(b_("# Generated by rays. Do not edit.\nTEMPLATES = {\n"))
+      for file_name, module_name in modules:
+        io.write(b_("  %r: %r,\n"%(n_(file_name), n_(module_name))))
+      io.write(b_("}\n"))
+    py_compile.compile(init_path, doraise = True)
   render = render_file
 
+  def with_layout(self, method, context):
+    """Moves markup rendered in ``context`` to ``body`` and returns a function which renders a layout by ``method``.
+    Templates call this method as ``renderer.with_layout_file(name)``.
+
+    In streamed templates, the layout is streamed after the template if the renderer has
+    a streaming version of ``method``, such as ``stream_file``.
+    """
+    body = EmbpyString(u_("").join(context.buffer))
+    del context.buffer[:]
+    vars = context.namespace
+    vars["body"] = body
+    stream_method = "stream" + method[len("render"):]
+    if context.streaming and hasattr(self, stream_method):
+      def _(t, *a, **k):
+        context.layout = getattr(self, stream_method)(t, vars, context.flush_size, *a, **k)
+        return EmbpyString(u_(""))
+      return _
+    return lambda t, *a, **k: getattr(self, method)(t, vars, *a, **k)
+
   def __getattr__(self, name):
     if name.startswith("with_layout"):
-      method = "render%s"%name[len("with_layout"):]
-      locals = Helper.get_buffer_frame_locals()
-      body = EmbpyString(u_("").join(locals["__buffer"]))
-      locals["__buffer"][:] = []
-      locals["body"] = body
-      return lambda t, *a, **k: getattr(self, method)(t, locals, *a, **k)
+      context = RenderContext.current()
+      if context is None:
+        raise AttributeError("'%s' is available only in templates."%name)
+      return self.with_layout("render%s"%name[len("with_layout"):], context)
     else:
       return lambda *a, **k: self.render_file(name, *a, **k)
 
   def render_string(self, template, vars = None):
     """Renders the template string."""
-    return self.create_embpy(template).render(vars or {})
+    return self.create_embpy(template).render(vars)
 # }}}
 
 # Extensions {{{
@@ -2604,14 +4231,57 @@ class StaticFileExtension(Extension): # {{{
        - path : str, such as "/home/www/app/statics"
        - cache : Integer, a cache expiry in secounds. default: 86400*365(a year)
                  Does not cache if the ``chache`` is negative.
+       - revalidate : Number, seconds to trust cached file metadata before the file is stat'ed again. default: 2
+       - metadata_cache_size : Integer, maximum number of files whose metadata are cached. default: 1024
+       - precompressed : List of content codings. If a client accepts one of them and a sibling
+                         file with the suffix in ``ENCODING_SUFFIXES`` (such as "app.js.gz") exists,
+                         the sibling is sent instead. default: ["br", "gzip"]
+       - compress : Boolean, compresses files whose type matches ``compress_types`` with gzip
+                    and caches them in memory. default: False
+       - compress_types : List of mimetype prefixes to be compressed.
+       - compress_min_size : Integer, minimum size of files to be compressed. default: 1KB
+       - compress_max_size : Integer, maximum size of files to be compressed. default: 1MB
+       - compressed_cache_size : Integer, maximum number of compressed files kept in memory. default: 64
+       - fingerprint : Boolean, builds a manifest of content hashes at startup and 
+                       ``app.url.static_file`` returns fingerprinted paths such as "app.0123456789ab.js".
+                       Fingerprinted paths are served with immutable cache headers. 
+                       Call ``build_manifest()`` if files are changed. default: False
+
+  :Attributes:
+      metadata
+          rays.LRUCache object which maps absolute paths to rays.FileMetadata objects.
+      revalidations
+          Number of cached metadata which have been checked against the file system.
+      compressed
+          rays.LRUCache object which maps (absolute path, ETag) to gzip compressed bytes.
+      manifest
+          Dictionary which maps paths to fingerprinted paths.
   """
-  def __init__(self, app, url, path, cache = 86400*365):
+  ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+  COMPRESS_TYPES = ["text/", "application/javascript", "application/json", 
+                    "application/xml", "image/svg+xml"]
+
+  def __init__(self, app, url, path, cache = 86400*365, revalidate = 2, metadata_cache_size = 1024,
+               precompressed = ("br", "gzip"), compress = False, compress_types = None,
+               compress_min_size = 1024, compress_max_size = 1024*1024, compressed_cache_size = 64,
+               fingerprint = False):
     Extension.__init__(self, app)
     self.url  = url
     self.path = path
     self.cache = cache
+    self.revalidate = revalidate
+    self.metadata = LRUCache(metadata_cache_size)
+    self.revalidations = 0
+    self.precompressed = list(precompressed or [])
+    self.compress = compress
+    self.compress_types = tuple(compress_types or self.COMPRESS_TYPES)
+    self.compress_min_size = compress_min_size
+    self.compress_max_size = compress_max_size
+    self.compressed = LRUCache(compressed_cache_size)
+    self.fingerprint = fingerprint
+    self.manifest = {}
+    self.fingerprints = {}
     self.hashes = {}
-    self.lock = threading.Lock()
     self.app.add_hook("before_initialize",
                       self.on_before_initialize,
                       name = "StaticFileExtension", pos="first")
@@ -2631,21 +4301,124 @@ class StaticFileExtension(Extension): # {{{
       hasher.update(b_(stat.st_size))
     return hasher.hexdigest()[:16]
 
+  def get_metadata(self, abs_path):
+    """Returns a rays.FileMetadata object for ``abs_path``.
+    Cached metadata are returned without any system calls until the ``revalidate`` interval expires.
+    """
+    metadata = self.metadata.get(abs_path)
+    now = time.time()
+    if metadata is not None:
+      if now - metadata.checked_at < self.revalidate:
+        return metadata
+      stats = os.stat(abs_path)
+      self.revalidations += 1
+      if stat.S_ISREG(stats.st_mode) and not metadata.is_modified(stats):
+        metadata.variants = self.find_variants(metadata)
+        metadata.checked_at = now
+        return metadata
+      self.metadata.delete(abs_path)
+    metadata = FileMetadata.from_path(abs_path)
+    metadata.variants = self.find_variants(metadata)
+    self.metadata.set(abs_path, metadata)
+    return metadata
+
+  def find_variants(self, metadata):
+    """Returns a dictionary of precompressed files which are not older than the ``metadata`` file."""
+    variants = {}
+    for encoding in self.precompressed:
+      try:
+        variant = FileMetadata.from_path(metadata.path + self.ENCODING_SUFFIXES[encoding])
+      except (IOError, OSError):
+        continue
+      if variant.mtime >= metadata.mtime:
+        variants[encoding] = variant
+    return variants
+
+  def accepted_encodings(self):
+    """Returns a list of content codings which the client accepts, in order of preference."""
+    if "HTTP_ACCEPT_ENCODING" not in self.app.req.env:
+      return []
+    return self.app.req.accept_encoding.preferred(self.precompressed + ["gzip"])
+
+  def is_compressible(self, metadata):
+    return (self.compress and metadata.mimetype is not None and 
+            self.compress_min_size <= metadata.size <= self.compress_max_size and 
+            metadata.mimetype.startswith(self.compress_types))
+
+  def get_compressed(self, metadata):
+    """Returns gzip compressed bytes of the ``metadata`` file, or None if compression does not reduce the size."""
+    key = (metadata.path, metadata.etag)
+    data = self.compressed.get(key)
+    if data is None:
+      with open(metadata.path, "rb") as io:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(io.read()) + compressor.flush()
+      if len(data) >= metadata.size:
+        data = False
+      self.compressed.set(key, data)
+    return data or None
+
+  def stats(self):
+    """Returns a dictionary object with the metadata cache statistics."""
+    result = self.metadata.stats()
+    result["revalidations"] = self.revalidations
+    return result
+
   def calc_hash(self, abs_path):
-    with self.lock:
-      if not abs_path in self.hashes:
-        self.hashes[abs_path] = self.hash_func(abs_path)
-    return self.hashes.get(abs_path, None)
+    hash = self.hashes.get(abs_path, None)
+    if hash is None:
+      hash = self.hashes[abs_path] = self.hash_func(abs_path)
+    return hash
+
+  def content_hash(self, abs_path):
+    """Returns a hash of the ``abs_path`` file contents."""
+    hasher = sha1()
+    with open(abs_path, "rb") as io:
+      for data in iter(lambda: io.read(65536), b""):
+        hasher.update(data)
+    return hasher.hexdigest()[:12]
+
+  def build_manifest(self):
+    """Scans the static directory and builds a manifest of fingerprinted paths."""
+    manifest = {}
+    for dir_path, dir_names, file_names in os.walk(self.path):
+      names = set(file_names)
+      for name in file_names:
+        base, ext = os.path.splitext(name)
+        if ext in self.ENCODING_SUFFIXES.values() and base in names:
+          continue
+        abs_path = os.path.join(dir_path, name)
+        path = os.path.relpath(abs_path, self.path).replace(os.sep, "/")
+        root, ext = os.path.splitext(path)
+        manifest[path] = "%s.%s%s"%(root, self.content_hash(abs_path), ext)
+    self.fingerprints = dict((v, k) for k, v in iter_items(manifest))
+    self.manifest = manifest
+    return manifest
 
   def on_before_initialize(self):
     self.hashes = {}
+    self.metadata.clear()
+    self.compressed.clear()
+    self.revalidations = 0
+    if self.fingerprint:
+      self.build_manifest()
 
     @self.app.get(self.url+"(str:.*)")
     def static_file(*a):
       path = self.app.req.params[-1]
+      fingerprinted = path in self.fingerprints
+      if fingerprinted:
+        path = self.fingerprints[path]
       abs_path = self.get_normalized_abs_path(path)
-
-      if self.cache > -1:
+      try:
+        metadata = self.get_metadata(abs_path)
+      except (IOError, OSError):
+        self.app.res.notfound()
+
+      if fingerprinted:
+        self.app.res.set_header("Expires", datetime.utcnow() + timedelta(days=365))
+        self.app.res.set_header("Cache-Control", "public, max-age=31536000, immutable")
+      elif self.cache > -1:
         self.app.res.set_header("Expires", datetime.utcnow() + \
                                    timedelta(seconds=self.cache))
         self.app.res.set_header("Cache-Control", "max-age=" + u_(self.cache))
@@ -2655,25 +4428,465 @@ class StaticFileExtension(Extension): # {{{
       if_modified_since = self.app.req.env.get("HTTP_IF_MODIFIED_SINCE", None)
       if if_modified_since:
         ims_d = parse_http_date_string(if_modified_since)
-        mt_d  = datetime(*(tuple(time.gmtime(os.stat(abs_path).st_mtime))[:6]))
+        mt_d  = datetime(*(tuple(time.gmtime(metadata.mtime))[:6]))
         if ims_d >= mt_d:
           self.app.res.not_modified()
 
-      self.app.res.send_file(abs_path)
+      res = self.app.res
+      compressible = self.is_compressible(metadata)
+      if metadata.variants or compressible:
+        res.set_header("Vary", "Accept-Encoding")
+        for encoding in self.accepted_encodings():
+          variant = metadata.variants.get(encoding, None)
+          if variant is not None:
+            res.content_type = metadata.mimetype or "application/octet-stream"
+            res.set_header("Content-Encoding", encoding)
+            res.send_file(variant.path, guess_mimetype = False, 
+                          range = self.app.req.env.get("HTTP_RANGE", None),
+                          if_range = self.app.req.env.get("HTTP_IF_RANGE", None),
+                          metadata = variant)
+          if encoding == "gzip" and compressible:
+            data = self.get_compressed(metadata)
+            if data is not None:
+              res.content_type = metadata.mimetype
+              res.set_header("Content-Encoding", "gzip")
+              res.set_header("Content-Length", len(data))
+              res.set_header("Last-Modified", metadata.last_modified)
+              res.set_header("Etag", metadata.etag[:-1] + '-gzip"')
+              return_response(data)
+
+      res.send_file(abs_path, range = self.app.req.env.get("HTTP_RANGE", None),
+                    if_range = self.app.req.env.get("HTTP_IF_RANGE", None),
+                    metadata = metadata)
 
   def on_after_initialize(self):
     old_url = self.app.get_url_builder("static_file")
-    def new_url(path, _query=None):
+    def new_url(path, _query=None, **kw):
+      fingerprinted = self.manifest.get(path, None)
+      if fingerprinted is not None:
+        return old_url(fingerprinted, _query=_query, **kw)
       if self.cache > -1:
         hash = self.calc_hash(self.get_normalized_abs_path(path))
         if hash:
-          return old_url(path, _query=hash)
-      return old_url(path)
+          return old_url(path, _query=hash, **kw)
+      return old_url(path, **kw)
     del self.app.url_cache["static_file"]
     self.app.url_cache["static_file"] = new_url
 
 #}}}
 
+class CompressedContent(object): # {{{
+  """An iterable response content which compresses another iterable content."""
+  def __init__(self, iterable, compressor):
+    self.iterable = iterable
+    self.compressor = compressor
+
+  def __iter__(self):
+    compress, flush = self.compressor.compress, self.compressor.flush
+    for data in self.iterable:
+      # flushes every chunk, so that streamed contents reach clients without delay
+      data = compress(data) + flush(zlib.Z_SYNC_FLUSH)
+      if data:
+        yield data
+    yield flush()
+
+  def close(self):
+    getattr(self.iterable, "close", lambda: None)()
+# }}}
+
+class CompressionExtension(Extension): # {{{
+  """Response compression extension.
+
+  Compresses responses with gzip or deflate if the client accepts them.
+  String contents are compressed at once and their 'Content-Length' is updated,
+  other contents, such as files and generators, are compressed while they are sent.
+
+  :Available configuration parameters:
+       - level : Integer, compression level from 1(fastest) to 9(smallest). default: 6
+       - min_size : Integer, minimum size of string contents to be compressed. default: 512
+       - types : List of content type prefixes to be compressed. default: ``StaticFileExtension.COMPRESS_TYPES``
+       - encodings : List of content codings in order of preference. default: ["gzip", "deflate"]
+  """
+  WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+  def __init__(self, app, level = 6, min_size = 512, types = None, encodings = ("gzip", "deflate")):
+    Extension.__init__(self, app)
+    self.level = level
+    self.min_size = min_size
+    self.types = tuple(types or StaticFileExtension.COMPRESS_TYPES)
+    self.encodings = list(encodings)
+    self.app.add_hook("before_dispatch",
+                      self.on_before_dispatch,
+                      name = "CompressionExtension", pos="last")
+    self.app.add_hook("before_start_response",
+                      self.on_before_start_response,
+                      name = "CompressionExtension", pos="last")
+
+  def create_compressor(self, encoding):
+    return zlib.compressobj(self.level, zlib.DEFLATED, self.WBITS[encoding])
+
+  def is_compressible(self, res):
+    if not (200 <= res.status_code < 300) or res.status_code in (204, 206):
+      return False
+    if res.get_header("Content-Encoding"):
+      return False
+    content_type = res.content_type
+    return bool(content_type) and content_type.startswith(self.types)
+
+  def compressed_etag(self, etag, encoding):
+    """Returns the ETag of the ``encoding`` compressed content. Only strong ETags get the content coding, 
+    weak ETags are shared by all encodings."""
+    if etag and etag.endswith('"') and not etag.startswith("W/"):
+      return '%s-%s"'%(etag[:-1], encoding)
+    return etag
+
+  def on_before_dispatch(self, *a):
+    # ETags of compressed contents, such as '"abc-gzip"', also validate the uncompressed ETag '"abc"'
+    req = self.app.req
+    if "HTTP_IF_NONE_MATCH" not in req.env:
+      return
+    etags = set(req.if_none_match)
+    for etag in req.if_none_match:
+      for encoding in self.encodings:
+        if etag.endswith('-%s"'%encoding):
+          etags.add(etag[:-len(encoding)-2] + '"')
+    req.if_none_match = frozenset(etags)
+
+  def on_not_modified(self, req, res):
+    # keeps the ETag which has been sent with the compressed content
+    etag = res.get_header("Etag")
+    if not etag or "HTTP_ACCEPT_ENCODING" not in req.env:
+      return
+    for encoding in req.accept_encoding.preferred(self.encodings)[:1]:
+      compressed = self.compressed_etag(etag, encoding)
+      if compressed != etag and compressed in req.if_none_match:
+        res.set_header("Etag", compressed)
+
+  def on_before_start_response(self, *a):
+    req, res = self.app.req, self.app.res
+    if res.status_code == 304:
+      self.on_not_modified(req, res)
+      return
+    if req.method == "head" or not self.is_compressible(res):
+      return
+    content = res.iterable_content
+    if isinstance(content, list) and sum(len(v) for v in content) < self.min_size:
+      return
+
+    vary = res.get_header("Vary")
+    if not vary:
+      res.set_header("Vary", "Accept-Encoding")
+    elif "accept-encoding" not in vary.lower():
+      res.set_header("Vary", vary + ", Accept-Encoding")
+
+    if "HTTP_ACCEPT_ENCODING" not in req.env:
+      return
+    encodings = req.accept_encoding.preferred(self.encodings)
+    if not encodings:
+      return
+    compressor = self.create_compressor(encodings[0])
+    res.set_header("Content-Encoding", encodings[0])
+    etag = res.get_header("Etag")
+    if etag:
+      res.set_header("Etag", self.compressed_etag(etag, encodings[0]))
+    if isinstance(content, list):
+      data = compressor.compress(b"".join(content)) + compressor.flush()
+      res.set_header("Content-Length", len(data))
+      res.iterable_content = [data]
+    else:
+      res.del_header("Content-Length")
+      res.iterable_content = CompressedContent(content, compressor)
+#}}}
+
+class ResponseCacheExtension(Extension): # {{{
+  """Whole-page response cache extension.
+
+  ``app.ext.response_cache(...)`` returns a filter which caches status codes, headers and 
+  contents of GET actions, so that cached pages are sent without running the action.
+  Requests with cookies, responses which set cookies or have non empty sessions are not cached,
+  so that pages are never shared between sessions.
+  While a missing entry is computed, other requests for the same page wait for it
+  instead of running the action at the same time.
+
+      >>> with app.filter(app.ext.response_cache(ttl=60, headers=["Accept-Language"])):
+      ...   @app.get("news")
+      ...   def news():
+      ...     return app.renderer.render_file("news", {"items": load_news()})
+
+  :Available configuration parameters:
+       - store : str or class, ``"Memory"`` or ``"Sqlite"``. default ``"Memory"``
+       - ttl : Number, default time to live of cached responses in seconds. default: 60
+       - wait : Number, maximum seconds to wait for a response computed by another request. default: 10
+       - maxsize : Integer, maximum number of cached responses. default: 1024
+       - path : str, a sqlite3 database file name(``"Sqlite"`` store only)
+
+  :Attributes:
+      store
+          rays.ResponseCacheStoreBase object
+      pending
+          Dictionary which maps keys of responses being computed to threading.Event objects.
+  """
+  def __init__(self, app, store = None, ttl = 60, wait = 10):
+    Extension.__init__(self, app)
+    self.store = store or MemoryResponseCacheStore(app)
+    self.ttl = ttl
+    self.wait = wait
+    self.pending = {}
+    self.lock = threading.Lock()
+
+  @classmethod
+  def app_config(cls, app, dct):
+    store_config = dict((k,v) for k,v in iter_items(dct) if k not in ("ttl", "wait"))
+    config = dict((k,v) for k,v in iter_items(dct) if k in ("ttl", "wait"))
+    store_type = store_config.pop("store", "Memory")
+    if isinstance(store_type, string_types):
+      store_class = eval("%sResponseCacheStore"%store_type)
+    else:
+      store_class = store_type
+    store_config["app"] = app
+    config["store"] = store_class(**store_config)
+    config["app"] = app
+    return cls(**config)
+
+  def __call__(self, ttl = None, headers = (), query = True, key = None, statuses = (200,), session_cookies = None):
+    """Returns a filter which caches responses.
+
+    :Parameters:
+        ttl
+            Time to live in seconds, default is the ``ttl`` configuration parameter.
+        headers
+            List of request header names, such as ["Accept-Language"], whose values are part of the cache key.
+        query
+            If True, query strings are part of the cache key.
+        key
+            Function which takes a rays.Request object and returns a cache key string.
+            Cache keys start with the request path, followed by the URL scheme and the host by default.
+        statuses
+            Status codes of responses to be cached.
+        session_cookies
+            List of cookie names. Requests with one of them are not cached.
+            If None, requests with any cookie are not cached.
+    """
+    ttl = self.ttl if ttl is None else ttl
+    key = key or (lambda req: self.create_key(req, headers, query))
+    def response_cache(*a, **kw):
+      req = self.app.req
+      if req.method != "get" or self.has_session(req, session_cookies):
+        yield
+        return
+      cache_key = key(req)
+      entry = self.store.get(cache_key)
+      acquired = False
+      if entry is None:
+        event = self.acquire(cache_key)
+        acquired = event is None
+        if not acquired:
+          event.wait(self.wait)
+          entry = self.store.get(cache_key)
+      if entry is not None:
+        self.send(entry)
+      try:
+        yield
+        self.save(cache_key, ttl, statuses)
+      finally:
+        if acquired:
+          self.release(cache_key)
+    return response_cache
+
+  def acquire(self, key):
+    """Marks the ``key`` as being computed by the current request.
+    Returns a threading.Event object to wait for if another request is computing the ``key``, otherwise None.
+    """
+    with self.lock:
+      if key in self.pending:
+        return self.pending[key]
+      self.pending[key] = threading.Event()
+
+  def release(self, key):
+    """Wakes up requests waiting for the ``key``. Filters release keys when actions finish, even if they have failed."""
+    with self.lock:
+      self.pending.pop(key).set()
+
+  def create_key(self, req, headers = (), query = True):
+    """Returns a cache key for the ``req``.
+    Pages may contain absolute URLs, so the URL scheme and the host are part of the key.
+    """
+    parts = [req.path, req.env.get("wsgi.url_scheme", ""), req.env.get("HTTP_HOST", "")]
+    if query:
+      parts.append(req.env.get("QUERY_STRING", ""))
+    for name in headers:
+      parts.append(req.env.get("HTTP_"+name.upper().replace("-", "_"), ""))
+    return "\n".join(parts)
+
+  def has_session(self, req, session_cookies = None):
+    if "HTTP_COOKIE" not in req.env:
+      return False
+    if session_cookies is None:
+      return True
+    return any(name in req.cookies for name in session_cookies)
+
+  def is_cacheable(self, res, statuses):
+    if res.status_code not in statuses or not isinstance(res.content, string_types):
+      return False
+    if "Set-Cookie" in res._headers or getattr(self.app, "session", None):
+      return False
+    cache_control = res.get_header("Cache-Control") or ""
+    return "no-store" not in cache_control and "private" not in cache_control
+
+  def save(self, key, ttl, statuses):
+    """Saves the current response if it is cacheable."""
+    res = self.app.res
+    if self.is_cacheable(res, statuses):
+      self.store.set(key, (res.status_code, res._headers.items(), res.content), ttl)
+
+  def send(self, entry):
+    """Sends the cached ``entry`` to the client immediately."""
+    status_code, headers, content = entry
+    self.app.res.status_code = status_code
+    self.app.res._headers = HeaderDict(headers)
+    return_response(content)
+
+  def invalidate(self, prefix = ""):
+    """Removes cached responses whose keys start with the ``prefix``, such as a path. 
+    Returns the number of removed responses.
+    """
+    return self.store.delete_prefix(prefix)
+# }}}
+
+class ResponseCacheStoreBase(object): # {{{
+  """Base class of response cache stores. Cached responses are tuples of (status code, headers, content)."""
+
+  def __init__(self, app, maxsize = 1024):
+    self.app = app
+    self.maxsize = maxsize
+
+  def get(self, key):
+    """Returns the response for the ``key``, or None if it is missing or expired."""
+    raise NotImplementedError()
+
+  def set(self, key, entry, ttl = None):
+    """Saves the response ``entry`` for ``ttl`` seconds, discarding the least recently used responses if the store is full."""
+    raise NotImplementedError()
+
+  def delete(self, key):
+    """Deletes the response for the ``key``."""
+    raise NotImplementedError()
+
+  def delete_prefix(self, prefix):
+    """Deletes responses whose keys start with the ``prefix``. Returns the number of deleted responses."""
+    raise NotImplementedError()
+
+  def clear(self):
+    """Deletes all responses."""
+    raise NotImplementedError()
+
+  def count(self):
+    """Returns the number of responses."""
+    raise NotImplementedError()
+# }}}
+
+class MemoryResponseCacheStore(ResponseCacheStoreBase): # {{{
+  """Implements a ``ResponseCacheStoreBase`` with a rays.LRUCache object."""
+
+  def __init__(self, *a, **kw):
+    super(MemoryResponseCacheStore, self).__init__(*a, **kw)
+    self.cache = LRUCache(self.maxsize)
+
+  def get(self, key):
+    return self.cache.get(key)
+
+  def set(self, key, entry, ttl = None):
+    self.cache.set(key, entry, ttl)
+
+  def delete(self, key):
+    self.cache.delete(key)
+
+  def delete_prefix(self, prefix):
+    return self.cache.delete_prefix(prefix)
+
+  def clear(self):
+    self.cache.clear()
+
+  def count(self):
+    return len(self.cache)
+# }}}
+
+class SqliteResponseCacheStore(ResponseCacheStoreBase): # {{{
+  """Implements a sqlite3 database file based ``ResponseCacheStoreBase``.
+  Processes which use the same database file share cached responses.
+
+  Access times, which decide the least recently used responses, are updated
+  at most once per ``ACCESS_RESOLUTION`` seconds.
+  """
+  ACCESS_RESOLUTION = 1
+
+  SCHEMA="""
+    CREATE TABLE IF NOT EXISTS rays_response_cache (
+      key         TEXT PRIMARY KEY NOT NULL,
+      entry       BLOB NOT NULL,
+      expires_at  REAL,
+      accessed_at REAL NOT NULL
+    );
+  """
+  INDEX="""
+    CREATE INDEX IF NOT EXISTS rays_response_cache_accessed_at_idx ON rays_response_cache(accessed_at);
+  """
+
+  def __init__(self, path, *a, **kw):
+    global sqlite3
+    import sqlite3
+    super(SqliteResponseCacheStore, self).__init__(*a, **kw)
+    self.path = path
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    # cached responses can be lost without harm, so skips syncing for every write.
+    self.connection.execute("PRAGMA synchronous = OFF")
+    self.connection.execute(self.SCHEMA)
+    self.connection.execute(self.INDEX)
+
+  def execute(self, sql, values = ()):
+    with self.lock:
+      return self.connection.execute(sql, values).fetchall()
+
+  def get(self, key):
+    now = time.time()
+    rows = self.execute("SELECT entry, expires_at, accessed_at FROM rays_response_cache WHERE key = ?", [key])
+    if not rows:
+      return None
+    entry, expires_at, accessed_at = rows[0]
+    if expires_at is not None and expires_at <= now:
+      self.delete(key)
+      return None
+    if now - accessed_at > self.ACCESS_RESOLUTION:
+      self.execute("UPDATE rays_response_cache SET accessed_at = ? WHERE key = ?", [now, key])
+    return pickle.loads(bytes(entry))
+
+  def set(self, key, entry, ttl = None):
+    now = time.time()
+    data = sqlite3.Binary(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+    with self.lock:
+      self.connection.execute("INSERT OR REPLACE INTO rays_response_cache VALUES (?, ?, ?, ?)",
+                              [key, data, ttl is not None and now + ttl or None, now])
+      excess = self.connection.execute("SELECT count(*) FROM rays_response_cache").fetchone()[0] - max(self.maxsize, 0)
+      if excess > 0:
+        self.connection.execute("""DELETE FROM rays_response_cache WHERE key IN (
+            SELECT key FROM rays_response_cache ORDER BY accessed_at LIMIT ?)""", [excess])
+
+  def delete(self, key):
+    self.execute("DELETE FROM rays_response_cache WHERE key = ?", [key])
+
+  def delete_prefix(self, prefix):
+    with self.lock:
+      return self.connection.execute("DELETE FROM rays_response_cache WHERE substr(key, 1, ?) = ?", 
+                                     [len(prefix), prefix]).rowcount
+
+  def clear(self):
+    self.execute("DELETE FROM rays_response_cache")
+
+  def count(self):
+    return self.execute("SELECT count(*) FROM rays_response_cache")[0][0]
+# }}}
+
 class AsyncExtension(Extension): # {{{
   """Asynchronous request extension(requires gevent, greenlet).
 
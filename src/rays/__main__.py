@@ -0,0 +1,78 @@
+#vim: fileencoding=utf8
+"""Command line tools for rays.
+
+Usage::
+
+    python -m rays prewarm TEMPLATE_DIR CACHE_DIR [--encoding ENCODING] [--no-filter]
+    python -m rays compile TEMPLATE_DIR PACKAGE_DIR [--encoding ENCODING] [--no-filter]
+"""
+from __future__ import division, print_function
+import sys
+from rays import Renderer, Helper
+
+def create_renderer(cmd_args, cache_dir = None):
+  filter = None if cmd_args.no_filter else Helper.htmlquote
+  return Renderer(cmd_args.template_dir, cache_dir, filter = filter, encoding = cmd_args.encoding)
+
+def prewarm(cmd_args):
+  renderer = create_renderer(cmd_args, cmd_args.cache_dir)
+  failures = 0
+  print("%-40s %8s %10s" % ("template", "status", "time(msec)"))
+  for name in renderer.template_names():
+    try:
+      _, embpy = renderer.prewarm([name])[0]
+    except Exception as e:
+      failures += 1
+      print("%-40s %8s %s" % (name, "error", e))
+      continue
+    if embpy.compile_time is not None:
+      status, t = "compiled", embpy.compile_time
+    else:
+      status, t = "loaded", embpy.load_time or 0.0
+    print("%-40s %8s %10.2f" % (name, status, t*1e3))
+  return failures and 1 or 0
+
+def compile_templates(cmd_args):
+  renderer = create_renderer(cmd_args)
+  modules = []
+  failures = 0
+  print("%-40s %8s %s" % ("template", "status", "module"))
+  for name in renderer.template_names():
+    try:
+      modules.append(renderer.write_module(cmd_args.package_dir, name))
+    except Exception as e:
+      failures += 1
+      print("%-40s %8s %s" % (name, "error", e))
+      continue
+    print("%-40s %8s %s" % (name, "compiled", modules[-1][1]))
+  renderer.write_package(cmd_args.package_dir, modules)
+  return failures and 1 or 0
+
+def main(sys_argv = None):
+  import argparse
+  parser = argparse.ArgumentParser(prog = "python -m rays")
+  subparsers = parser.add_subparsers(dest = "command")
+  p = subparsers.add_parser("prewarm", help = "compiles templates into the cache directory.")
+  p.add_argument("template_dir", help = "template directory.")
+  p.add_argument("cache_dir", help = "cache directory.")
+  p.add_argument("--encoding", default = "utf8",
+                 help = "template encoding(default: %(default)s)")
+  p.add_argument("--no-filter", action = "store_true",
+                 help = "compiles templates for a renderer without the html escaping filter.")
+  p.set_defaults(func = prewarm)
+  p = subparsers.add_parser("compile", help = "compiles templates into a python package.")
+  p.add_argument("template_dir", help = "template directory.")
+  p.add_argument("package_dir", help = "package directory.")
+  p.add_argument("--encoding", default = "utf8",
+                 help = "template encoding(default: %(default)s)")
+  p.add_argument("--no-filter", action = "store_true",
+                 help = "compiles templates for a renderer without the html escaping filter.")
+  p.set_defaults(func = compile_templates)
+  cmd_args = parser.parse_args(sys.argv[1:] if sys_argv is None else sys_argv)
+  if not getattr(cmd_args, "func", None):
+    parser.print_help()
+    return 1
+  return cmd_args.func(cmd_args)
+
+if __name__ == "__main__":
+  sys.exit(main())
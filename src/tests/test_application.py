@@ -428,6 +428,25 @@ class TestApplication(Base):
     assert "https://localhost/get/10/str/9" == app.url.get(10, "str", 9)
     assert "http://localhost/get/10/str/9?query" == app.url.get(10, "str", 9, _query="query", _ssl=False)
 
+  def test_url_builder_relative(self):
+    app = self.app
+    @app.get("get/(int:\d+)/(str:[^/]+)")
+    def get():
+      return "ok"
+    @app.get("static")
+    def static():
+      return "ok"
+    self.finish_app_config()
+
+    assert "/get/10/a%20b" == app.url.get(10, "a b", _relative=True)
+    assert "/get/10/a-b.c_d~/e" == app.url.get(10, "a-b.c_d~/e", _relative=True)
+    assert "/static?q=1" == app.url.static(_relative=True, _query="q=1")
+    assert isinstance(app.get_url_builder("get"), UrlBuilder)
+
+    app.config("relative_url", True)
+    assert "/get/10/str" == app.url.get(10, "str")
+    assert "http://localhost/get/10/str" == app.url.get(10, "str", _relative=False, _ssl=False)
+
   def test_handle_exception_with_debugging(self):
     app = self.app
     @app.get("get1")
@@ -503,6 +522,9 @@ class TestApplication(Base):
     @app.get("get3")
     def get3():
       return u_("ユニコード")
+    @app.get("get4")
+    def get4():
+      return (v for v in [u_("a"), u_(""), b"b", u_("ド")])
     def wrapper(v):
       return [b"wrapped"]
     self.finish_app_config()
@@ -516,6 +538,69 @@ class TestApplication(Base):
     response = self.browser.get(self.url("get3"))
     assert u_("ユニコード").encode("utf8") in response.body
 
+    # every chunk of generators is bytes, including empty strings
+    body = app({"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "REQUEST_METHOD": "GET", "PATH_INFO": self.url("get4")},
+               lambda status, headers: None)
+    assert [b"a", b"", b"b", u_("ド").encode("utf8")] == list(body)
+
+  def test_auto_etag(self):
+    app = self.app
+    app.config("auto_etag", True)
+    @app.get("get1")
+    def get1():
+      return u_("ユニコード")
+    @app.get("get2")
+    def get2():
+      app.res.set_header("Etag", '"v1"')
+      return "get2"
+    @app.get("get3")
+    def get3():
+      return BytesIO(b"io")
+    @app.post("post1")
+    def post1():
+      return "post1"
+    self.finish_app_config()
+
+    response = self.browser.get(self.url("get1"))
+    etag = response.headers["Etag"]
+    assert etag.startswith('W/"')
+    response = self.browser.get(self.url("get1"), extra_environ={"HTTP_IF_NONE_MATCH": '"x", ' + etag})
+    assert "304 Not Modified" == response.status
+    assert b"" == response.body
+    assert etag == response.headers["Etag"]
+    assert "Content-Type" not in response.headers
+
+    response = self.browser.get(self.url("get2"), extra_environ={"HTTP_IF_NONE_MATCH": '"v1"'})
+    assert "304 Not Modified" == response.status
+    response = self.browser.get(self.url("get2"), extra_environ={"HTTP_IF_NONE_MATCH": '"v0"'})
+    assert b"get2" == response.body
+
+    response = self.browser.get(self.url("get3"), extra_environ={"HTTP_IF_NONE_MATCH": '*'})
+    assert b"io" == response.body
+    assert "Etag" not in response.headers
+    response = self.browser.post(self.url("post1"), extra_environ={"HTTP_IF_NONE_MATCH": '*'})
+    assert b"post1" == response.body
+
+  def test_etag_filter(self):
+    app = self.app
+    calls = []
+    @app.apply_filter(app.etag(lambda id: id < 10 and id or None))
+    @app.get("get1/(int:[0-9]+)")
+    def get1(id):
+      calls.append(id)
+      return "get1"
+    self.finish_app_config()
+
+    response = self.browser.get(self.url("get1", 1))
+    assert 'W/"1"' == response.headers["Etag"]
+    response = self.browser.get(self.url("get1", 1), extra_environ={"HTTP_IF_NONE_MATCH": 'W/"1"'})
+    assert "304 Not Modified" == response.status
+    response = self.browser.get(self.url("get1", 2), extra_environ={"HTTP_IF_NONE_MATCH": 'W/"1"'})
+    assert b"get1" == response.body
+    response = self.browser.get(self.url("get1", 10), extra_environ={"HTTP_IF_NONE_MATCH": '*'})
+    assert "Etag" not in response.headers
+    assert [1, 2, 10] == calls
+
   def test_javascript_url_builder(self):
     app = self.app
     @app.get("get1/(int:\d+)")
@@ -0,0 +1,118 @@
+#vim fileencoding=utf8
+from __future__ import division, print_function
+
+import sys, zlib
+import rays
+from rays.compat import *
+from .base import *
+import_BytesIO()
+
+class TestCompressionExtension(Base):
+  def setup_method(self, method):
+    Base.setup_method(self, method)
+    self.app.config("CompressionExtension", {"min_size": 100})
+    app = self.app
+
+    @app.get("html")
+    def html():
+      return "<p>hello</p>" * 100
+
+    @app.get("small")
+    def small():
+      return "<p>hello</p>"
+
+    @app.get("stream")
+    def stream():
+      return BytesIO(b"".join(b_("<p>%d</p>"%i) for i in range(100)))
+
+    @app.get("versioned")
+    def versioned():
+      app.validate_etag('"v1"')
+      return "<p>hello</p>" * 100
+
+    @app.get("json")
+    def json():
+      app.res.content_type = "image/png"
+      return "x" * 1000
+    self.finish_app_config()
+
+  def raw_get(self, path, accept_encoding = None, **kw):
+    # webtest decodes compressed bodies, so calls the application directly
+    env = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+           "REQUEST_METHOD": "GET", "PATH_INFO": path}
+    env.update(kw)
+    if accept_encoding is not None:
+      env["HTTP_ACCEPT_ENCODING"] = accept_encoding
+    result = {}
+    def start_response(status, headers):
+      result["status"], result["headers"] = status, dict(headers)
+    body = self.app(env, start_response)
+    result["body"] = b"".join(body)
+    getattr(body, "close", lambda: None)()
+    return result
+
+  def test_gzip(self):
+    response = self.raw_get("/html", "gzip, deflate")
+    assert "gzip" == response["headers"]["Content-Encoding"]
+    assert "Accept-Encoding" == response["headers"]["Vary"]
+    assert int(response["headers"]["Content-Length"]) == len(response["body"])
+    assert b"<p>hello</p>" * 100 == zlib.decompress(response["body"], 16 + zlib.MAX_WBITS)
+
+  def test_deflate(self):
+    response = self.raw_get("/html", "gzip;q=0.5, deflate")
+    assert "deflate" == response["headers"]["Content-Encoding"]
+    assert b"<p>hello</p>" * 100 == zlib.decompress(response["body"])
+
+  def test_not_compressed(self):
+    response = self.raw_get("/html")
+    assert "Content-Encoding" not in response["headers"]
+    assert "Accept-Encoding" == response["headers"]["Vary"]
+    assert b"<p>hello</p>" * 100 == response["body"]
+
+    response = self.raw_get("/html", "identity")
+    assert "Content-Encoding" not in response["headers"]
+
+    response = self.raw_get("/small", "gzip")
+    assert "Content-Encoding" not in response["headers"]
+    assert "Vary" not in response["headers"]
+
+    response = self.raw_get("/json", "gzip")
+    assert "Content-Encoding" not in response["headers"]
+
+  def test_stream(self):
+    response = self.raw_get("/stream", "gzip")
+    assert "gzip" == response["headers"]["Content-Encoding"]
+    assert "Content-Length" not in response["headers"]
+    expected = b"".join(b_("<p>%d</p>"%i) for i in range(100))
+    assert expected == zlib.decompress(response["body"], 16 + zlib.MAX_WBITS)
+
+  def test_decoded_by_client(self):
+    response = self.browser.get("/html", headers = {"Accept-Encoding": "gzip"})
+    assert b"<p>hello</p>" * 100 == response.body
+
+  def test_auto_etag(self):
+    self.app.config("auto_etag", True)
+    response = self.raw_get("/html", "gzip")
+    etag = response["headers"]["Etag"]
+    # weak ETags are shared by all encodings
+    assert etag.startswith('W/"') and not etag.endswith('-gzip"')
+    response = self.raw_get("/html", "gzip", HTTP_IF_NONE_MATCH=etag)
+    assert "304 Not Modified" == response["status"]
+    assert etag == response["headers"]["Etag"]
+    assert b"" == response["body"]
+
+  def test_strong_etag(self):
+    response = self.raw_get("/versioned", "gzip")
+    assert '"v1-gzip"' == response["headers"]["Etag"]
+    response = self.raw_get("/versioned", "gzip", HTTP_IF_NONE_MATCH='"v1-gzip"')
+    assert "304 Not Modified" == response["status"]
+    assert '"v1-gzip"' == response["headers"]["Etag"]
+    # content codings which the extension does not use are not removed
+    response = self.raw_get("/versioned", "gzip", HTTP_IF_NONE_MATCH='"v1-br"')
+    assert "200 OK" == response["status"]
+
+    response = self.raw_get("/versioned")
+    assert '"v1"' == response["headers"]["Etag"]
+    response = self.raw_get("/versioned", HTTP_IF_NONE_MATCH='"v1"')
+    assert "304 Not Modified" == response["status"]
+    assert '"v1"' == response["headers"]["Etag"]
@@ -86,12 +86,19 @@ class TestFunctions(Base):
     with pytest.raises(UnicodeError):
       print(guess_decode(2))
 
+  def test_decode_url_param(self):
+    assert u_("ascii") == decode_url_param("ascii")
+    assert u_("") == decode_url_param(None)
+    assert u_("あああ") == decode_url_param(n_(u_("あああ").encode("utf8")))
+    assert u_("あああ") == decode_url_param(n_(u_("あああ").encode("cp932")))
+
   
   def test_escape_html(self):
     assert u_("&amp;&lt;&gt;&#39;&quot;") == escape_html(u_("&<>'\""))
   
   def test_unescape_html(self):
     assert u_("&<>'\"") == unescape_html(u_("&amp;&lt;&gt;&#39;&quot;"))
+    assert u_("&lt;") == unescape_html(escape_html(u_("&lt;")))
   
   def test_to_http_date_string(self):
     from datetime import datetime
@@ -100,6 +107,18 @@ class TestFunctions(Base):
     assert "Fri, 01 Jan 2010 01:00:00 GMT" == to_http_date_string(date)
     assert "Fri, 01 Jan 2010 01:00:00 GMT" ==  to_http_date_string(date.timetuple())
   
+  def test_parse_range_header(self):
+    assert [(0, 9)] == parse_range_header("bytes=0-9", 100)
+    assert [(90, 99)] == parse_range_header("bytes=90-", 100)
+    assert [(95, 99)] == parse_range_header("bytes=-5", 100)
+    assert [(0, 99)] == parse_range_header("bytes=-500", 100)
+    assert [(0, 0), (50, 99)] == parse_range_header("bytes=0-0, 50-200", 100)
+    assert [] == parse_range_header("bytes=100-", 100)
+    assert None == parse_range_header("bytes=5-1", 100)
+    assert None == parse_range_header("items=0-1", 100)
+    assert None == parse_range_header("bytes=a-b", 100)
+    assert None == parse_range_header("bytes=" + ",".join(["0-1"]*17), 100)
+  
   def test_snake_case(self):
     assert "test_model" == to_snake_case("TestModel")
     assert "test_model" == to_snake_case("TESTModel")
@@ -148,3 +148,44 @@ class TestHookable(Base):
     assert "hook1" == hooks[0].name
     assert "hook3" == hooks[1].name
     assert 2 == len(hooks)
+
+  def test_compile_hooks(self):
+    p = Hookable()
+    assert p.get_hook_runner("test0")() is None
+
+    @p.hook("test0")
+    def test1(v):
+      return v
+
+    runner = p.get_hook_runner("test0")
+    assert runner is p.get_hook_runner("test0")
+    assert [1] == runner(1)
+
+    @p.hook("test0", pos="first")
+    def test2(v):
+      return v * 2
+
+    assert runner is not p.get_hook_runner("test0")
+    assert [2, 1] == p.run_hook("test0", [1])
+
+    p.remove_hook("test0", test2)
+    assert [1] == p.run_hook("test0", [1])
+
+  def test_hook_order(self):
+    p = Hookable()
+    p.add_hook("test0", lambda v: v, name="hook1", pos="last")
+    p.add_hook("test0", lambda v: v, name="hook2", pos="after_hook3")
+    p.add_hook("test0", lambda v: v, name="hook3")
+    p.add_hook("test0", lambda v: v, name="hook4", pos="first")
+    assert ["hook4", "hook3", "hook2", "hook1"] == p.get_hook_order("test0")
+    assert [] == p.get_hook_order("dummy")
+
+  def test_circular_hooks(self):
+    p = Hookable()
+    p.add_hook("test0", lambda v: v, name="hook1", pos="before_hook2")
+    p.add_hook("test0", lambda v: v, name="hook2", pos="before_hook1")
+    p.add_hook("test0", lambda v: v, name="hook3")
+    with pytest.raises(ValueError) as e:
+      p.run_hook("test0", [1])
+    assert "hook1(before_hook2)" in str(e.value)
+    assert "hook3" not in str(e.value)
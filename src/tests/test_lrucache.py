@@ -0,0 +1,61 @@
+#vim: fileencoding=utf8
+from __future__ import division, print_function
+
+import sys
+from rays import *
+from rays.compat import *
+from .base import *
+
+import pytest
+
+class TestLRUCache(Base):
+  def test_get_and_set(self):
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert 1 == cache.get("a")
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert 1 == cache.get("a")
+    assert 3 == cache.get("c")
+    assert None == cache.get("b")
+    assert {"hits": 3, "misses": 1, "size": 2, "maxsize": 2} == cache.stats()
+
+  def test_resize(self):
+    cache = LRUCache(3)
+    for k in "abc":
+      cache.set(k, k)
+    cache.resize(1)
+    assert ["c"] == list(cache.data.keys())
+    cache.resize(0)
+    cache.set("d", "d")
+    assert 0 == len(cache)
+
+  def test_delete_and_clear(self):
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.delete("a")
+    cache.delete("a")
+    assert None == cache.get("a")
+    cache.clear()
+    assert 0 == cache.misses
+
+  def test_ttl(self):
+    cache = LRUCache()
+    cache.set("a", 1, ttl = 60)
+    cache.set("b", 2, ttl = -1)
+    cache.set("c", 3)
+    assert 1 == cache.get("a")
+    assert None == cache.get("b")
+    assert "b" not in cache.expires
+    assert 3 == cache.get("c")
+    cache.set("a", 1)
+    assert "a" not in cache.expires
+
+  def test_delete_prefix(self):
+    cache = LRUCache()
+    for k in ("nav:en", "nav:ja", "footer"):
+      cache.set(k, k, ttl = 60)
+    assert 2 == cache.delete_prefix("nav:")
+    assert ["footer"] == list(cache.data.keys())
+    assert ["footer"] == list(cache.expires.keys())
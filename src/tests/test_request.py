@@ -1,12 +1,14 @@
 #vim fileencoding=utf8
 from __future__ import division, print_function
 
-import sys, codecs
+import sys, codecs, os.path
+import pytest
 import rays
 from rays.compat import *
 from .base import *
 
 import urllib.parse
+import_BytesIO()
 
 class TestRequest(Base):
 
@@ -106,6 +108,45 @@ class TestRequest(Base):
     )
     assert response.body == b"index"
 
+  def test_query_and_form(self):
+    app = self.app
+
+    @app.post("")
+    def index():
+      req = app.req
+      assert "form_pairs" not in req.__dict__
+      assert {"q": u_("クエリ"), "lst": ["1", "2"]} == req.query
+      assert "form_pairs" not in req.__dict__
+      assert {"f": u_("フォーム"), "q": "body"} == req.form
+      assert {"f": u_("フォーム"), "q": u_("クエリ"), "lst": ["1", "2"]} == req.input
+      return "ok"
+    app.config("form_parser", {"method_override_limit": 0})
+    self.finish_app_config()
+
+    url = self.url("index", _query="q=%s&lst=1&lst=2"%urllib.parse.quote(u_("クエリ").encode("utf8")))
+    response = self.browser.post(url, [("f", b_("フォーム")), ("q", b"body")])
+    assert response.body == b"ok"
+
+  def test_method_override(self):
+    app = self.app
+
+    @app.delete("")
+    def index():
+      return app.req.method
+    self.finish_app_config()
+
+    assert b"delete" == self.browser.post(self.url("index", _query="_method=delete")).body
+    assert b"delete" == self.browser.post(self.url("index", _query="_method=put&_method=delete")).body
+    assert b"delete" == self.browser.post(self.url("index"), {"_method": ["put", "delete"]}).body
+    response = self.browser.post(self.url("index", _query="_method[a]=delete"), expect_errors=True)
+    assert response.status.startswith("405")
+    assert b"delete" == self.browser.post(self.url("index"), 
+      headers={"X-HTTP-Method-Override": "DELETE"}).body
+
+    app.form_parser.method_override_limit = 10
+    response = self.browser.post(self.url("index"), {"_method": "delete", "data": "x"*100}, expect_errors=True)
+    assert response.status.startswith("405")
+
   def test_cookie(self):
     app = self.app
 
@@ -420,3 +461,150 @@ class TestRequest(Base):
     response = self.browser.get(self.url("url_2"), 
       extra_environ={"HTTP_ACCEPT_ENCODING": ""})
     assert b"ok2" in response.body
+
+  def test_if_none_match(self):
+    app = self.app
+
+    @app.get("url_1")
+    def url_1():
+      assert app.req.if_none_match == frozenset(['"abc"', '"de,f"', '"ghi-gzip"'])
+      assert app.req.etag_matches('"abc"')
+      assert app.req.etag_matches('W/"abc"')
+      assert app.req.etag_matches('W/"de,f"')
+      assert app.req.etag_matches('W/"ghi-gzip"')
+      assert not app.req.etag_matches('W/"ghi"')
+      assert not app.req.etag_matches('"ab"')
+      return "ok1"
+
+    @app.get("url_2")
+    def url_2():
+      assert app.req.etag_matches('"anything"')
+      return "ok2"
+
+    @app.get("url_3")
+    def url_3():
+      assert not app.req.etag_matches('"anything"')
+      return "ok3"
+    self.finish_app_config()
+
+    response = self.browser.get(self.url("url_1"), 
+      extra_environ={"HTTP_IF_NONE_MATCH": '"abc", W/"de,f",W/"ghi-gzip"'})
+    assert b"ok1" in response.body
+
+    response = self.browser.get(self.url("url_2"), extra_environ={"HTTP_IF_NONE_MATCH": '*'})
+    assert b"ok2" in response.body
+
+    response = self.browser.get(self.url("url_3"))
+    assert b"ok3" in response.body
+
+  def test_header_cache(self):
+    app = self.app
+    accepts = []
+
+    @app.get("url_1")
+    def url_1():
+      accepts.append(app.req.accept)
+      assert app.req.accept.accepts("text", "html").q == 0.7
+      assert app.req.cookies["name"] == "value"
+      app.req.cookies["name"] = "changed"
+      return "ok"
+    self.finish_app_config()
+
+    headers = {"HTTP_ACCEPT": "text/*;q=0.3, text/html;q=0.7", "HTTP_COOKIE": "name=value"}
+    self.browser.get(self.url("url_1"), extra_environ=headers)
+    assert 2 == app.header_cache.misses
+    self.browser.get(self.url("url_1"), extra_environ=headers)
+    assert 2 == app.header_cache.hits
+    assert accepts[0] is accepts[1]
+
+    app.config("header_cache_size", 0)
+    self.browser.get(self.url("url_1"), extra_environ=headers)
+    assert 0 == len(app.header_cache)
+    assert accepts[1] is not accepts[2]
+
+
+class TestFormParser(Base):
+  BOUNDARY = "----boundary"
+
+  def multipart_body(self, parts):
+    buf = []
+    for name, filename, value in parts:
+      buf.append(b_("--%s\r\n"%self.BOUNDARY))
+      if filename:
+        buf.append(b_('Content-Disposition: form-data; name="%s"; filename="%s"\r\n'%(name, filename)))
+        buf.append(b"Content-Type: application/octet-stream\r\n\r\n")
+      else:
+        buf.append(b_('Content-Disposition: form-data; name="%s"\r\n\r\n'%name))
+      buf.append(value)
+      buf.append(b"\r\n")
+    buf.append(b_("--%s--\r\n"%self.BOUNDARY))
+    return b"".join(buf)
+
+  def env(self, body, content_type):
+    return {"wsgi.input": BytesIO(body), "CONTENT_LENGTH": str(len(body)), "CONTENT_TYPE": content_type}
+
+  def multipart_env(self, body):
+    return self.env(body, "multipart/form-data; boundary=%s"%self.BOUNDARY)
+
+  def test_parse_urlencoded(self):
+    parser = rays.FormParser(chunk_size = 3)
+    body = b"a=1&b=%E3%81%82+%E3%81%84&c=&a=2"
+    result = list(parser.parse(self.env(body, "application/x-www-form-urlencoded")))
+    assert [("a", "1"), ("b", u_("あ い")), ("c", ""), ("a", "2")] == result
+
+  def test_parse_multipart(self):
+    data = b"x" * 1000 + b"\r\n--" + b"y" * 1000
+    body = self.multipart_body([("field", None, b_("値")), ("file", "a.bin", data)])
+    for chunk_size in (1, 7, 64, 64*1024):
+      parser = rays.FormParser(chunk_size = chunk_size)
+      result = dict(parser.parse(self.multipart_env(body)))
+      assert u_("値") == result["field"]
+      assert "a.bin" == result["file"].filename
+      assert "application/octet-stream" == result["file"].type
+      assert data == result["file"].value
+      assert len(data) == result["file"].size
+
+  def test_spool_to_sink(self):
+    sinks = []
+    def sink(name, filename, content_type):
+      sinks.append((name, filename, content_type))
+      return BytesIO()
+    data = b"z" * 5000
+    body = self.multipart_body([("small", "small.bin", b"abc"), ("large", "large.bin", data)])
+    parser = rays.FormParser(chunk_size = 512, memory_limit = 1024, sink = sink)
+    result = dict(parser.parse(self.multipart_env(body)))
+    assert [("large", "large.bin", "application/octet-stream")] == sinks
+    assert b"abc" == result["small"].value
+    assert data == result["large"].value
+
+  def test_spool_to_temporary_file(self):
+    data = b"z" * 5000
+    parser = rays.FormParser(chunk_size = 512, memory_limit = 1024)
+    result = dict(parser.parse(self.multipart_env(self.multipart_body([("large", "large.bin", data)]))))
+    assert not isinstance(result["large"].file, BytesIO)
+    assert data == result["large"].value
+
+  def test_limits(self):
+    body = self.multipart_body([("field", None, b"x" * 100)])
+    with pytest.raises(rays.RequestBodyError) as e:
+      list(rays.FormParser(max_content_length = 10).parse(self.multipart_env(body)))
+    assert 413 == e.value.status_code
+    with pytest.raises(rays.RequestBodyError) as e:
+      list(rays.FormParser(max_field_size = 10).parse(self.multipart_env(body)))
+    assert 413 == e.value.status_code
+    with pytest.raises(rays.RequestBodyError) as e:
+      list(rays.FormParser().parse(self.multipart_env(body[:-20])))
+    assert 400 == e.value.status_code
+
+  def test_request_entity_too_large(self):
+    app = self.app
+    app.config("form_parser", {"max_content_length": 10})
+
+    @app.post("")
+    def index():
+      return app.req.input["data"]
+    self.finish_app_config()
+
+    assert b"short" == self.browser.post(self.url("index"), {"data": "short"}).body
+    response = self.browser.post(self.url("index"), {"data": "x" * 100}, expect_errors = True)
+    assert response.status.startswith("413")
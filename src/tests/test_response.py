@@ -54,6 +54,25 @@ class TestResponse(Base):
     res.set_header("X-multiple-header2", "value2", unique=True)
     assert res.get_header("X-multiple-header2") == "value2"
 
+    assert res.get_header("x-MULTIPLE-header2") == "value2"
+    res.del_header("X-MULTIPLE-HEADER1")
+    assert res.get_header("X-multiple-header1") == None
+
+  def test_headers_order(self):
+    res = Response(start_response)
+    res.set_header("Set-Cookie", "a=1", unique=False)
+    res.set_header("X-test", "value")
+    res.set_header("Set-Cookie", "b=1", unique=False)
+    res.set_header("content-type", "text/plain")
+    assert [("Accept-Ranges", "none"), ("Cache-Control", "no-cache"),
+            ("content-type", "text/plain"), ("Set-Cookie", "a=1"),
+            ("Set-Cookie", "b=1"), ("X-test", "value")] == res.headers
+    assert "text/plain" == res.content_type
+
+  def test_status_map(self):
+    for code, message in iter_items(Response.CODE_MAP):
+      assert "%d %s"%(code, message) == Response.STATUS_MAP[code]
+
 
   def test_set_cookie(self):
     res = Response(start_response)
@@ -95,6 +114,7 @@ class TestResponse(Base):
   def test_not_modified(self):
     res = Response(start_response)
     res.set_header("X-custom-header", "value")
+    res.set_header("Etag", '"abc"')
 
     try:
       res.not_modified()
@@ -103,6 +123,8 @@ class TestResponse(Base):
       assert res.status_code == 304
       assert e.thunk == []
       assert res.get_header("X-custom-header") != None
+      assert res.get_header("Etag") == '"abc"'
+      assert res.get_header("Cache-Control") == "no-cache"
       assert res.get_header("Content-type") == None
 
   def test_send_file_not_found(self):
@@ -0,0 +1,220 @@
+#vim fileencoding=utf8
+from __future__ import division, print_function
+
+import sys, os, time, threading
+import rays
+from rays.compat import *
+from .base import *
+
+import pytest
+
+class TestResponseCacheExtension(Base):
+  CONFIG = {}
+
+  def setup_method(self, method):
+    Base.setup_method(self, method)
+    self.app.config("ResponseCacheExtension", self.create_config())
+    app = self.app
+    self.calls = calls = []
+    cache = app.ext.response_cache
+
+    with app.filter(cache()):
+      @app.get("page")
+      def page():
+        calls.append("page")
+        app.res.set_header("X-Test", "value")
+        return "page%d"%len(calls)
+
+      @app.get("missing")
+      def missing():
+        calls.append("missing")
+        app.res.notfound()
+
+      @app.get("cookie")
+      def cookie():
+        calls.append("cookie")
+        app.res.set_cookie("name", "value")
+        return "cookie"
+
+      @app.get("slow")
+      def slow():
+        calls.append("slow")
+        time.sleep(0.2)
+        return "slow"
+
+      @app.get("error")
+      def error():
+        calls.append("error")
+        raise ValueError("error")
+
+      @app.get("assertion")
+      def assertion():
+        calls.append("assertion")
+        assert False
+
+    @app.apply_filter(cache(headers=["Accept-Language"], query=False, session_cookies=["session_id"]))
+    @app.get("lang")
+    def lang():
+      calls.append("lang")
+      return app.req.env.get("HTTP_ACCEPT_LANGUAGE", "")
+
+    @app.apply_filter(cache(ttl=0.2))
+    @app.get("short")
+    def short():
+      calls.append("short")
+      return "short"
+    self.finish_app_config()
+
+  def teardown_method(self, method):
+    self.app.ext.response_cache.store.clear()
+
+  def create_config(self):
+    return dict(self.CONFIG)
+
+  def raw_get(self, path, query = "", **env):
+    environ = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+               "REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query}
+    environ.update(env)
+    result = {}
+    def start_response(status, headers):
+      result["status"], result["headers"] = status, dict(headers)
+    body = self.app(environ, start_response)
+    result["body"] = b"".join(body)
+    return result
+
+  def test_cache(self):
+    first = self.raw_get("/page")
+    second = self.raw_get("/page")
+    assert ["page"] == self.calls
+    assert b"page1" == first["body"] == second["body"]
+    assert first["status"] == second["status"] == "200 OK"
+    assert "value" == second["headers"]["X-Test"]
+    assert first["headers"] == second["headers"]
+    assert 1 == self.app.ext.response_cache.store.count()
+
+    assert b"page2" == self.raw_get("/page", "a=1")["body"]
+    assert b"page2" == self.raw_get("/page", "a=1")["body"]
+    assert 2 == self.calls.count("page")
+
+  def test_not_cached(self):
+    assert "404 Not Found" == self.raw_get("/missing")["status"]
+    self.raw_get("/missing")
+    assert 2 == self.calls.count("missing")
+    assert {} == self.app.ext.response_cache.pending
+
+    assert "Set-Cookie" in self.raw_get("/cookie")["headers"]
+    self.raw_get("/cookie")
+    assert 2 == self.calls.count("cookie")
+
+    self.raw_get("/page", HTTP_COOKIE="name=value")
+    self.raw_get("/page", HTTP_COOKIE="name=value")
+    assert 2 == self.calls.count("page")
+    assert 0 == self.app.ext.response_cache.store.count()
+
+  def test_key(self):
+    assert b"ja" == self.raw_get("/lang", HTTP_ACCEPT_LANGUAGE="ja")["body"]
+    assert b"en" == self.raw_get("/lang", HTTP_ACCEPT_LANGUAGE="en")["body"]
+    assert b"ja" == self.raw_get("/lang", "a=1", HTTP_ACCEPT_LANGUAGE="ja")["body"]
+    self.raw_get("/lang", HTTP_ACCEPT_LANGUAGE="en", HTTP_COOKIE="name=value")
+    assert 2 == self.calls.count("lang")
+    self.raw_get("/lang", HTTP_ACCEPT_LANGUAGE="en", HTTP_COOKIE="session_id=value")
+    assert 3 == self.calls.count("lang")
+
+    # pages may contain absolute URLs
+    self.raw_get("/page")
+    self.raw_get("/page", **{"wsgi.url_scheme": "https", "SERVER_PORT": "443"})
+    self.raw_get("/page", HTTP_HOST="example.com")
+    self.raw_get("/page")
+    assert 3 == self.calls.count("page")
+
+  def test_ttl(self):
+    self.raw_get("/short")
+    self.raw_get("/short")
+    assert 1 == self.calls.count("short")
+    time.sleep(0.3)
+    self.raw_get("/short")
+    assert 2 == self.calls.count("short")
+
+  def test_invalidate(self):
+    self.raw_get("/page")
+    self.raw_get("/page", "a=1")
+    self.raw_get("/short")
+    assert 2 == self.app.ext.response_cache.invalidate("/page")
+    self.raw_get("/page")
+    self.raw_get("/short")
+    assert 3 == self.calls.count("page")
+    assert 1 == self.calls.count("short")
+
+  def test_stampede(self):
+    results = []
+    def worker():
+      results.append(self.raw_get("/slow")["body"])
+    threads = [threading.Thread(target=worker) for i in range(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert [b"slow"]*5 == results
+    assert ["slow"] == self.calls
+    assert {} == self.app.ext.response_cache.pending
+
+  def test_failed_action(self):
+    extension = self.app.ext.response_cache
+    extension.wait = 1
+    assert "500 Internal Server Error" == self.raw_get("/error")["status"]
+    assert {} == extension.pending
+    with pytest.raises(AssertionError):
+      self.raw_get("/assertion")
+    assert {} == extension.pending
+    assert None == self.app({"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "REQUEST_METHOD": "GET",
+                             "PATH_INFO": "/page", "QUERY_STRING": "b=1"}, None)
+    assert {} == extension.pending
+
+    # later requests do not wait for failed ones
+    start = time.time()
+    self.raw_get("/error")
+    with pytest.raises(AssertionError):
+      self.raw_get("/assertion")
+    assert time.time() - start < 0.5
+    assert ["error", "assertion", "page", "error", "assertion"] == self.calls
+
+  def test_lru(self):
+    store = self.app.ext.response_cache.store
+    store.maxsize = 2
+    store.ACCESS_RESOLUTION = 0
+    if hasattr(store, "cache"):
+      store.cache.resize(2)
+    self.raw_get("/page", "a=1")
+    self.raw_get("/page", "a=2")
+    time.sleep(0.01)
+    self.raw_get("/page", "a=1")
+    self.raw_get("/page", "a=3")
+    assert 2 == store.count()
+    self.raw_get("/page", "a=1")
+    self.raw_get("/page", "a=2")
+    assert ["page"]*4 == self.calls
+
+class TestSqliteResponseCacheStore(TestResponseCacheExtension):
+  DB_FILE = os.path.join(Base.TEST_DIR, "response_cache.db")
+
+  def create_config(self):
+    self.try_removing_file(self.DB_FILE)
+    return {"store": "Sqlite", "path": self.DB_FILE, "maxsize": 100}
+
+  def teardown_method(self, method):
+    self.app.ext.response_cache.store.connection.close()
+    self.try_removing_file(self.DB_FILE)
+
+  def test_shared(self):
+    self.raw_get("/page")
+    store = rays.SqliteResponseCacheStore(self.DB_FILE, self.app)
+    status_code, headers, content = store.get("/page\nhttp\nlocalhost\n")
+    assert 200 == status_code
+    assert "page1" == content
+    assert ("X-Test", "value") in headers
+    store.connection.close()
+
+  def test_index(self):
+    store = self.app.ext.response_cache.store
+    plan = store.execute("EXPLAIN QUERY PLAN SELECT key FROM rays_response_cache ORDER BY accessed_at LIMIT 1")
+    assert "rays_response_cache_accessed_at_idx" in str(plan)
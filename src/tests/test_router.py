@@ -0,0 +1,140 @@
+#vim: fileencoding=utf8
+from __future__ import division, print_function
+
+import sys, uuid
+from rays import *
+from rays.compat import *
+from .base import *
+
+import pytest
+
+class TestRouter(Base):
+  def test_static_segments(self):
+    assert ["", "member"] == Router.static_segments("/member/(int:\d+)")
+    assert ["", "about"] == Router.static_segments("/about")
+    assert [""] == Router.static_segments("/index\.html")
+    assert ["", "a"] == Router.static_segments("/a/b/?")
+    assert [""] == Router.static_segments("/a/?")
+    assert [] == Router.static_segments("/a/b|/c/d")
+    assert ["", "a"] == Router.static_segments("/a/(str:b|c)")
+
+  def test_lookup(self):
+    app = self.app
+
+    @app.get("member/(int:\d+)")
+    def show_member(id):
+      return "show"
+
+    @app.post("member/(int:\d+)")
+    def update_member(id):
+      return "update"
+
+    @app.get("member/(str:.*)")
+    def member_fallback(name):
+      return "fallback"
+    self.finish_app_config()
+
+    router = app.router
+    action, m, find = router.lookup("/member/1", "get")
+    assert action is show_member
+    assert ("1",) == m.groups()
+    assert find
+    action, m, find = router.lookup("/member/1", "post")
+    assert action is update_member
+    action, m, find = router.lookup("/member/bob", "get")
+    assert action is member_fallback
+    action, m, find = router.lookup("/member/bob", "post")
+    assert (None, None, True) == (action, m, find)
+    assert (None, None, False) == router.lookup("/unknown/1", "get")
+
+  def test_dispatch_in_definition_order(self):
+    app = self.app
+
+    @app.get("(str:.*)")
+    def catch_all(path):
+      return "catch_all"
+
+    @app.get("member/(int:\d+)")
+    def show_member(id):
+      return "show"
+    self.finish_app_config()
+
+    assert b"catch_all" == self.browser.get("/member/1").body
+
+  def test_add_route_after_initialization(self):
+    self.finish_app_config()
+
+    @self.app.get("later/(int:\d+)")
+    def later(id):
+      return u_(id)
+
+    assert b"10" == self.browser.get("/later/10").body
+    assert self.browser.post("/later/10", expect_errors = True).status.startswith("405")
+
+  def test_static_path(self):
+    assert "/about" == Router.static_path("/about")
+    assert "/index.html" == Router.static_path("/index\.html")
+    assert None == Router.static_path("/member/(int:\d+)")
+    assert None == Router.static_path("/a\d")
+    assert None == Router.static_path("/about/?")
+
+  def test_static_routes(self):
+    app = self.app
+
+    @app.get("about")
+    def about():
+      return "about"
+
+    @app.post("about")
+    def post_about():
+      return "post_about"
+
+    @app.get("(str:.*)")
+    def catch_all(path):
+      return "catch_all"
+
+    @app.get("contact")
+    def contact():
+      return "contact"
+    self.finish_app_config()
+
+    router = app.router
+    assert router.static[("get", "/about")][0] is about
+    assert router.static[("post", "/about")][0] is post_about
+    # shadowed by the catch_all action
+    assert ("get", "/contact") not in router.static
+
+    assert b"about" == self.browser.get("/about").body
+    assert b"post_about" == self.browser.post("/about").body
+    assert b"catch_all" == self.browser.get("/contact").body
+    assert self.browser.put("/about", expect_errors = True).status.startswith("405")
+
+  def test_converters(self):
+    app = self.app
+
+    @app.converter("upper")
+    def upper(s):
+      return s.upper()
+
+    @app.get("convert/(int:\d+)/(float:[\d\.]+)/(uuid:[\w\-]+)/(upper:\w+)/(path:.*)")
+    def convert(i, f, u, name, path):
+      assert 10 == i
+      assert 1.5 == f
+      assert "12345678-1234-5678-1234-567812345678" == str(u)
+      assert "BOB" == name
+      return path
+    self.finish_app_config()
+
+    assert [int, float, uuid.UUID, upper, str] == app.actions_map["convert"].param_types
+    response = self.browser.get("/convert/10/1.5/12345678-1234-5678-1234-567812345678/bob/a/%E3%83%91%E3%82%B9")
+    assert u_("a/パス") == response.body.decode("utf8")
+
+  def test_unregistered_converter(self):
+    app = self.app
+    @app.get("convert/(len:\w+)")
+    def convert(v):
+      return v
+    with pytest.raises(ValueError) as e:
+      self.finish_app_config()
+    assert "'len'" in str(e.value)
+    assert "app.converter('len')" in str(e.value)
@@ -1,12 +1,27 @@
 #vim fileencoding=utf8
 from __future__ import division, print_function
 
-import sys
+import sys, os, time, shutil, tempfile, zlib, mimetypes
+from hashlib import sha1
 import rays
 from rays.compat import *
 from .base import *
 
 class TestStaticFileExtension(Base):
+  def raw_get(self, url, accept_encoding = None):
+    # webtest decodes gzip'ed bodies, so calls the application directly
+    env = {"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "SERVER_PORT": "80",
+           "REQUEST_METHOD": "GET", "PATH_INFO": url.split("?")[0]}
+    if accept_encoding is not None:
+      env["HTTP_ACCEPT_ENCODING"] = accept_encoding
+    result = {}
+    def start_response(status, headers):
+      result["status"], result["headers"] = status, dict(headers)
+    body = self.app(env, start_response)
+    result["body"] = b"".join(body)
+    getattr(body, "close", lambda: None)()
+    return result
+
   def test_path(self):
     self.app.config("StaticFileExtension", {"url":"static/", "path": self.TEST_DIR})
     self.finish_app_config()
@@ -44,6 +59,173 @@ class TestStaticFileExtension(Base):
                  headers = {"If-Modified-Since": "Thu, 01 Mar 2100 00:00:00 +0000"})
     assert response.status.startswith("304")
 
+  def test_range(self):
+    self.app.config("StaticFileExtension", {"url":"static/", "path": self.TEST_DIR})
+    self.finish_app_config()
+    url = self.url("static_file", "content.txt")
+
+    response = self.browser.get(url, headers = {"Range": "bytes=5-11"})
+    assert response.status.startswith("206")
+    assert b"content" == response.body
+    assert "bytes 5-11/15" == response.headers["Content-Range"]
+    assert "bytes" == response.headers["Accept-Ranges"]
+
+    response = self.browser.get(url, headers = {"Range": "bytes=-3"})
+    assert b" \r\n" == response.body
+
+    response = self.browser.get(url, headers = {"Range": "bytes=0-3,5-"})
+    assert response.status.startswith("206")
+    boundary = response.headers["Content-Type"].split("boundary=")[1]
+    assert response.headers["Content-Type"].startswith("multipart/byteranges")
+    assert int(response.headers["Content-Length"]) == len(response.body)
+    assert b"".join([
+      b"--", b_(boundary), b"\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-3/15\r\n\r\ntest\r\n",
+      b"--", b_(boundary), b"\r\nContent-Type: text/plain\r\nContent-Range: bytes 5-14/15\r\n\r\ncontent \r\n\r\n",
+      b"--", b_(boundary), b"--\r\n"]) == response.body
+
+    response = self.browser.get(url, headers = {"Range": "bytes=100-"}, expect_errors = True)
+    assert response.status.startswith("416")
+    assert "bytes */15" == response.headers["Content-Range"]
+
+    response = self.browser.get(url, headers = {"Range": "bytes=0-3", "If-Range": '"outdated"'})
+    assert response.status.startswith("200")
+    assert b"test content \r\n" == response.body
+
+  def test_file_wrapper(self):
+    self.app.config("StaticFileExtension", {"url":"static/", "path": self.TEST_DIR})
+    self.finish_app_config()
+    wrapped = []
+    def wrapper(file, chunk_size = 8192):
+      wrapped.append(chunk_size)
+      return iter(lambda: file.read(chunk_size), b"")
+
+    url = self.url("static_file", "content.txt")
+    self.app.config("file_chunk_size", 4)
+    response = self.browser.get(url, headers = {"Range": "bytes=5-"}, extra_environ = {"wsgi.file_wrapper": wrapper})
+    assert b"content \r\n" == response.body
+    assert [4] == wrapped
+
+    response = self.browser.get(url, headers = {"Range": "bytes=0-3"}, extra_environ = {"wsgi.file_wrapper": wrapper})
+    assert b"test" == response.body
+    assert [4] == wrapped
+
+  def test_metadata_cache(self):
+    path = tempfile.mkdtemp()
+    try:
+      file_path = os.path.join(path, "cached.txt")
+      with open(file_path, "wb") as io:
+        io.write(b"cached")
+      self.app.config("StaticFileExtension", {"url":"static/", "path": path, "revalidate": 60})
+      self.finish_app_config()
+      ext = self.app.ext.static_file
+      url = self.url("static_file", "cached.txt")
+
+      assert b"cached" == self.browser.get(url).body
+      assert b"cached" == self.browser.get(url).body
+      stats = ext.stats()
+      assert 1 == stats["hits"]
+      assert 0 == stats["revalidations"]
+      assert "text/plain" == ext.metadata.get(file_path).mimetype
+
+      # files replaced within the revalidate interval are sent with their current size
+      with open(file_path, "wb") as io:
+        io.write(b"replaced!")
+      response = self.raw_get(url)
+      assert b"replaced!" == response["body"]
+      assert "9" == response["headers"]["Content-Length"]
+      assert 0 == ext.stats()["revalidations"]
+
+      with open(file_path, "wb") as io:
+        io.write(b"modified")
+      ext.revalidate = 0
+      assert b"modified" == self.browser.get(url).body
+      assert 1 == ext.stats()["revalidations"]
+
+      os.remove(file_path)
+      assert self.browser.get(url, expect_errors = True).status.startswith("404")
+    finally:
+      shutil.rmtree(path)
+
+  def test_precompressed(self):
+    path = tempfile.mkdtemp()
+    try:
+      for name, data in [("app.js", b"var a = 1;"), ("app.js.gz", b"gzipped"), ("app.js.br", b"brotli")]:
+        with open(os.path.join(path, name), "wb") as io:
+          io.write(data)
+      self.app.config("StaticFileExtension", {"url":"static/", "path": path})
+      self.finish_app_config()
+      url = self.url("static_file", "app.js")
+
+      response = self.raw_get(url)
+      assert b"var a = 1;" == response["body"]
+      assert "Content-Encoding" not in response["headers"]
+      assert "Accept-Encoding" == response["headers"]["Vary"]
+
+      response = self.raw_get(url, "gzip, br")
+      assert b"brotli" == response["body"]
+      assert "br" == response["headers"]["Content-Encoding"]
+      assert mimetypes.guess_type("app.js")[0] == response["headers"]["Content-type"]
+
+      response = self.raw_get(url, "gzip, br;q=0.5")
+      assert b"gzipped" == response["body"]
+      assert "gzip" == response["headers"]["Content-Encoding"]
+
+      response = self.raw_get(url, "gzip;q=0, deflate")
+      assert b"var a = 1;" == response["body"]
+    finally:
+      shutil.rmtree(path)
+
+  def test_compress(self):
+    self.app.config("StaticFileExtension", {"url":"static/", "path": self.TEST_DIR,
+      "compress": True, "compress_min_size": 100})
+    self.finish_app_config()
+    ext = self.app.ext.static_file
+
+    url = self.url("static_file", "base.py")
+    with open(os.path.join(self.TEST_DIR, "base.py"), "rb") as io:
+      data = io.read()
+    for i in range(2):
+      response = self.raw_get(url, "gzip")
+      assert "gzip" == response["headers"]["Content-Encoding"]
+      assert "Accept-Encoding" == response["headers"]["Vary"]
+      assert int(response["headers"]["Content-Length"]) == len(response["body"]) < len(data)
+      assert data == zlib.decompress(response["body"], 16 + zlib.MAX_WBITS)
+    assert 1 == ext.compressed.hits
+
+    response = self.raw_get(url)
+    assert data == response["body"]
+
+    # too small to be compressed
+    response = self.raw_get(self.url("static_file", "content.txt"), "gzip")
+    assert "Content-Encoding" not in response["headers"]
+    assert "Vary" not in response["headers"]
+
+  def test_fingerprint(self):
+    path = tempfile.mkdtemp()
+    try:
+      os.mkdir(os.path.join(path, "js"))
+      for name, data in [("js/app.js", b"var a = 1;"), ("js/app.js.gz", b"gzipped")]:
+        with open(os.path.join(path, name), "wb") as io:
+          io.write(data)
+      self.app.config("StaticFileExtension", {"url":"static/", "path": path, "fingerprint": True})
+      self.finish_app_config()
+      ext = self.app.ext.static_file
+
+      fingerprinted = "js/app.%s.js"%sha1(b"var a = 1;").hexdigest()[:12]
+      assert {"js/app.js": fingerprinted} == ext.manifest
+      url = self.url("static_file", "js/app.js")
+      assert "/static/" + fingerprinted == url
+
+      response = self.browser.get(url)
+      assert b"var a = 1;" == response.body
+      assert "public, max-age=31536000, immutable" == response.headers["Cache-Control"]
+
+      response = self.browser.get(self.url("static_file", "js/app.js.gz"))
+      assert b"gzipped" == response.body
+      assert response.headers["Cache-Control"].startswith("max-age")
+    finally:
+      shutil.rmtree(path)
+
   def test_mb_content(self):
     self.app.config("StaticFileExtension", {"url":"static/", "path": self.TEST_DIR})
     self.finish_app_config()
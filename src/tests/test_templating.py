@@ -1,7 +1,7 @@
 #vim: fileencoding=utf8
 from __future__ import division, print_function
 
-import sys, os.path, codecs, traceback
+import sys, os.path, codecs, traceback, time
 from rays import *
 from rays.compat import *
 from .base import *
@@ -57,14 +57,61 @@ class TestEmbpy(Base): # {{{
                              "html_values": [u_("<p>value1</p>")]})
     return embpy
 
+  def test_stream(self):
+    embpy = Embpy(codecs.open(self.template("index.html")),
+                  self.cache("index.html"), filter = Helper.htmlquote)
+    vars = {"text_values": [u_("値1"), u_("値2")], "html_values": [u_("<p>value1</p>")]}
+    expected = embpy.render(vars)
+    chunks = list(embpy.stream(vars, flush_size = 1))
+    assert 1 < len(chunks)
+    assert expected == u_("").join(chunks)
+    assert [expected] == list(embpy.stream(vars, flush_size = None))
+
+    embpy = Embpy(u_("<head></head><% flush() %><% for i in range(3): %><p><%= i %></p><% end %>"))
+    assert [u_("<head></head>"), u_("<p>0</p><p>1</p><p>2</p>")] == list(embpy.stream(flush_size = None))
+    assert u_("<head></head><p>0</p><p>1</p><p>2</p>") == embpy.render()
+
+    # functions defined in templates are not generators
+    embpy = Embpy(u_("<% def row(x): %><td><%= x %></td><% end %><% for i in range(2): %><% row(i) %><% end %><% flush() %>END"))
+    assert u_("<td>0</td><td>1</td>END") == embpy.render()
+    assert [u_("<td>0</td><td>1</td>"), u_("END")] == list(embpy.stream(flush_size = 1))
+    embpy = Embpy(u_("<% def row(x) {: %><td><%= x %></td><% flush() %><% :} %><% row(0) %><p>1</p>"))
+    assert [u_("<td>0</td><p>1</p>")] == list(embpy.stream(flush_size = None))
+
+  def test_stream_errors(self):
+    embpy = Embpy(u_("<p><%= value %></p>"))
+    with pytest.raises(NameError):
+      list(embpy.stream())
+
   def test_cache(self):
     embpy = self.test_render_without_filter()
     assert embpy.is_cached()
-    self.test_render_without_filter()
-    data = open(self.template("index.html"), "rb").read()
-    open(self.template("index.html"), "wb").write(data)
-    assert (not embpy.is_cached())
-    self.test_render_without_filter()
+    assert embpy.compile_time is not None
+    embpy = self.test_render_without_filter()
+    assert embpy.compile_time is None
+    assert embpy.load_time is not None
+
+    # cache keys depend on the template contents, not on modification times
+    with open(self.template("index.html"), "rb") as io:
+      data = io.read()
+    with open(self.template("index.html"), "wb") as io:
+      io.write(data)
+    assert Embpy(codecs.open(self.template("index.html")), self.cache("index.html")).is_cached()
+    assert not Embpy(data.decode("utf8") + u_("<p>changed</p>"), self.cache("index.html")).is_cached()
+    assert not Embpy(codecs.open(self.template("index.html")), self.cache("index.html"), 
+                     filter = escape_html).is_cached()
+
+  def test_cache_atomic_write(self):
+    embpy = Embpy(u_("<%= 1 %>"), self.cache("atomic.html"))
+    assert u_("1") == embpy.render()
+    assert [os.path.basename(embpy.cache_path)] == [v for v in os.listdir(self.cache("")) if v.startswith("atomic")]
+    assert not [v for v in os.listdir(self.cache("")) if v.startswith(".embpy")]
+
+    with open(embpy.cache_path, "wb") as io:
+      io.write(b"broken")
+    embpy = Embpy(u_("<%= 1 %>"), self.cache("atomic.html"))
+    assert u_("1") == embpy.render()
+    assert embpy.compile_time is not None
 
   def test_render_with_filter(self):
     def filter(s):
@@ -153,6 +200,245 @@ class TestRendererAndHelper(Base):
 """) == renderer.render_file("index", {"text_values": [u_("値1"), u_("値2")],
                              "html_values": [u_("<p>value1</p>")]})
 
+  def test_render_does_not_modify_vars(self):
+    renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR, template_globals = {"v": "global", "g": "g"})
+    vars = {"v": u_("local")}
+    assert u_("local g") == renderer.render_string(u_("<%= v %> <%= g %>"), vars)
+    assert {"v": u_("local")} == vars
+
+  def test_template_cache(self):
+    renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
+    vars = {"text_values": [], "html_values": []}
+    renderer.render_file("index", vars)
+    template = os.path.join(self.TEMPLATE_DIR, "index.html")
+    embpy = renderer.embpy_cache[template]
+    assert embpy.file_path.endswith("index.html")
+    renderer.render_file("index", vars)
+    assert embpy is renderer.embpy_cache[template]
+    # names of the same file share the compiled template
+    renderer.render_file("index.html", vars)
+    assert embpy is renderer.get_embpy("index.html")
+    assert [template] == list(renderer.embpy_cache.keys())
+    assert (os.path.join(self.TEMPLATE_DIR, "index.html"), "index.html") == renderer.find_template("index")
+
+  def test_prewarm(self):
+    renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
+    names = renderer.template_names()
+    assert "index.html" in names and "layout.html" in names
+    warmed = renderer.prewarm(["index.html", "layout.html"])
+    assert ["index.html", "layout.html"] == [name for name, _ in warmed]
+    assert all(embpy.is_cached() and embpy.compile_time is not None for _, embpy in warmed)
+
+    # another process sharing the cache directory loads the compiled code
+    renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
+    embpy = renderer.get_embpy("index.html")
+    assert embpy.compile_time is None
+    assert embpy.load_time is not None
+
+  def test_prewarm_command(self, capsys):
+    from rays.__main__ import main
+    assert 1 == main(["prewarm", self.TEMPLATE_DIR, self.CACHE_DIR, "--no-filter"])
+    out = capsys.readouterr()[0]
+    assert "index.html" in out and "compiled" in out
+    assert "syntax_error.html" in out and "error" in out
+    renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
+    assert renderer.get_embpy("index.html").compile_time is None
+
+  def test_precompile(self):
+    import tempfile, shutil
+    path = tempfile.mkdtemp()
+    sys.path.insert(0, path)
+    try:
+      renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR, filter = Helper.htmlquote)
+      modules = renderer.precompile(os.path.join(path, "precompiled_templates"),
+                                    ["index", "capture_outputs", "contents", "layout"])
+      assert ("index.html", "t_index_html") == modules[0]
+
+      precompiled = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR, filter = Helper.htmlquote, package = "precompiled_templates")
+      vars = {"text_values": [u_("<値1>")], "html_values": [u_("<p>value1</p>")]}
+      output = precompiled.render_file("index", vars)
+      assert not os.listdir(self.CACHE_DIR)
+      assert renderer.render_file("index", vars) == output
+      embpy = precompiled.get_embpy("index")
+      assert embpy.function is not None
+      assert embpy.compile_time is None
+      assert renderer.render_file("index", vars) == u_("").join(precompiled.stream_file("index", vars, flush_size = 1))
+      assert renderer.capture_outputs({}) == precompiled.capture_outputs({})
+      assert renderer.contents({}) == precompiled.contents({})
+
+      # templates not in the package or modified after the precompilation are compiled as usual
+      assert precompiled.get_embpy("index.xml").function is None
+      stale = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR, package = "precompiled_templates")
+      assert stale.get_embpy("index").function is None
+    finally:
+      sys.path.remove(path)
+      for name in list(sys.modules.keys()):
+        if name.startswith("precompiled_templates"):
+          del sys.modules[name]
+      shutil.rmtree(path)
+
+  def test_precompile_assigned_names(self):
+    import tempfile, shutil
+    path = tempfile.mkdtemp()
+    template_dir = os.path.join(path, "templates")
+    os.makedirs(template_dir)
+    templates = {
+      "titled_layout.html": u_("<title><%= title %></title><%=r body %>"),
+      "titled.html": u_("<% title = 'Hello' %><% for item in items: %><p><%= item %></p><% end %><%= renderer.with_layout_file('titled_layout') %>"),
+    }
+    for name, text in iter_items(templates):
+      with open(os.path.join(template_dir, name), "wb") as io:
+        io.write(text.encode("utf8"))
+    sys.path.insert(0, path)
+    try:
+      renderer = Renderer(template_dir, None, filter = Helper.htmlquote)
+      renderer.precompile(os.path.join(path, "precompiled_assigned"))
+      precompiled = Renderer(template_dir, None, filter = Helper.htmlquote, package = "precompiled_assigned")
+      vars = {"items": [1, 2]}
+      expected = u_("<title>Hello</title><p>1</p><p>2</p>")
+      assert expected == renderer.render_file("titled", vars)
+      assert expected == precompiled.render_file("titled", vars)
+      assert precompiled.get_embpy("titled").function is not None
+      assert expected == u_("").join(renderer.stream_file("titled", vars, flush_size = None))
+      assert expected == u_("").join(precompiled.stream_file("titled", vars, flush_size = None))
+      assert expected == u_("").join(precompiled.stream_file("titled", vars, flush_size = 1))
+      # vars are not modified by assignments in templates
+      assert {"items": [1, 2]} == vars
+    finally:
+      sys.path.remove(path)
+      for name in list(sys.modules.keys()):
+        if name.startswith("precompiled_assigned"):
+          del sys.modules[name]
+      shutil.rmtree(path)
+
+  def test_reload(self):
+    import tempfile, shutil
+    template_dir = tempfile.mkdtemp()
+    def write(text, mtime):
+      path = os.path.join(template_dir, "page.html")
+      with open(path, "wb") as io:
+        io.write(text.encode("utf8"))
+      os.utime(path, (mtime, mtime))
+    try:
+      now = time.time()
+      write(u_("<p>1</p>"), now - 100)
+      renderer = Renderer(template_dir, self.CACHE_DIR, reload_interval = 3600)
+      assert u_("<p>1</p>") == renderer.page()
+      write(u_("<p>2</p>"), now - 50)
+      # not checked until the interval elapses
+      assert u_("<p>1</p>") == renderer.page()
+      assert ["page"] == renderer.check_templates()
+      assert [] == renderer.check_templates()
+      assert u_("<p>2</p>") == renderer.page()
+
+      renderer.reload_interval = 0
+      write(u_("<p>3</p>"), now)
+      assert u_("<p>3</p>") == renderer.page()
+      embpy = renderer.get_embpy("page")
+      assert embpy is renderer.get_embpy("page")
+
+      renderer.reload()
+      assert {} == renderer.embpy_cache
+      assert u_("<p>3</p>") == renderer.page()
+      os.remove(os.path.join(template_dir, "page.html"))
+      assert ["page"] == renderer.check_templates()
+    finally:
+      shutil.rmtree(template_dir)
+
+  def test_fragment_cache(self):
+    import tempfile, shutil
+    template_dir = tempfile.mkdtemp()
+    templates = {
+      "nav.html": u_("<% calls.append(title) %><nav><%= title %></nav>"),
+      "page.html": u_("<% for _ in h.cache(key, 60): %><% calls.append(key) %><b><%= key %></b><% end %>/"),
+    }
+    for name, text in iter_items(templates):
+      with open(os.path.join(template_dir, name), "wb") as io:
+        io.write(text.encode("utf8"))
+    try:
+      renderer = Renderer(template_dir, self.CACHE_DIR, filter = Helper.htmlquote)
+      calls = []
+      assert u_("<nav>&lt;a&gt;</nav>") == renderer.render_cached("nav", {"title": "<a>", "calls": calls}, "nav:en")
+      assert u_("<nav>&lt;a&gt;</nav>") == renderer.render_cached("nav", {"title": "<b>", "calls": calls}, "nav:en")
+      assert u_("<nav>&lt;b&gt;</nav>") == renderer.render_cached("nav", {"title": "<b>", "calls": calls}, "nav:ja")
+      assert ["<a>", "<b>"] == calls
+      # cached markup is not escaped again
+      assert u_("<nav>&lt;a&gt;</nav>") == renderer.render_string(u_("<%= renderer.render_cached('nav', key = 'nav:en') %>"))
+
+      del calls[:]
+      assert u_("<b>k1</b>/") == renderer.page({"key": "k1", "calls": calls})
+      assert u_("<b>k1</b>/") == renderer.page({"key": "k1", "calls": calls})
+      assert u_("<b>k2</b>/") == renderer.page({"key": "k2", "calls": calls})
+      assert ["k1", "k2"] == calls
+
+      # streamed blocks are not flushed while they are executed, so they are stored too
+      assert [u_("<b>k3</b>/")] == list(renderer.stream_file("page", {"key": "k3", "calls": calls}, flush_size = 1))
+      assert u_("<b>k3</b>/") == u_("").join(renderer.stream_file("page", {"key": "k3", "calls": calls}, flush_size = 1))
+      assert u_("<b>k1</b>/") == u_("").join(renderer.stream_file("page", {"key": "k1", "calls": calls}))
+      assert ["k1", "k2", "k3"] == calls
+      assert "k3" in renderer.fragment_cache
+
+      assert 2 == renderer.invalidate("nav:")
+      assert 3 == len(renderer.fragment_cache)
+      renderer.reload()
+      assert 0 == len(renderer.fragment_cache)
+      # reload() does not wait for locks held by an interrupted thread
+      with renderer.fragment_cache.lock:
+        renderer.reload()
+      assert u_("<b>k1</b>/") == renderer.page({"key": "k1", "calls": calls})
+    finally:
+      shutil.rmtree(template_dir)
+
+  def test_fragment_cache_config(self):
+    self.app.config("renderer", {"fragment_cache_size": 1})
+    assert 1 == self.app.renderer.fragment_cache.maxsize
+
+  def test_stream_file(self):
+    app = self.app
+    app.renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
+    vars = {"text_values": [u_("値1"), u_("値2")], "html_values": [u_("<p>value1</p>")]}
+
+    @app.get("stream")
+    def stream():
+      return app.renderer.stream_file("index", vars, flush_size = 1)
+    self.finish_app_config()
+
+    response = self.browser.get("/stream")
+    assert app.renderer.render_file("index", vars).encode("utf8") == response.body
+
+    headers = []
+    body = app({"wsgi.url_scheme": "http", "HTTP_HOST": "localhost", "REQUEST_METHOD": "GET", "PATH_INFO": "/stream"},
+               lambda status, h: headers.extend(h))
+    assert not isinstance(body, list)
+    assert "Content-Length" not in dict(headers)
+    assert 1 < len(list(body))
+
+  def test_stream_with_layouts_and_captures(self):
+    import tempfile, shutil
+    template_dir = tempfile.mkdtemp()
+    templates = {
+      "layout.html": u_("<html><head></head><% flush() %><body>\n<%=r body %></body></html>\n"),
+      "page.html": u_("<% for i in range(3): %>row<%= i %>\n<% end %><% flush() %><%= renderer.with_layout_file('layout') %>after\n"),
+      "captured.html": u_("<% with h.capture('items'): %><% for i in range(5): %>item<%= i %>,<% end %><% end %>[<%=r items %>]\n"),
+    }
+    for name, text in iter_items(templates):
+      with open(os.path.join(template_dir, name), "wb") as io:
+        io.write(text.encode("utf8"))
+    try:
+      renderer = Renderer(template_dir, self.CACHE_DIR, filter = Helper.htmlquote)
+      # the body is held until the layout is streamed, and the head of the layout can be flushed
+      assert [u_("<html><head></head>"), u_("<body>\n"), u_("row0\nrow1\nrow2\n"), u_("</body></html>\n"), u_("after\n")] == \
+             list(renderer.stream_file("page", flush_size = 5))
+      assert renderer.render_file("page") == u_("").join(renderer.stream_file("page", flush_size = 5))
+      assert [u_("<html><head></head>"), u_("<body>\nrow0\nrow1\nrow2\n</body></html>\n"), u_("after\n")] == \
+             list(renderer.stream_file("page", flush_size = None))
+
+      # captured markup is not flushed
+      assert [u_("["), u_("item0,item1,item2,item3,item4,"), u_("]\n")] == list(renderer.stream_file("captured", flush_size = 5))
+      assert renderer.render_file("captured") == u_("").join(renderer.stream_file("captured", flush_size = 1))
+    finally:
+      shutil.rmtree(template_dir)
+
   def test_render_file_with_encoding(self):
     renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
     assert u_("""    表示される(SJIS)
@@ -187,6 +473,32 @@ class TestRendererAndHelper(Base):
 </div>
 """) == renderer.capture_outputs({})
 
+  def test_render_context(self):
+    app = self.app
+    app.renderer = Renderer(self.TEMPLATE_DIR, self.CACHE_DIR)
+
+    @app.helper
+    def nested_concat(helper, value, depth):
+      if depth:
+        return helper.nested_concat(value, depth - 1)
+      helper.concat(value)
+      assert helper.context is RenderContext.current()
+
+    assert u_("<b>deep</b>") == app.renderer.render_string(u_("<b><% h.nested_concat('deep', 20) %></b>"))
+    assert RenderContext.current() is None
+    assert None is app.renderer.template_globals["h"].context
+    with pytest.raises(AttributeError):
+      app.renderer.with_layout_file("layout")
+
+    # streams which are suspended do not affect other templates
+    template = u_("a<% flush() %><% with h.capture('v'): %><%= n %><% end %><% h.concat(u_(n)) %>[<%= v %>]")
+    stream1 = app.renderer.create_embpy(template).stream({"n": 1}, None)
+    stream2 = app.renderer.create_embpy(template).stream({"n": 2}, None)
+    assert u_("aa") == next(stream1) + next(stream2)
+    assert u_("a3[3]") == app.renderer.render_string(template, {"n": 3})
+    assert [u_("1[1]")] == list(stream1)
+    assert [u_("2[2]")] == list(stream2)
+
   def test_htmlquote(self):
     h = Helper()
     assert u_("&amp;&lt;&gt;&#39;&quot;") == h.htmlquote(u_("&<>'\""))